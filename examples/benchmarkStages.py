@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Benchmark the coadd pipeline stages on synthetic data
+
+Runs BackgroundSubtractionStage, WarpExposureStage, PsfMatchStage, CoaddGenerationStage, ChiSquaredStage,
+OutlierRejectionStage, RobustCoaddStage and FusedCoaddStage on synthetic exposures
+(see lsst.coadd.pipeline.syntheticData)
+and reports exposures/sec and megapixels/sec for each stage. Results may be saved as a baseline,
+and later runs compared against the baseline to flag performance regressions.
+"""
+from __future__ import with_statement
+
+import optparse
+import os
+import sys
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.daf.base as dafBase
+import lsst.pex.harness as pexHarness
+import lsst.pex.logging as pexLog
+import lsst.pex.policy as pexPolicy
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.syntheticData as syntheticData
+from lsst.pex.harness import Clipboard
+
+def timeStage(stageClass, inputDictList, log):
+    """Run a stage once per item of inputDictList and time it
+    
+    Inputs:
+    - stageClass: the parallel stage class
+    - inputDictList: list of dicts of input name (as in the stage's inputKeys policy): item;
+        the stage is run once per dict
+    - log: log
+    
+    @return stage, clipboardList, wallTime (sec)
+    """
+    stage = stageClass(pexPolicy.Policy(), log)
+    clipboardList = []
+    for inputDict in inputDictList:
+        clipboard = pexHarness.Clipboard.Clipboard()
+        for name, item in inputDict.iteritems():
+            clipboard.put(stage.policy.getString("inputKeys." + name), item)
+        clipboardList.append(clipboard)
+    startTime = time.time()
+    for clipboard in clipboardList:
+        stage.process(clipboard)
+    return stage, clipboardList, time.time() - startTime
+
+def getOutputList(stage, clipboardList, name):
+    """Return the output item with the specified name (as in the stage's outputKeys policy)
+    from each clipboard
+    """
+    clipboardKey = stage.policy.getString("outputKeys." + name)
+    return [clipboard.get(clipboardKey) for clipboard in clipboardList]
+
+def makeEventList(numExposures):
+    """Return a list of coadd events, the last of which has isLastExposure = True"""
+    eventList = []
+    for ind in range(numExposures):
+        event = dafBase.PropertySet()
+        event.add("isLastExposure", ind == numExposures - 1)
+        eventList.append(event)
+    return eventList
+
+def benchmark(width, height, numExposures, seed):
+    """Benchmark all stages on one synthetic data set
+    
+    @return a list of results, one per stage: dicts with fields:
+    - stage: name of stage
+    - width, height, numExposures: size of the data set
+    - wallTime: total time (sec)
+    - exposuresPerSec, megapixelsPerSec: throughput
+    """
+    log = pexLog.Log(pexLog.Log.getDefaultLog(), "benchmarkStages")
+    print "Make %d synthetic %dx%d exposures" % (numExposures, width, height)
+    referenceExposure, exposureList = syntheticData.makeDataset(width, height, numExposures, seed=seed)
+
+    resultList = []
+    def addResult(stageName, wallTime):
+        result = dict(
+            stage = stageName,
+            width = width,
+            height = height,
+            numExposures = numExposures,
+            wallTime = wallTime,
+            exposuresPerSec = numExposures / max(wallTime, 1.0e-9),
+            megapixelsPerSec = numExposures * width * height / 1.0e6 / max(wallTime, 1.0e-9),
+        )
+        print "%-25s %8.2f sec %8.2f exposures/sec %8.2f Mpix/sec" % \
+            (stageName, wallTime, result["exposuresPerSec"], result["megapixelsPerSec"])
+        resultList.append(result)
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.BackgroundSubtractionStageParallel,
+        [dict(exposure=exposure) for exposure in exposureList], log)
+    addResult("BackgroundSubtractionStage", wallTime)
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.WarpExposureStageParallel,
+        [dict(exposure=exposure, referenceExposure=referenceExposure) for exposure in exposureList], log)
+    addResult("WarpExposureStage", wallTime)
+    warpedExposureList = getOutputList(stage, clipboardList, "warpedExposure")
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.PsfMatchStageParallel,
+        [dict(warpedExposure=exposure, referenceExposure=referenceExposure)
+            for exposure in warpedExposureList], log)
+    addResult("PsfMatchStage", wallTime)
+    psfMatchedExposureList = getOutputList(stage, clipboardList, "psfMatchedExposure")
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.CoaddGenerationStageParallel,
+        [dict(psfMatchedExposure=exposure, event=event) for exposure, event
+            in zip(psfMatchedExposureList, makeEventList(numExposures))], log)
+    addResult("CoaddGenerationStage", wallTime)
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.ChiSquaredStageParallel,
+        [dict(exposure=exposure, event=event) for exposure, event
+            in zip(warpedExposureList, makeEventList(numExposures))], log)
+    addResult("ChiSquaredStage", wallTime)
+
+    maskedImageList = afwImage.vectorMaskedImageF([e.getMaskedImage() for e in psfMatchedExposureList])
+    stage, clipboardList, wallTime = timeStage(coaddPipe.OutlierRejectionStageParallel,
+        [dict(maskedImageList=maskedImageList)], log)
+    addResult("OutlierRejectionStage", wallTime)
+
+    # two passes: the exposures are re-streamed for pass two
+    eventList = makeEventList(numExposures) + makeEventList(numExposures)
+    stage, clipboardList, wallTime = timeStage(coaddPipe.RobustCoaddStageParallel,
+        [dict(exposure=exposure, event=event) for exposure, event
+            in zip(psfMatchedExposureList * 2, eventList)], log)
+    addResult("RobustCoaddStage", wallTime)
+
+    stage, clipboardList, wallTime = timeStage(coaddPipe.FusedCoaddStageParallel,
+        [dict(exposure=exposure, referenceExposure=referenceExposure, event=event) for exposure, event
+            in zip(exposureList, makeEventList(numExposures))], log)
+    addResult("FusedCoaddStage", wallTime)
+
+    return resultList
+
+def getResultKey(result):
+    """Return the key of a benchmark result in a baseline file"""
+    return "%s %dx%d x%d" % (result["stage"], result["width"], result["height"], result["numExposures"])
+
+def compareToBaseline(resultList, baselineDict, tolerance):
+    """Compare results to a baseline and print the comparison
+    
+    Inputs:
+    - resultList: list of results from benchmark
+    - baselineDict: dict of result key (see getResultKey): result
+    - tolerance: a result is a regression if its throughput is less than (1 - tolerance) times the baseline
+    
+    @return the number of regressions
+    """
+    numRegressions = 0
+    print "%-45s %12s %12s %8s" % ("Benchmark", "Mpix/sec", "Baseline", "Status")
+    for result in resultList:
+        key = getResultKey(result)
+        baseline = baselineDict.get(key)
+        if baseline == None:
+            print "%-45s %12.2f %12s %8s" % (key, result["megapixelsPerSec"], "-", "new")
+            continue
+        ratio = result["megapixelsPerSec"] / max(baseline["megapixelsPerSec"], 1.0e-9)
+        if ratio < 1.0 - tolerance:
+            status = "SLOWER"
+            numRegressions += 1
+        else:
+            status = "ok"
+        print "%-45s %12.2f %12.2f %8s" % (key, result["megapixelsPerSec"], baseline["megapixelsPerSec"],
+            status)
+    return numRegressions
+
+if __name__ == "__main__":
+    pexLog.Trace.setVerbosity('lsst.coadd', 0)
+    parser = optparse.OptionParser(usage = """usage: %prog [options]
+
+Benchmark the coadd pipeline stages on synthetic data.""")
+    parser.add_option("--size", action="append", dest="sizeList", metavar="WIDTHxHEIGHT",
+        help="size of the synthetic exposures; may be repeated (default: 1024x1024)")
+    parser.add_option("--num", type="int", default=5, help="number of exposures (default: %default)")
+    parser.add_option("--seed", type="int", default=0, help="random number seed (default: %default)")
+    parser.add_option("--baseline", help="path of a baseline file (JSON) to compare against")
+    parser.add_option("--save-baseline", action="store_true", dest="saveBaseline", default=False,
+        help="save the results to the baseline file (updating existing entries)")
+    parser.add_option("--tolerance", type="float", default=0.2,
+        help="fractional loss of throughput that counts as a regression (default: %default)")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments: %s" % (args,))
+    if options.saveBaseline and not options.baseline:
+        parser.error("--save-baseline requires --baseline")
+    sizeList = options.sizeList or ["1024x1024"]
+    
+    resultList = []
+    for sizeStr in sizeList:
+        width, height = [int(val) for val in sizeStr.lower().split("x")]
+        resultList += benchmark(width, height, options.num, options.seed)
+    
+    baselineDict = {}
+    if options.baseline and os.path.exists(options.baseline):
+        with file(options.baseline, "r") as baselineFile:
+            baselineDict = json.load(baselineFile)
+    print
+    numRegressions = compareToBaseline(resultList, baselineDict, options.tolerance)
+
+    if options.saveBaseline:
+        for result in resultList:
+            baselineDict[getResultKey(result)] = result
+        with file(options.baseline, "w") as baselineFile:
+            json.dump(baselineDict, baselineFile, indent=4, sort_keys=True)
+        print "Saved baseline to %s" % (options.baseline,)
+    
+    if numRegressions > 0:
+        print "%d benchmarks are more than %0.0f%% slower than the baseline" % \
+            (numRegressions, options.tolerance * 100)
+        sys.exit(1)
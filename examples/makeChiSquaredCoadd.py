@@ -37,6 +37,8 @@ import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.exposureIndex as exposureIndex
+import lsst.coadd.pipeline.policyCache as policyCache
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 Verbosity = 5
@@ -112,6 +114,9 @@ where:
   - the first exposure listed is the reference exposure:
         its size and WCS are used for the coadd exposure
   - empty lines and lines that start with # are ignored.
+  - if environment variable COADD_EXPOSURE_INDEX is set to the path of an exposure index
+    (an sqlite database, created if necessary) then exposures that do not overlap the reference
+    exposure are skipped without reading their pixels
 - policyPath is the path to a policy file
 """
     if len(sys.argv) not in (3, 4):
@@ -132,10 +137,7 @@ where:
     else:
         policy = pexPolicy.Policy()
     # remove the following bit once the code uses simpleStageTester
-    policyFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "ChiSquaredStageDictionary.paf", "policy")
-    print "policyFile %s loaded" % (policyFile,)
-    defPolicy = pexPolicy.Policy.createPolicy(policyFile, policyFile.getRepositoryPath())
-    policy.mergeDefaults(defPolicy)
+    policy = policyCache.mergeDefaults(policy, "coadd_pipeline", "ChiSquaredStageDictionary.paf")
     
     exposurePathList = []
     with file(exposureList, "rU") as infile:
@@ -146,6 +148,12 @@ where:
             filePath = line
             exposurePathList.append(filePath)
 
+    exposureIndexPath = os.environ.get("COADD_EXPOSURE_INDEX")
+    if exposureIndexPath:
+        numExposures = len(exposurePathList)
+        exposurePathList = exposureIndex.filterToFirstExposure(exposureIndexPath, exposurePathList)
+        print "%d of %d exposures overlap the reference exposure" % (len(exposurePathList), numExposures)
+
     coadd, weightMap = makeCoadd(exposurePathList, policy)
     coadd.writeFits(outName)
     weightMap.writeFits(weightOutName)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import with_statement
 
+import optparse
 import os
 import sys
 import time
@@ -13,32 +14,16 @@ import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.exposureIndex as exposureIndex
+import lsst.coadd.pipeline.parallelUtils as parallelUtils
+import lsst.coadd.pipeline.policyCache as policyCache
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 SaveDebugImages = False
 Verbosity = 1
+DefaultNumPrefetch = 2 # default number of exposures to read ahead
 
-BackgroundCellSize = 512
-
-def subtractBackground(maskedImage):
-    """Subtract the background from a MaskedImage
-    
-    Note: at present the mask and variance are ignored, but they might used be someday.
-    
-    Returns the background object returned by afwMath.makeBackground.
-    """
-    bkgControl = afwMath.BackgroundControl(afwMath.Interpolate.NATURAL_SPLINE)
-    bkgControl.setNxSample(int(maskedImage.getWidth() // BackgroundCellSize) + 1)
-    bkgControl.setNySample(int(maskedImage.getHeight() // BackgroundCellSize) + 1)
-    bkgControl.getStatisticsControl().setNumSigmaClip(3)
-    bkgControl.getStatisticsControl().setNumIter(3)
-
-    image = maskedImage.getImage()
-    bkgObj = afwMath.makeBackground(image, bkgControl)
-    image -= bkgObj.getImageF()
-    return bkgObj
-
-def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPolicy):
+def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPolicy, numPrefetch=0):
     """Make a coadd using psf-matching and chiSquaredStage
     
     Inputs:
@@ -46,6 +31,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPo
     - warpExposurePolicy: policy to control warping
     - psfMatchPolicy: policy to control psf-matching
     - chiSquaredPolicy: policy to control chi squared stage
+    - numPrefetch: number of exposures to read (and background-subtract) ahead in a background thread
     """
     if len(exposurePathList) == 0:
         print "No images specified; nothing to do"
@@ -62,6 +48,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPo
     psfMatchStage = coaddPipe.PsfMatchStage(psfMatchPolicy)
     psfMatchTester = pexHarness.simpleStageTester.SimpleStageTester(psfMatchStage)
     psfMatchTester.setDebugVerbosity(Verbosity)
+    backgroundStage = coaddPipe.BackgroundSubtractionStageParallel(pexPolicy.Policy(), pexLog.Log())
 #     stage = coaddPipe.CoaddGenerationStage(chiSquaredPolicy)
 #     tester = pexHarness.simpleStageTester.SimpleStageTester(stage)
 #     tester.setDebugVerbosity(Verbosity)
@@ -71,15 +58,19 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPo
     # process exposures
     referenceExposure = None
     lastInd = len(exposurePathList) - 1
-    for expInd, exposurePath in enumerate(exposurePathList):
+
+    def readExposure(exposurePath):
+        """Read an exposure and subtract its background"""
+        exposure = afwImage.ExposureF(exposurePath)
+        backgroundStage.subtractBackground(exposure.getMaskedImage())
+        return exposure
+
+    for expInd, (exposurePath, exposure) in enumerate(
+        parallelUtils.prefetch(readExposure, exposurePathList, numPrefetch)):
         isFirst = (expInd == 0)
         isLast = (expInd == lastInd)
 
         print "Processing exposure %d of %d: %s" % (expInd+1, lastInd+1, exposurePath)
-        exposure = afwImage.ExposureF(exposurePath)
-
-        print "Subtract background"
-        subtractBackground(exposure.getMaskedImage())
 
         clipboard = pexHarness.Clipboard.Clipboard()
         event = dafBase.PropertySet()
@@ -125,7 +116,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPo
 
 if __name__ == "__main__":
     pexLog.Trace.setVerbosity('lsst.coadd', Verbosity)
-    helpStr = """Usage: makeCoadd.py coaddPath exposureList  [psfMatchPolicyPath [coaddPolicyPath]]
+    helpStr = """Usage: makeCoadd.py [--prefetch K] coaddPath exposureList  [psfMatchPolicyPath [coaddPolicyPath]]
 
 where:
 - coaddPath is the desired name or path of the output coadd
@@ -136,47 +127,49 @@ where:
   - the first exposure listed is the reference exposure:
         its size and WCS are used for the coadd exposure
   - empty lines and lines that start with # are ignored.
+  - if environment variable COADD_EXPOSURE_INDEX is set to the path of an exposure index
+    (an sqlite database, created if necessary) then exposures that do not overlap the reference
+    exposure are skipped without reading their pixels
 - psfMatchPolicyPath is the path to a policy file; overrides for policy/PsfMatchToImageStageDictionary.paf
 - coaddPolicyPath is the path to a policy file; overrides for policy/ChiSquaredStageDictionary.paf
-"""
-    if len(sys.argv) not in (3, 4):
+- K is the number of exposures to read and background-subtract ahead in a background thread;
+    0 to read each exposure only when it is needed (default: %d)
+""" % (DefaultNumPrefetch,)
+    parser = optparse.OptionParser(add_help_option=False)
+    parser.add_option("--prefetch", type="int", default=DefaultNumPrefetch)
+    (options, args) = parser.parse_args()
+    if len(args) not in (2, 3):
         print helpStr
         sys.exit(0)
     
-    outName = sys.argv[1]
+    outName = args[0]
     if os.path.exists(outName + "_img.fits"):
         print "Coadd file %s already exists" % (outName,)
         sys.exit(1)
     weightOutName = outName + "_weight.fits"
     
-    exposureList = sys.argv[2]
+    exposureList = args[1]
 
-    if len(sys.argv) > 3:
-        policyPath = sys.argv[3]
+    if len(args) > 2:
+        policyPath = args[2]
         psfMatchPolicy = pexPolicy.Policy(policyPath)
     else:
         psfMatchPolicy = pexPolicy.Policy()
-    # There doesn't seem to be a better way to get at the policy dict; it should come from the stage. Sigh.
-    warpExposurePolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "WarpExposureStageDictionary.paf",
-        "policy")
-    warpExposurePolicy = pexPolicy.Policy.createPolicy(warpExposurePolFile,
-        warpExposurePolFile.getRepositoryPath())
-
-    psfMatchPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "PsfMatchToImageStageDictionary.paf", "policy")
-    defPsfMatchPolicy = pexPolicy.Policy.createPolicy(psfMatchPolFile, psfMatchPolFile.getRepositoryPath())
-    psfMatchPolicy.mergeDefaults(defPsfMatchPolicy)
+    warpExposurePolicy = policyCache.mergeDefaults(None, "coadd_pipeline", "WarpExposureStageDictionary.paf")
+
+    psfMatchPolicy = policyCache.mergeDefaults(psfMatchPolicy, "coadd_pipeline",
+        "PsfMatchToImageStageDictionary.paf")
     
     chiSquaredPolicy = pexPolicy.Policy()
     chiSquaredPolicy 
 
-    if len(sys.argv) > 4:
-        policyPath = sys.argv[4]
+    if len(args) > 3:
+        policyPath = args[3]
         chiSquaredPolicy = pexPolicy.Policy(chiSquaredPolicyPath)
     else:
         chiSquaredPolicy = pexPolicy.Policy()
-    chiSquaredPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "ChiSquaredStageDictionary.paf", "policy")
-    defChiSquaredPolicy = pexPolicy.Policy.createPolicy(chiSquaredPolFile, chiSquaredPolFile.getRepositoryPath())
-    chiSquaredPolicy.mergeDefaults(defChiSquaredPolicy)
+    chiSquaredPolicy = policyCache.mergeDefaults(chiSquaredPolicy, "coadd_pipeline",
+        "ChiSquaredStageDictionary.paf")
     
     exposurePathList = []
     with file(exposureList, "rU") as infile:
@@ -188,13 +181,20 @@ where:
             fileName = os.path.basename(filePath)
             exposurePathList.append(filePath)
 
+    exposureIndexPath = os.environ.get("COADD_EXPOSURE_INDEX")
+    if exposureIndexPath:
+        numExposures = len(exposurePathList)
+        exposurePathList = exposureIndex.filterToFirstExposure(exposureIndexPath, exposurePathList)
+        print "%d of %d exposures overlap the reference exposure" % (len(exposurePathList), numExposures)
+
     if len(exposurePathList) == 0:
         print "No exposures; nothing to do"
         sys.exit(0)
 
     startTime = time.time()
 
-    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPolicy)
+    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, chiSquaredPolicy,
+        numPrefetch=options.prefetch)
     coadd.writeFits(outName)
     weightMap.writeFits(weightOutName)
 
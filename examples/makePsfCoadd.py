@@ -24,6 +24,7 @@
 
 from __future__ import with_statement
 
+import optparse
 import os
 import sys
 import time
@@ -36,38 +37,26 @@ import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.exposureIndex as exposureIndex
+import lsst.coadd.pipeline.parallelUtils as parallelUtils
+import lsst.coadd.pipeline.policyCache as policyCache
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 SaveDebugImages = False
 Verbosity = 1
+DefaultNumPrefetch = 2 # default number of exposures to read ahead
 
-BackgroundCellSize = 512
-
-def subtractBackground(maskedImage):
-    """Subtract the background from a MaskedImage
-    
-    Note: at present the mask and variance are ignored, but they might used be someday.
-    
-    Returns the background object returned by afwMath.makeBackground.
-    """
-    bkgControl = afwMath.BackgroundControl(afwMath.Interpolate.NATURAL_SPLINE)
-    bkgControl.setNxSample(int(maskedImage.getWidth() // BackgroundCellSize) + 1)
-    bkgControl.setNySample(int(maskedImage.getHeight() // BackgroundCellSize) + 1)
-    bkgControl.getStatisticsControl().setNumSigmaClip(3)
-    bkgControl.getStatisticsControl().setNumIter(3)
-
-    image = maskedImage.getImage()
-    bkgObj = afwMath.makeBackground(image, bkgControl)
-    image -= bkgObj.getImageF()
-    return bkgObj
-
-def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPolicy):
+def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPolicy, numPrefetch=0,
+    referenceExposure=None):
     """Make a coadd using psf-matching and coaddGenerationStage
     
     Inputs:
     - exposurePathList: a list of paths to calibrated science exposures
     - warpExposurePolicy: policy to control warping
     - psfMatchPolicy: policy to control psf-matching
+    - numPrefetch: number of exposures to read (and background-subtract) ahead in a background thread
+    - referenceExposure: exposure to which to warp and psf-match all exposures (e.g. the coadd
+        being updated; see coaddGenPolicy.seedPolicy); if None then the first exposure is used
     """
     if len(exposurePathList) == 0:
         print "No images specified; nothing to do"
@@ -84,6 +73,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPoli
     psfMatchStage = coaddPipe.PsfMatchStage(psfMatchPolicy)
     psfMatchTester = pexHarness.simpleStageTester.SimpleStageTester(psfMatchStage)
     psfMatchTester.setDebugVerbosity(Verbosity)
+    backgroundStage = coaddPipe.BackgroundSubtractionStageParallel(pexPolicy.Policy(), pexLog.Log())
 #     stage = coaddPipe.CoaddGenerationStage(coaddGenPolicy)
 #     tester = pexHarness.simpleStageTester.SimpleStageTester(stage)
 #     tester.setDebugVerbosity(Verbosity)
@@ -91,17 +81,20 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPoli
     coaddGenerationStage = coaddPipe.CoaddGenerationStageParallel(coaddGenPolicy, tempLog)
     
     # process exposures
-    referenceExposure = None
     lastInd = len(exposurePathList) - 1
-    for expInd, exposurePath in enumerate(exposurePathList):
+
+    def readExposure(exposurePath):
+        """Read an exposure and subtract its background"""
+        exposure = afwImage.ExposureF(exposurePath)
+        backgroundStage.subtractBackground(exposure.getMaskedImage())
+        return exposure
+
+    for expInd, (exposurePath, exposure) in enumerate(
+        parallelUtils.prefetch(readExposure, exposurePathList, numPrefetch)):
         isFirst = (expInd == 0)
         isLast = (expInd == lastInd)
 
         print "Processing exposure %d of %d: %s" % (expInd+1, lastInd+1, exposurePath)
-        exposure = afwImage.ExposureF(exposurePath)
-
-        print "Subtract background"
-        subtractBackground(exposure.getMaskedImage())
 
         clipboard = pexHarness.Clipboard.Clipboard()
         event = dafBase.PropertySet()
@@ -140,7 +133,8 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPoli
 
 if __name__ == "__main__":
     pexLog.Trace.setVerbosity('lsst.coadd', Verbosity)
-    helpStr = """Usage: makeCoadd.py coaddPath exposureList  [psfMatchPolicyPath [coaddGenerationPolicyPath]]
+    helpStr = """Usage: makeCoadd.py [--prefetch K] [--update oldCoaddPath] coaddPath exposureList
+    [psfMatchPolicyPath [coaddGenerationPolicyPath]]
 
 where:
 - coaddPath is the desired name or path of the output coadd
@@ -151,45 +145,54 @@ where:
   - the first exposure listed is the reference exposure:
         its size and WCS are used for the coadd exposure
   - empty lines and lines that start with # are ignored.
+  - if environment variable COADD_EXPOSURE_INDEX is set to the path of an exposure index
+    (an sqlite database, created if necessary) then exposures that do not overlap the reference
+    exposure are skipped without reading their pixels
 - psfMatchPolicyPath is the path to a policy file; overrides for policy/PsfMatchToImageStageDictionary.paf
 - coaddGenerationPolicyPath is the path to a policy file; overrides for
     policy/CoaddGenerationStageDictionary.paf
-"""
-    if len(sys.argv) not in (3, 4):
+- K is the number of exposures to read and background-subtract ahead in a background thread;
+    0 to read each exposure only when it is needed (default: %d)
+- oldCoaddPath is the path of a coadd made by this script (with weight map oldCoaddPath_weight.fits)
+    to which to add the exposures; the new coadd has its size and WCS and every exposure is
+    warped and psf-matched to it
+""" % (DefaultNumPrefetch,)
+    parser = optparse.OptionParser(add_help_option=False)
+    parser.add_option("--prefetch", type="int", default=DefaultNumPrefetch)
+    parser.add_option("--update", default="")
+    (options, args) = parser.parse_args()
+    if len(args) not in (2, 3):
         print helpStr
         sys.exit(0)
     
-    outName = sys.argv[1]
+    outName = args[0]
     if os.path.exists(outName + "_img.fits"):
         print "Coadd file %s already exists" % (outName,)
         sys.exit(1)
     weightOutName = outName + "_weight.fits"
     
-    exposureList = sys.argv[2]
+    exposureList = args[1]
 
-    if len(sys.argv) > 3:
-        policyPath = sys.argv[3]
+    if len(args) > 2:
+        policyPath = args[2]
         psfMatchPolicy = pexPolicy.Policy(policyPath)
     else:
         psfMatchPolicy = pexPolicy.Policy()
-    # There doesn't seem to be a better way to get at the policy dict; it should come from the stage. Sigh.
-    warpExposurePolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "WarpExposureStageDictionary.paf",
-        "policy")
-    warpExposurePolicy = pexPolicy.Policy.createPolicy(warpExposurePolFile,
-        warpExposurePolFile.getRepositoryPath())
-
-    psfMatchPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "PsfMatchToImageStageDictionary.paf", "policy")
-    defPsfMatchPolicy = pexPolicy.Policy.createPolicy(psfMatchPolFile, psfMatchPolFile.getRepositoryPath())
-    psfMatchPolicy.mergeDefaults(defPsfMatchPolicy)
-
-    if len(sys.argv) > 4:
-        policyPath = sys.argv[4]
+    warpExposurePolicy = policyCache.mergeDefaults(None, "coadd_pipeline", "WarpExposureStageDictionary.paf")
+
+    psfMatchPolicy = policyCache.mergeDefaults(psfMatchPolicy, "coadd_pipeline",
+        "PsfMatchToImageStageDictionary.paf")
+
+    if len(args) > 3:
+        policyPath = args[3]
         coaddGenPolicy = pexPolicy.Policy(coaddGenerationPolicyPath)
     else:
         coaddGenPolicy = pexPolicy.Policy()
-    coaddGenPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "CoaddGenerationStageDictionary.paf", "policy")
-    defCoaddGenPolicy = pexPolicy.Policy.createPolicy(coaddGenPolFile, coaddGenPolFile.getRepositoryPath())
-    coaddGenPolicy.mergeDefaults(defCoaddGenPolicy)
+    coaddGenPolicy = policyCache.mergeDefaults(coaddGenPolicy, "coadd_pipeline",
+        "CoaddGenerationStageDictionary.paf")
+    if options.update:
+        coaddGenPolicy.set("seedPolicy.coaddPath", options.update)
+        coaddGenPolicy.set("seedPolicy.weightMapPath", options.update + "_weight.fits")
     
     exposurePathList = []
     with file(exposureList, "rU") as infile:
@@ -200,13 +203,28 @@ where:
             filePath = line
             exposurePathList.append(filePath)
 
+    exposureIndexPath = os.environ.get("COADD_EXPOSURE_INDEX")
+    if exposureIndexPath:
+        numExposures = len(exposurePathList)
+        if options.update:
+            wcs, bbox = exposureIndex.readExposureGeometry(options.update)
+            exposurePathList = exposureIndex.filterExposurePathList(exposureIndexPath, exposurePathList,
+                wcs, bbox)
+        else:
+            exposurePathList = exposureIndex.filterToFirstExposure(exposureIndexPath, exposurePathList)
+        print "%d of %d exposures overlap the reference exposure" % (len(exposurePathList), numExposures)
+
     if len(exposurePathList) == 0:
         print "No exposures; nothing to do"
         sys.exit(0)
 
     startTime = time.time()
 
-    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPolicy)
+    referenceExposure = None
+    if options.update:
+        referenceExposure = afwImage.ExposureF(options.update)
+    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, coaddGenPolicy,
+        numPrefetch=options.prefetch, referenceExposure=referenceExposure)
     coadd.writeFits(outName)
     weightMap.writeFits(weightOutName)
 
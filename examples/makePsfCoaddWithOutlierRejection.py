@@ -24,11 +24,19 @@
 
 """Exercise outlierRejectionStage
 
-To avoid filling up the disk or memory, it simply runs over small bit of a set of exposures
+To avoid filling up the disk or memory, it simply runs over small bit of a set of exposures,
+unless tiling is enabled in the outlier rejection policy (outlierRejectionPolicy.tileWidth
+and/or tileHeight); in that case the psf-matched exposures are saved to a scratch directory
+and OutlierRejectionStage reads them back one tile at a time. With --cube the psf-matched
+masked images are instead written, as they are produced, into a memory-mapped stack cube
+(see lsst.coadd.pipeline.stackCube) from which OutlierRejectionStage reads each tile.
 """
 from __future__ import with_statement
 
 import sys, os, math
+import optparse
+import shutil
+import tempfile
 
 import pdb
 import unittest
@@ -41,39 +49,28 @@ import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.exposureIndex as exposureIndex
+import lsst.coadd.pipeline.parallelUtils as parallelUtils
+import lsst.coadd.pipeline.policyCache as policyCache
+import lsst.coadd.pipeline.stackCube as stackCube
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 SaveDebugImages = False
 Verbosity = 1
+DefaultNumPrefetch = 2 # default number of exposures to read ahead
 
 BBox = afwImage.BBox(afwImage.PointI(0, 0), 100, 100)
 
-BackgroundCellSize = 512
-
-def subtractBackground(maskedImage):
-    """Subtract the background from a MaskedImage
-    
-    Note: at present the mask and variance are ignored, but they might used be someday.
-    
-    Returns the background object returned by afwMath.makeBackground.
-    """
-    bkgControl = afwMath.BackgroundControl(afwMath.Interpolate.NATURAL_SPLINE)
-    bkgControl.setNxSample(int(maskedImage.getWidth() // BackgroundCellSize) + 1)
-    bkgControl.setNySample(int(maskedImage.getHeight() // BackgroundCellSize) + 1)
-    bkgControl.getStatisticsControl().setNumSigmaClip(3)
-    bkgControl.getStatisticsControl().setNumIter(3)
-
-    image = maskedImage.getImage()
-    bkgObj = afwMath.makeBackground(image, bkgControl)
-    image -= bkgObj.getImageF()
-    return bkgObj
-
-def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejectionPolicy):
+def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejectionPolicy, numPrefetch=0,
+    useStackCube=False):
     """Make a coadd using psf-matching and outlierRejectionStage
     
     Inputs:
     - exposurePathList: a list of paths to calibrated science exposures
     - psfMatchPolicy: policy to control psf-matching
+    - numPrefetch: number of exposures to read (and background-subtract) ahead in a background thread
+    - useStackCube: if True then write the psf-matched masked images into a memory-mapped stack cube
+        in a scratch directory, rather than keeping them in memory
     """
     if len(exposurePathList) == 0:
         print "No images specified; nothing to do"
@@ -90,22 +87,36 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejec
     psfMatchStage = coaddPipe.PsfMatchStage(psfMatchPolicy)
     psfMatchTester = pexHarness.simpleStageTester.SimpleStageTester(psfMatchStage)
     psfMatchTester.setDebugVerbosity(Verbosity)
+    backgroundStage = coaddPipe.BackgroundSubtractionStageParallel(pexPolicy.Policy(), pexLog.Log())
     outlierRejectionStage = coaddPipe.OutlierRejectionStage(outlierRejectionPolicy)
     outlierRejectionTester = pexHarness.simpleStageTester.SimpleStageTester(outlierRejectionStage)
     outlierRejectionTester.setDebugVerbosity(Verbosity)
     
+    tileWidth = outlierRejectionPolicy.get("outlierRejectionPolicy.tileWidth")
+    tileHeight = outlierRejectionPolicy.get("outlierRejectionPolicy.tileHeight")
+    useTiles = (tileWidth > 0) or (tileHeight > 0)
+    useScratchDir = useTiles or useStackCube
+    if useScratchDir:
+        scratchDir = tempfile.mkdtemp(prefix="outlierRejection")
+    cube = None
+    
     # process exposures
     referenceExposure = None
     lastInd = len(exposurePathList) - 1
     psfMatchedExposureList = []
-    for expInd, exposurePath in enumerate(exposurePathList):
-        isLast = (expInd == lastInd)
+    psfMatchedPathList = []
 
-        print "Processing exposure %d of %d: %s" % (expInd+1, lastInd+1, exposurePath)
+    def readExposure(exposurePath):
+        """Read an exposure and subtract its background"""
         exposure = afwImage.ExposureF(exposurePath)
+        backgroundStage.subtractBackground(exposure.getMaskedImage())
+        return exposure
+
+    for expInd, (exposurePath, exposure) in enumerate(
+        parallelUtils.prefetch(readExposure, exposurePathList, numPrefetch)):
+        isLast = (expInd == lastInd)
 
-        print "Subtract background"
-        subtractBackground(exposure.getMaskedImage())
+        print "Processing exposure %d of %d: %s" % (expInd+1, lastInd+1, exposurePath)
 
         clipboard = pexHarness.Clipboard.Clipboard()
 
@@ -113,7 +124,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejec
         if not referenceExposure:
             print "First exposure; simply add to coadd"
             referenceExposure = exposure
-            psfMatchedExposureList.append(afwImage.ExposureF(exposure, BBox))
+            psfMatchedExposure = exposure
         else:
             clipboard.put(warpExposurePolicy.get("inputKeys.exposure"), exposure)
             clipboard.put(warpExposurePolicy.get("inputKeys.referenceExposure"), referenceExposure)
@@ -121,18 +132,41 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejec
             psfMatchTester.runWorker(clipboard)
             
             psfMatchedExposure = clipboard.get(psfMatchPolicy.get("outputKeys.psfMatchedExposure"))
-            psfMatchedExposureList.append(afwImage.ExposureF(psfMatchedExposure, BBox))
             if SaveDebugImages:
                 exposureName = os.path.basename(exposurePath)
                 warpedExposure = clipboard.get(warpExposurePolicy.get("outputKeys.warpedExposure"))
                 warpedExposure.writeFits("warped_%s" % (exposureName,))
                 psfMatchedExposure.writeFits("psfMatched_%s" % (exposureName,))
 
+        if useStackCube:
+            psfMatchedMaskedImage = psfMatchedExposure.getMaskedImage()
+            if cube == None:
+                cube = stackCube.StackCube.create(os.path.join(scratchDir, "stack"),
+                    psfMatchedMaskedImage.getWidth(), psfMatchedMaskedImage.getHeight(), lastInd + 1)
+            cube.setMaskedImage(expInd, psfMatchedMaskedImage)
+        elif useTiles:
+            psfMatchedPath = os.path.join(scratchDir, "psfMatched%d" % (expInd,))
+            psfMatchedExposure.getMaskedImage().writeFits(psfMatchedPath)
+            psfMatchedPathList.append(psfMatchedPath)
+        else:
+            psfMatchedExposureList.append(afwImage.ExposureF(psfMatchedExposure, BBox))
+
     clipboard = pexHarness.Clipboard.Clipboard()
-    psfMatchedMaskedImageList = afwImage.vectorMaskedImageF(
-        [e.getMaskedImage() for e in psfMatchedExposureList])
-    clipboard.put(outlierRejectionPolicy.get("inputKeys.maskedImageList"), psfMatchedMaskedImageList)
-    outlierRejectionTester.runWorker(clipboard)
+    if useStackCube:
+        cube.flush()
+        clipboard.put(outlierRejectionPolicy.get("inputKeys.stackCubePath"), cube.path)
+    elif useTiles:
+        clipboard.put(outlierRejectionPolicy.get("inputKeys.maskedImagePathList"), psfMatchedPathList)
+    else:
+        psfMatchedMaskedImageList = afwImage.vectorMaskedImageF(
+            [e.getMaskedImage() for e in psfMatchedExposureList])
+        clipboard.put(outlierRejectionPolicy.get("inputKeys.maskedImageList"), psfMatchedMaskedImageList)
+    try:
+        outlierRejectionTester.runWorker(clipboard)
+    finally:
+        if useScratchDir:
+            del cube
+            shutil.rmtree(scratchDir)
     coaddMaskedImage = clipboard.get(outlierRejectionPolicy.get("outputKeys.coadd"))
     coaddExposure = afwImage.makeExposure(coaddMaskedImage, referenceExposure.getWcs())
     weightMap = clipboard.get(outlierRejectionPolicy.get("outputKeys.weightMap"))
@@ -140,7 +174,7 @@ def makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejec
 
 if __name__ == "__main__":
     pexLog.Trace.setVerbosity('lsst.coadd', Verbosity)
-    helpStr = """Usage: makePsfCoaddWithOutlierRejection.py coaddPath psfMatchedExposureList  [psfMatchPolicyPath [outlierRejectionPolicyPath]]
+    helpStr = """Usage: makePsfCoaddWithOutlierRejection.py [--prefetch K] [--cube] coaddPath psfMatchedExposureList  [psfMatchPolicyPath [outlierRejectionPolicyPath]]
 
 where:
 - coaddPath is the desired name or path of the output coadd
@@ -151,46 +185,50 @@ where:
   - the first exposure listed is the reference exposure:
         its size and WCS are used for the coadd exposure
   - empty lines and lines that start with # are ignored.
+  - if environment variable COADD_EXPOSURE_INDEX is set to the path of an exposure index
+    (an sqlite database, created if necessary) then exposures that do not overlap the reference
+    exposure are skipped without reading their pixels
 - psfMatchPolicyPath is the path to a policy file; overrides for policy/PsfMatchToImageStageDictionary.paf
 - outlierRejectionPolicyPath is the path to a policy file; overrides for
     policy/OutlierRejectionStageDictionary.paf
-"""
-    if len(sys.argv) not in (3, 4):
+- K is the number of exposures to read and background-subtract ahead in a background thread;
+    0 to read each exposure only when it is needed (default: %d)
+- --cube: write the psf-matched images into a memory-mapped stack cube in a scratch directory
+    instead of keeping them in memory; set outlierRejectionPolicy.tileWidth and/or tileHeight
+    so that OutlierRejectionStage only reads one tile of the stack at a time
+""" % (DefaultNumPrefetch,)
+    parser = optparse.OptionParser(add_help_option=False)
+    parser.add_option("--prefetch", type="int", default=DefaultNumPrefetch)
+    parser.add_option("--cube", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+    if len(args) not in (2, 3):
         print helpStr
         sys.exit(0)
     
-    outName = sys.argv[1]
+    outName = args[0]
     if os.path.exists(outName + "_img.fits"):
         print "Coadd file %s already exists" % (outName,)
         sys.exit(1)
     weightOutName = outName + "_weight.fits"
     
-    psfMatchedExposureList = sys.argv[2]
+    psfMatchedExposureList = args[1]
 
-    if len(sys.argv) > 3:
-        policyPath = sys.argv[3]
+    if len(args) > 2:
+        policyPath = args[2]
         psfMatchPolicy = pexPolicy.Policy(policyPath)
     else:
         psfMatchPolicy = pexPolicy.Policy()
-    # There doesn't seem to be a better way to get at the policy dict; it should come from the stage. Sigh.
-    warpExposurePolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "WarpExposureStageDictionary.paf",
-        "policy")
-    warpExposurePolicy = pexPolicy.Policy.createPolicy(warpExposurePolFile,
-        warpExposurePolFile.getRepositoryPath())
-    psfMatchPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "PsfMatchToImageStageDictionary.paf", "policy")
-    defPsfMatchPolicy = pexPolicy.Policy.createPolicy(psfMatchPolFile, psfMatchPolFile.getRepositoryPath())
-    psfMatchPolicy.mergeDefaults(defPsfMatchPolicy)
-
-    if len(sys.argv) > 4:
-        policyPath = sys.argv[4]
+    warpExposurePolicy = policyCache.mergeDefaults(None, "coadd_pipeline", "WarpExposureStageDictionary.paf")
+    psfMatchPolicy = policyCache.mergeDefaults(psfMatchPolicy, "coadd_pipeline",
+        "PsfMatchToImageStageDictionary.paf")
+
+    if len(args) > 3:
+        policyPath = args[3]
         outlierRejectionPolicy = pexPolicy.Policy(outlierRejectionPolicyPath)
     else:
         outlierRejectionPolicy = pexPolicy.Policy()
-    outlierRejectionPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline",
-        "OutlierRejectionStageDictionary.paf", "policy")
-    defOutlierRejectionPolicy = pexPolicy.Policy.createPolicy(outlierRejectionPolFile,
-        outlierRejectionPolFile.getRepositoryPath())
-    outlierRejectionPolicy.mergeDefaults(defOutlierRejectionPolicy)
+    outlierRejectionPolicy = policyCache.mergeDefaults(outlierRejectionPolicy, "coadd_pipeline",
+        "OutlierRejectionStageDictionary.paf")
     
     exposurePathList = []
     with file(psfMatchedExposureList, "rU") as infile:
@@ -201,6 +239,13 @@ where:
             filePath = line
             exposurePathList.append(filePath)
 
-    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejectionPolicy)
+    exposureIndexPath = os.environ.get("COADD_EXPOSURE_INDEX")
+    if exposureIndexPath:
+        numExposures = len(exposurePathList)
+        exposurePathList = exposureIndex.filterToFirstExposure(exposureIndexPath, exposurePathList)
+        print "%d of %d exposures overlap the reference exposure" % (len(exposurePathList), numExposures)
+
+    coadd, weightMap = makeCoadd(exposurePathList, warpExposurePolicy, psfMatchPolicy, outlierRejectionPolicy,
+        numPrefetch=options.prefetch, useStackCube=options.cube)
     coadd.writeFits(outName)
     weightMap.writeFits(weightOutName)
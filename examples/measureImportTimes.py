@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Measure the time to import lsst.coadd.pipeline and each of its stage modules
+
+Each import is timed in a fresh interpreter, so the time includes all dependencies
+that the module imports (as it would for a newly started worker).
+"""
+import optparse
+import subprocess
+import sys
+
+import lsst.coadd.pipeline as coaddPipe
+
+ImportTimerCode = """
+import time
+startTime = time.time()
+import %s
+print time.time() - startTime
+"""
+
+def measureImportTime(moduleName, numRepeats):
+    """Return the minimum time (sec) to import a module in a fresh interpreter
+    
+    @raise RuntimeError if the import fails
+    """
+    timeList = []
+    for i in range(numRepeats):
+        proc = subprocess.Popen([sys.executable, "-c", ImportTimerCode % (moduleName,)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdoutData, stderrData = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("Could not import %s:\n%s" % (moduleName, stderrData))
+        timeList.append(float(stdoutData.strip().split()[-1]))
+    return min(timeList)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage = """usage: %prog [options]
+
+Measure the time to import lsst.coadd.pipeline and each of its stage modules.""")
+    parser.add_option("--repeat", type="int", default=3,
+        help="number of times to import each module; the minimum time is reported (default: %default)")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments: %s" % (args,))
+
+    moduleNameList = [coaddPipe.__name__] + \
+        ["%s.%s" % (coaddPipe.__name__, name) for name in coaddPipe.getStageModuleNames()]
+    print "%-50s %10s" % ("Module", "Time (sec)")
+    for moduleName in moduleNameList:
+        print "%-50s %10.3f" % (moduleName, measureImportTime(moduleName, options.repeat))
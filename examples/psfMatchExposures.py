@@ -36,30 +36,11 @@ import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.policyCache as policyCache
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 Verbosity = 1
 
-BackgroundCellSize = 512
-
-def subtractBackground(maskedImage):
-    """Subtract the background from a MaskedImage
-    
-    Note: at present the mask and variance are ignored, but they might used be someday.
-    
-    Returns the background object returned by afwMath.makeBackground.
-    """
-    bkgControl = afwMath.BackgroundControl(afwMath.Interpolate.NATURAL_SPLINE)
-    bkgControl.setNxSample(int(maskedImage.getWidth() // BackgroundCellSize) + 1)
-    bkgControl.setNySample(int(maskedImage.getHeight() // BackgroundCellSize) + 1)
-    bkgControl.getStatisticsControl().setNumSigmaClip(3)
-    bkgControl.getStatisticsControl().setNumIter(3)
-
-    image = maskedImage.getImage()
-    bkgObj = afwMath.makeBackground(image, bkgControl)
-    image -= bkgObj.getImageF()
-    return bkgObj
-
 def psfMatchExposures(exposurePathList, warpExposurePolicy, psfMatchPolicy):
     """Warp and psf-match a set of exposures to match a reference exposure
     
@@ -80,6 +61,7 @@ def psfMatchExposures(exposurePathList, warpExposurePolicy, psfMatchPolicy):
     psfMatchStage = coaddPipe.PsfMatchStage(psfMatchPolicy)
     psfMatchTester = pexHarness.simpleStageTester.SimpleStageTester(psfMatchStage)
     psfMatchTester.setDebugVerbosity(Verbosity)
+    backgroundStage = coaddPipe.BackgroundSubtractionStageParallel(pexPolicy.Policy(), pexLog.Log())
 
     # process exposures
     referenceExposurePath = exposurePathList[0]
@@ -91,7 +73,7 @@ def psfMatchExposures(exposurePathList, warpExposurePolicy, psfMatchPolicy):
         exposureName = os.path.basename(exposurePath)
 
         print "Subtract background"
-        subtractBackground(exposure.getMaskedImage())
+        backgroundStage.subtractBackground(exposure.getMaskedImage())
 
         # set up the clipboard
         clipboard = pexHarness.Clipboard.Clipboard()
@@ -149,15 +131,10 @@ where:
         print "No exposures; nothing to do"
         sys.exit(0)
 
-    # There doesn't seem to be a better way to get at the policy dict; it should come from the stage. Sigh.
-    warpExposurePolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "WarpExposureStageDictionary.paf",
-        "policy")
-    warpExposurePolicy = pexPolicy.Policy.createPolicy(warpExposurePolFile,
-        warpExposurePolFile.getRepositoryPath())
+    warpExposurePolicy = policyCache.mergeDefaults(None, "coadd_pipeline", "WarpExposureStageDictionary.paf")
 
-    psfMatchPolFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "PsfMatchToImageStageDictionary.paf", "policy")
-    defPsfMatchPolicy = pexPolicy.Policy.createPolicy(psfMatchPolFile, psfMatchPolFile.getRepositoryPath())
-    psfMatchPolicy.mergeDefaults(defPsfMatchPolicy)
+    psfMatchPolicy = policyCache.mergeDefaults(psfMatchPolicy, "coadd_pipeline",
+        "PsfMatchToImageStageDictionary.paf")
     
     startTime = time.time()
 
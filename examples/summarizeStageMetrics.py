@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Summarize stage measurements written by stages with instrumentationPolicy.jsonLinesPath set
+"""
+import sys
+
+import lsst.coadd.pipeline.stageMetrics as stageMetrics
+
+def printSummary(jsonLinesPathList):
+    """Print a per-stage summary of the measurements in a set of JSON lines files
+    """
+    measurementList = []
+    for jsonLinesPath in jsonLinesPathList:
+        measurementList += stageMetrics.readMeasurements(jsonLinesPath)
+    summaryDict = stageMetrics.summarizeMeasurements(measurementList)
+
+    print "%-35s %7s %7s %10s %10s %12s %10s" % \
+        ("Stage", "Calls", "Failed", "Wall (s)", "CPU (s)", "MaxRssDelta", "Mpix/s")
+    for stageName in sorted(summaryDict.keys()):
+        summary = summaryDict[stageName]
+        print "%-35s %7d %7d %10.1f %10.1f %12d %10.2f" % (stageName, summary["numCalls"],
+            summary["numFailed"], summary["wallTime"], summary["cpuTime"], summary["maxRssDelta"],
+            summary["megapixelsPerSec"])
+
+if __name__ == "__main__":
+    helpStr = """Usage: summarizeStageMetrics.py jsonLinesPath [jsonLinesPath ...]
+
+where:
+- jsonLinesPath is a file of stage measurements (see policy/InstrumentationDictionary.paf)
+"""
+    if len(sys.argv) < 2:
+        print helpStr
+        sys.exit(0)
+    
+    printSummary(sys.argv[1:])
@@ -34,6 +34,7 @@ import lsst.pex.harness as pexHarness
 import lsst.pex.policy as pexPolicy
 import lsst.afw.image as afwImage
 import lsst.coadd.pipeline as coaddPipe
+import lsst.coadd.pipeline.policyCache as policyCache
 from lsst.pex.harness import Clipboard, simpleStageTester
 
 Verbosity = 5
@@ -98,10 +99,7 @@ where:
         policy = pexPolicy.Policy(policyPath)
     else:
         policy = pexPolicy.Policy()
-    # There doesn't seem to be a better way to get at the policy dict; it should come from the stage. Sigh.
-    policyFile = pexPolicy.DefaultPolicyFile("coadd_pipeline", "WarpExposureStageDictionary.paf", "policy")
-    defPolicy = pexPolicy.Policy.createPolicy(policyFile, policyFile.getRepositoryPath())
-    policy.mergeDefaults(defPolicy)
+    policy = policyCache.mergeDefaults(policy, "coadd_pipeline", "WarpExposureStageDictionary.paf")
     
     exposurePathList = []
     with file(exposureList, "rU") as infile:
@@ -20,8 +20,77 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-from chiSquaredStage import *
-from psfMatchToImageStage import *
-from coaddGenerationStage import *
-from outlierRejectionStage import *
-from warpExposureStage import *
+
+"""Pipeline stages for making coadds
+
+The stage modules are imported on first access of one of their names (e.g. WarpExposureStage)
+rather than when this package is imported, so that a worker that runs one stage does not pay
+to import the dependencies of the others (lsst.coadd.chisquared, lsst.coadd.psfmatched, ip_diffim...).
+getImportTimes reports how long each stage module took to import; examples/measureImportTimes.py
+measures the import time of each stage module in a fresh interpreter.
+"""
+import sys
+import time
+import types
+
+# stage module name: names it provides
+_stageModuleNameDict = {
+    "backgroundSubtractionStage": ("BackgroundSubtractionStageParallel", "BackgroundSubtractionStage"),
+    "chiSquaredStage": ("ChiSquaredStageParallel", "ChiSquaredStage"),
+    "coaddGenerationStage": ("CoaddGenerationStageParallel", "CoaddGenerationStage"),
+    "coaddMergeStage": ("CoaddMergeStageParallel", "CoaddMergeStage"),
+    "fusedCoaddStage": ("FusedCoaddStageParallel", "FusedCoaddStage"),
+    "outlierRejectionStage": ("OutlierRejectionStageParallel", "OutlierRejectionStage"),
+    "psfMatchToImageStage": ("PsfMatchStageParallel", "PsfMatchStage", "convolveExposure"),
+    "robustCoaddStage": ("RobustCoaddStageParallel", "RobustCoaddStage"),
+    "warpExposureStage": ("WarpExposureStageParallel", "WarpExposureStage"),
+}
+
+# name: stage module that provides it
+_nameModuleDict = {}
+for _moduleName, _nameList in _stageModuleNameDict.iteritems():
+    for _name in _nameList:
+        _nameModuleDict[_name] = _moduleName
+del _moduleName, _nameList, _name
+
+_importTimeDict = {} # stage module name: import time (sec)
+
+__all__ = sorted(_nameModuleDict.keys()) + ["getImportTimes", "getStageModuleNames"]
+
+def getStageModuleNames():
+    """Return the names of the stage modules, e.g. "warpExposureStage"
+    """
+    return sorted(_stageModuleNameDict.keys())
+
+def getImportTimes():
+    """Return a dict of stage module name: time (sec) it took to import,
+    for each stage module imported so far by accessing one of its names
+    
+    Dependencies already imported by another module are not counted.
+    """
+    return _importTimeDict.copy()
+
+class _LazyStageModule(types.ModuleType):
+    """This package, with the names provided by the stage modules imported on first access
+    """
+    def __getattr__(self, name):
+        moduleName = _nameModuleDict.get(name)
+        if moduleName is None:
+            raise AttributeError("module %r has no attribute %r" % (self.__name__, name))
+        fullModuleName = "%s.%s" % (self.__name__, moduleName)
+        startTime = time.time()
+        __import__(fullModuleName)
+        _importTimeDict.setdefault(moduleName, time.time() - startTime)
+        module = sys.modules[fullModuleName]
+        for moduleItemName in _stageModuleNameDict[moduleName]:
+            setattr(self, moduleItemName, getattr(module, moduleItemName))
+        return getattr(module, name)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(_nameModuleDict.keys()))
+
+_lazyModule = _LazyStageModule(__name__, __doc__)
+_lazyModule.__dict__.update(sys.modules[__name__].__dict__)
+# keep the original module alive; its globals are cleared if it is deleted
+_lazyModule._originalModule = sys.modules[__name__]
+sys.modules[__name__] = _lazyModule
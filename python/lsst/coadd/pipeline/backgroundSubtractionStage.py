@@ -0,0 +1,143 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import numpy
+
+from lsst.pex.logging import Log
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import baseStage
+import parallelUtils
+
+class BackgroundSubtractionStageParallel(baseStage.ParallelStage):
+    """Pipeline stage to subtract the background from an exposure, in place.
+    
+    The background is fit with afwMath.makeBackground on cells of cellSize x cellSize pixels.
+    If binSize > 1 then the fit is made to the image binned by binSize x binSize,
+    which reduces the cost of measuring the cell statistics by roughly binSize^2;
+    the binned background model is evaluated once and bilinearly interpolated
+    to full resolution. The model image is output as background.
+    
+    If exposureList is on the clipboard then the background is subtracted from every exposure in it
+    (using a pool of numThreads threads) and the models are output as backgroundList;
+    in that case exposure is not required.
+    """
+    packageName = "coadd_pipeline"
+    policyDictionaryName = "BackgroundSubtractionStageDictionary.paf"
+    metricsInputKeys = ("exposureList", "exposure")
+    
+    def setup(self):
+        baseStage.ParallelStage.setup(self)
+        
+        self.binSize = max(self.policy.get("binSize"), 1)
+        self.cellSize = self.policy.get("cellSize")
+        self.interpStyle = getattr(afwMath.Interpolate, self.policy.get("interpStyle"))
+        self.numSigmaClip = self.policy.get("numSigmaClip")
+        self.numIter = self.policy.get("numIter")
+        self.numThreads = self.policy.get("numThreads")
+    
+    def process(self, clipboard):
+        """Subtract the background from exposure (or each exposure in exposureList)"""
+        exposureList = self.getFromClipboard(clipboard, "exposureList", doRaise=False)
+        if exposureList != None:
+            self.log.log(Log.INFO, "Subtract background from %d exposures using %d threads" % \
+                (len(exposureList), max(self.numThreads, 1)))
+            backgroundList = parallelUtils.runInThreads(
+                lambda exposure: self.subtractBackground(exposure.getMaskedImage()),
+                exposureList, self.numThreads)
+            self.addToClipboard(clipboard, "backgroundList", backgroundList)
+            return
+
+        exposure = self.getFromClipboard(clipboard, "exposure")
+        background = self.subtractBackground(exposure.getMaskedImage())
+        self.addToClipboard(clipboard, "background", background)
+    
+    def subtractBackground(self, maskedImage):
+        """Subtract the background from a MaskedImage, in place
+        
+        Note: at present the mask and variance are ignored, but they might used be someday.
+        
+        @return the background model (an afwImage.ImageF the size of maskedImage)
+        """
+        image = maskedImage.getImage()
+        if self.binSize > 1:
+            binnedImage = afwMath.binImage(image, self.binSize)
+            binnedBackground = self.fitBackground(binnedImage, float(self.cellSize) / self.binSize)
+            background = upsampleImage(binnedBackground, self.binSize,
+                image.getWidth(), image.getHeight())
+        else:
+            background = self.fitBackground(image, self.cellSize)
+        background.setXY0(image.getX0(), image.getY0())
+        image -= background
+        return background
+    
+    def fitBackground(self, image, cellSize):
+        """Fit a background to an image and return the model evaluated at every pixel
+        
+        Inputs:
+        - image: image to fit (an afwImage.ImageF)
+        - cellSize: size of background cells (pixels of image)
+        
+        @return the background model (an afwImage.ImageF the size of image)
+        """
+        bkgControl = afwMath.BackgroundControl(self.interpStyle)
+        bkgControl.setNxSample(int(image.getWidth() // cellSize) + 1)
+        bkgControl.setNySample(int(image.getHeight() // cellSize) + 1)
+        bkgControl.getStatisticsControl().setNumSigmaClip(self.numSigmaClip)
+        bkgControl.getStatisticsControl().setNumIter(self.numIter)
+        return afwMath.makeBackground(image, bkgControl).getImageF()
+
+def upsampleImage(binnedImage, binSize, width, height):
+    """Bilinearly interpolate a binned image to full resolution
+    
+    Inputs:
+    - binnedImage: binned image (an afwImage.ImageF); pixel i is the mean of full-resolution pixels
+        [i*binSize, (i+1)*binSize)
+    - binSize: binning factor
+    - width, height: dimensions of the full-resolution image; the pixels beyond the last bin center
+        are extrapolated as constant
+    
+    @return the full-resolution image (an afwImage.ImageF)
+    """
+    binnedArray = binnedImage.getArray()
+    def getInterpolation(numBinned, num):
+        """Return index0, index1, weight1 to interpolate from numBinned bins to num pixels"""
+        binPos = numpy.clip((numpy.arange(num) + 0.5) / binSize - 0.5, 0, numBinned - 1)
+        index0 = numpy.floor(binPos).astype(int)
+        index1 = numpy.minimum(index0 + 1, numBinned - 1)
+        return index0, index1, (binPos - index0).astype(numpy.float32)
+    
+    numBinnedY, numBinnedX = binnedArray.shape
+    x0, x1, xWeight = getInterpolation(numBinnedX, width)
+    y0, y1, yWeight = getInterpolation(numBinnedY, height)
+    rowArray = binnedArray[:, x0] * (1 - xWeight) + binnedArray[:, x1] * xWeight
+    upsampledArray = rowArray[y0, :] * (1 - yWeight)[:, numpy.newaxis] \
+        + rowArray[y1, :] * yWeight[:, numpy.newaxis]
+
+    image = afwImage.ImageF(width, height)
+    image.getArray()[:, :] = upsampledArray
+    return image
+
+# this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
+class BackgroundSubtractionStage(baseStage.Stage):
+    parallelClass = BackgroundSubtractionStageParallel
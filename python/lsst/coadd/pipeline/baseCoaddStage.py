@@ -0,0 +1,252 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import os
+import tempfile
+
+from lsst.pex.logging import Log
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+import baseStage
+import coaddState
+import tileUtils
+import warpGeometry
+
+class CoaddStageParallel(baseStage.ParallelStage):
+    """
+    Base class for pipeline stages that add exposures to a coadd one event at a time.
+    
+    The coadd has the same dimensions, xy0 and WCS as the first exposure
+    or the next exposure after processing an event with isLastExposure = True.
+    
+    When an event is processed with isLastExposure = True the coadd and weight map are written
+    to the clipboard or, if outputPartialCoadd is true, the unnormalized state of the coadd
+    is written to the clipboard as partialCoadd (a coaddState.PartialCoadd) so that it can be
+    merged with other partial coadds by CoaddMergeStage.
+    
+    If checkpointPolicy.directory is specified then the running state of the coadd is periodically
+    saved to disk; if checkpointPolicy.resume is also true then the stage starts from the saved state
+    and skips exposures that have already been added.
+    
+    If seedPolicy specifies a previously written coadd (a partial coadd, or a coadd and weight map)
+    then the first coadd starts from it instead of from empty, so that updating a coadd
+    with new exposures only requires adding the new exposures. The seed has the dimensions, xy0 and WCS
+    of the coadd; exposures in a seed partial coadd are skipped if presented again.
+    A checkpoint found on resuming takes precedence (it already includes the seed).
+    
+    If patchPolicy.patchWidth and patchHeight are positive then, instead of one coadd, the stage
+    accumulates one coadd per patch: a region of the parent pixel grid of the exposures' common WCS
+    (see tileUtils.getPatchBBox), so one pass over the exposures can coadd a whole tract. Each exposure
+    is added to every patch it overlaps, or to the patches listed in the event's patchId field, if present.
+    At most patchPolicy.maxNumInMemory patches are kept in memory; the least recently used are spilled
+    to disk and read back as needed (see coaddState.CoaddPatchCache). When an event is processed
+    with isLastExposure = True the patches are written, one at a time, to patchPolicy.outputDirectory
+    (each is released before the next is loaded, so the patches are never all in memory at once)
+    and the clipboard gets patchIdList plus the paths of the files: coaddList and weightMapList,
+    or partialCoaddList if outputPartialCoadd is true.
+    Checkpointing and seeding are not supported with patches.
+    
+    accumulatorPolicy selects the storage layout of the accumulators: the standard accumulators
+    or compactCoadd.CompactCoadd, which uses less memory per pixel (see compactCoadd for the layouts
+    and their accuracy).
+    
+    Subclasses must set these class variables (in addition to those required by ParallelStage):
+    - coaddType: type of coadd; see coaddState.makeCoadd
+    - exposureKey: name of the exposure in inputKeys
+    - weightKey: name of the weight of the added exposure in outputKeys, or None if not output
+    """
+    weightKey = None
+
+    def setup(self):
+        baseStage.ParallelStage.setup(self)
+        
+        self.coadd = None
+        self.allowedMaskPlanes = self.policy.getPolicy("coaddPolicy").get("allowedMaskPlanes")
+        self.layout = coaddState.makeLayout(self.policy.getPolicy("accumulatorPolicy"))
+        checkpointPolicy = self.policy.getPolicy("checkpointPolicy")
+        self.checkpointer = coaddState.CoaddCheckpointer(self.coaddType, checkpointPolicy, self.log)
+        
+        patchPolicy = self.policy.getPolicy("patchPolicy")
+        self.patchWidth = patchPolicy.get("patchWidth")
+        self.patchHeight = patchPolicy.get("patchHeight")
+        self.patchCache = None
+        if self.patchWidth > 0 or self.patchHeight > 0:
+            if self.patchWidth <= 0 or self.patchHeight <= 0:
+                raise RuntimeError("patchPolicy.patchWidth=%s and patchHeight=%s must both be positive" % \
+                    (self.patchWidth, self.patchHeight))
+            seedPolicy = self.policy.getPolicy("seedPolicy")
+            if self.checkpointer.isEnabled() or seedPolicy.get("partialCoaddPath") \
+                or seedPolicy.get("coaddPath"):
+                raise RuntimeError("checkpointPolicy and seedPolicy are not supported with patches")
+            self.patchCache = coaddState.CoaddPatchCache(self.coaddType, self.allowedMaskPlanes,
+                patchPolicy.get("maxNumInMemory"), patchPolicy.get("spillDirectory"), self.log, self.layout)
+            self.patchOutputDirectory = patchPolicy.get("outputDirectory")
+            return
+
+        if self.checkpointer.isEnabled() and checkpointPolicy.get("resume"):
+            self.coadd = self.checkpointer.read(self.allowedMaskPlanes, self.layout)
+        if not self.coadd:
+            seed = coaddState.readSeed(self.coaddType, self.policy.getPolicy("seedPolicy"), self.log)
+            if seed != None:
+                self.coadd = seed.makeCoadd(self.allowedMaskPlanes, self.layout)
+                self.checkpointer.addSeedExposureIds(seed.exposureIdList)
+    
+    def process(self, clipboard):
+        """Add exposure to coadd"""
+        exposure = self.getFromClipboard(clipboard, self.exposureKey)
+        event = self.getFromClipboard(clipboard, "event")
+        if self.patchCache != None:
+            self.addToPatches(clipboard, exposure, event)
+            return
+
+        exposureId = self.checkpointer.getExposureId(event)
+        if self.checkpointer.hasExposure(exposureId):
+            self.log.log(Log.INFO, "Exposure %s is already in the coadd; skipping it" % (exposureId,))
+            weight = 0.0
+        else:
+            weight = self.addExposure(clipboard, exposure)
+            self.log.log(Log.INFO, "Added exposure to coadd; weight=%s" % (weight,))
+            self.checkpointer.exposureAdded(self.coadd, exposureId)
+        if self.weightKey:
+            self.addToClipboard(clipboard, self.weightKey, weight)
+
+        if event.get("isLastExposure"):
+            self.outputCoadd(clipboard)
+            self.coadd = None
+            self.checkpointer.clear()
+    
+    def addExposure(self, clipboard, exposure):
+        """Add exposure to the coadd, first creating the coadd if necessary
+        
+        @return weight of exposure
+        """
+        if not self.coadd:
+            self.log.log(Log.INFO, "First exposure: create coadd")
+            self.coadd = self.makeCoadd(exposure)
+        return self.coadd.addExposure(exposure)
+    
+    def addToPatches(self, clipboard, exposure, event):
+        """Add exposure to each patch it overlaps, or to each patch in the event's patchId field
+        """
+        exposureId = self.checkpointer.getExposureId(event)
+        exposureBBox = coaddUtils.bboxFromImage(exposure)
+        if event.exists("patchId"):
+            patchIdList = [str(patchId) for patchId in event.getArray("patchId")]
+        else:
+            patchIdList = tileUtils.getOverlappingPatchIdList(exposureBBox, self.patchWidth, self.patchHeight)
+
+        weight = 0.0
+        numAdded = 0
+        for patchId in patchIdList:
+            patchBBox = tileUtils.getPatchBBox(patchId, self.patchWidth, self.patchHeight)
+            overlapBBox = tileUtils.getOverlapBBox(exposureBBox, patchBBox)
+            if overlapBBox == None:
+                self.log.log(Log.WARN, "Exposure does not overlap patch %s; skipping it" % (patchId,))
+                continue
+            if warpGeometry.isSameBBox(exposureBBox, patchBBox):
+                patchExposure = exposure
+            else:
+                subExposure = afwImage.ExposureF(exposure,
+                    warpGeometry.getRelativeBBox(overlapBBox, exposureBBox))
+                patchExposure = warpGeometry.embedExposure(subExposure, patchBBox, exposure.getWcs())
+            coadd = self.patchCache.get(patchId, lambda: self.makeCoadd(patchExposure))
+            weight = max(weight, coadd.addExposure(patchExposure))
+            self.patchCache.exposureAdded(patchId, exposureId)
+            numAdded += 1
+        self.log.log(Log.INFO, "Added exposure to %d of %d patches; weight=%s" % \
+            (numAdded, len(patchIdList), weight))
+        if self.weightKey:
+            self.addToClipboard(clipboard, self.weightKey, weight)
+
+        if event.get("isLastExposure"):
+            self.outputPatchCoadds(clipboard)
+            self.patchCache.clear()
+            self.checkpointer.reset()
+
+    def makeCoadd(self, exposure):
+        """Return a new, empty coadd with the same dimensions, xy0 and WCS as exposure"""
+        return coaddState.makeCoadd(self.coaddType, exposure, self.allowedMaskPlanes, self.layout)
+    
+    def outputCoadd(self, clipboard):
+        """Write the coadd and weight map, or the partial coadd, to the clipboard"""
+        if self.policy.get("outputPartialCoadd"):
+            self.log.log(Log.INFO, "Last exposure: write partial coadd to clipboard and reset to initial state")
+            partialCoadd = coaddState.PartialCoadd.fromCoadd(self.coaddType, self.coadd,
+                self.checkpointer.exposureIdList, deep=False)
+            self.addToClipboard(clipboard, "partialCoadd", partialCoadd)
+        else:
+            self.log.log(Log.INFO, "Last exposure: write coadd to clipboard and reset to initial state")
+            coaddExposure = self.coadd.getCoadd()
+            weightMap = self.coadd.getWeightMap()
+            self.addToClipboard(clipboard, "coadd", coaddExposure)
+            self.addToClipboard(clipboard, "weightMap", weightMap)
+    
+    def outputPatchCoadds(self, clipboard):
+        """Write the coadd and weight map, or the partial coadd, of each patch to disk, one patch at a time,
+        and write the patch IDs and the paths of the files to the clipboard
+        
+        Each patch is removed from the patch cache once it is written, so writing the patches
+        never holds more than one patch beyond those the cache already keeps in memory.
+        """
+        outputDirectory = self.patchOutputDirectory
+        if not outputDirectory:
+            outputDirectory = tempfile.mkdtemp(prefix="patchCoadds")
+        elif not os.path.exists(outputDirectory):
+            os.makedirs(outputDirectory)
+        patchIdList = self.patchCache.getPatchIdList()
+        self.addToClipboard(clipboard, "patchIdList", patchIdList)
+        outputPartialCoadd = self.policy.get("outputPartialCoadd")
+        if outputPartialCoadd:
+            self.log.log(Log.INFO, "Last exposure: write %d partial patch coadds to %s "
+                "and reset to initial state" % (len(patchIdList), outputDirectory))
+        else:
+            self.log.log(Log.INFO, "Last exposure: write %d patch coadds to %s "
+                "and reset to initial state" % (len(patchIdList), outputDirectory))
+        
+        partialCoaddPathList = []
+        coaddPathList = []
+        weightMapPathList = []
+        for patchId in patchIdList:
+            patchName = patchId.replace(",", "_")
+            partialCoadd = self.patchCache.getPartialCoadd(patchId)
+            if outputPartialCoadd:
+                partialCoaddPath = os.path.join(outputDirectory, "partialCoadd_%s" % (patchName,))
+                partialCoadd.writeFits(partialCoaddPath)
+                partialCoaddPathList.append(partialCoaddPath)
+            else:
+                coadd = partialCoadd.makeCoadd(self.allowedMaskPlanes, self.layout)
+                coaddPath = os.path.join(outputDirectory, "coadd_%s" % (patchName,))
+                weightMapPath = os.path.join(outputDirectory, "weightMap_%s.fits" % (patchName,))
+                coadd.getCoadd().writeFits(coaddPath)
+                coadd.getWeightMap().writeFits(weightMapPath)
+                coaddPathList.append(coaddPath)
+                weightMapPathList.append(weightMapPath)
+                del coadd
+            del partialCoadd
+            self.patchCache.remove(patchId)
+        
+        if outputPartialCoadd:
+            self.addToClipboard(clipboard, "partialCoaddList", partialCoaddPathList)
+        else:
+            self.addToClipboard(clipboard, "coaddList", coaddPathList)
+            self.addToClipboard(clipboard, "weightMapList", weightMapPathList)
@@ -21,8 +21,9 @@
 #
 
 import lsst.pex.logging as pexLog
-import lsst.pex.policy as pexPolicy
 import lsst.pex.harness.stage as harnessStage
+import policyCache
+import stageMetrics
 
 class ParallelStage(harnessStage.ParallelProcessing):
     """
@@ -36,15 +37,53 @@ class ParallelStage(harnessStage.ParallelProcessing):
 
     The policy dictionary must be contained here:
     <packageName>/policy/policyDictionaryName
+    It is parsed once per process; see policyCache.
+    
+    If the policy dictionary includes instrumentationPolicy (see policy/InstrumentationDictionary.paf)
+    then every call to the subclass's process method is measured (wall time, CPU time, peak memory
+    and number of input pixels); see stageMetrics.StageMetrics. The measurer is available as self.metrics
+    (None if measurement is disabled). Subclasses should set metricsInputKeys to the names (in inputKeys)
+    of their primary data inputs, in order of precedence; the pixels of the first one on the clipboard
+    are counted. Other inputs (e.g. a reference exposure) are not counted.
     """
+    metricsInputKeys = ()
+    
     def setup(self):
         self.log = pexLog.Log(self.log, self.__class__.__name__)
 
-        policyFile = pexPolicy.DefaultPolicyFile(self.packageName, self.policyDictionaryName, "policy")
-        defPolicy = pexPolicy.Policy.createPolicy(policyFile, policyFile.getRepositoryPath(), True)
-        if self.policy is None:
-            self.policy = pexPolicy.Policy()
-        self.policy.mergeDefaults(defPolicy.getDictionary())
+        self.policy = policyCache.mergeDefaults(self.policy, self.packageName, self.policyDictionaryName)
+        self._inputKeyDict = self._makeClipboardKeyDict("inputKeys")
+        self._outputKeyDict = self._makeClipboardKeyDict("outputKeys")
+        
+        self.metrics = None
+        if self.policy.exists("instrumentationPolicy"):
+            instrumentationPolicy = self.policy.getPolicy("instrumentationPolicy")
+            if instrumentationPolicy.get("enabled"):
+                self._instrumentProcess(instrumentationPolicy)
+    
+    def _makeClipboardKeyDict(self, keysName):
+        """Return a dict of item name: clipboard key for the items in policy keysName
+        
+        Computed once in setup so that getFromClipboard and addToClipboard
+        need not search the policy for every event.
+        """
+        if not self.policy.exists(keysName):
+            return {}
+        keysPolicy = self.policy.getPolicy(keysName)
+        keyDict = {}
+        for name in keysPolicy.names(True):
+            keyDict[name] = keysPolicy.getString(name)
+        return keyDict
+
+    def _instrumentProcess(self, instrumentationPolicy):
+        """Replace self.process with a version that measures each call"""
+        self.metrics = stageMetrics.StageMetrics(self.__class__.__name__, instrumentationPolicy)
+        inputKeyList = [self._inputKeyDict[name] for name in self.metricsInputKeys]
+        uninstrumentedProcess = self.process
+        def process(clipboard):
+            return self.metrics.measure(uninstrumentedProcess, clipboard, inputKeyList)
+        process.__doc__ = uninstrumentedProcess.__doc__
+        self.process = process
     
     def getFromClipboard(self, clipboard, key, doRaise=True):
         """Retrieve an item from the clipboard.
@@ -61,11 +100,12 @@ class ParallelStage(harnessStage.ParallelProcessing):
         @raise lsst.pex.exceptions.LsstCppException wrapping lsst::pex::policy::NameNotFound
             if full key is not found in policy; this indicates a bug: a mismatch with the stage dictionary.
         """
-        policyKey = "inputKeys.%s" % (key,)
-        clipboardKey = self.policy.getString(policyKey)
+        clipboardKey = self._inputKeyDict.get(key)
+        if clipboardKey == None:
+            clipboardKey = self.policy.getString("inputKeys.%s" % (key,))
         clipboardItem = clipboard.get(clipboardKey)
         if clipboardItem == None and doRaise:
-            raise KeyError("Could not find %s=%s on clipboard" % (policyKey, clipboardKey))
+            raise KeyError("Could not find inputKeys.%s=%s on clipboard" % (key, clipboardKey))
         return clipboardItem
     
     def addToClipboard(self, clipboard, key, item):
@@ -79,10 +119,11 @@ class ParallelStage(harnessStage.ParallelProcessing):
 
         @raise KeyError or ? if full key is not found in self.policy.
         """
-        policyKey = "outputKeys.%s" % (key,)
-        clipboardKey = self.policy.getString(policyKey)
+        clipboardKey = self._outputKeyDict.get(key)
+        if clipboardKey == None:
+            clipboardKey = self.policy.getString("outputKeys.%s" % (key,))
         if clipboardKey == None:
-            raise KeyError("Could not find %s in policy" % (policyKey,))
+            raise KeyError("Could not find outputKeys.%s in policy" % (key,))
         clipboard.put(clipboardKey, item)
 
 Stage = harnessStage.Stage # convenience
@@ -20,12 +20,11 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-from lsst.pex.logging import Log
-import lsst.coadd.chisquared as coaddChiSq
-import lsst.coadd.utils as coaddUtils
+import baseCoaddStage
 import baseStage
+import coaddState
 
-class ChiSquaredStageParallel(baseStage.ParallelStage):
+class ChiSquaredStageParallel(baseCoaddStage.CoaddStageParallel):
     """
     Pipeline stage to create a chi-squared coadd
 
@@ -33,46 +32,14 @@ class ChiSquaredStageParallel(baseStage.ParallelStage):
     or the next exposure after processing an event with isLastExposure = True.
     
     The coadd is written to the clipboard when an event is processed with isLastExposure = True.
+    
+    See baseCoaddStage.CoaddStageParallel for details.
     """
     packageName = "coadd_pipeline"
     policyDictionaryName = "ChiSquaredStageDictionary.paf"
-    def setup(self):
-        baseStage.ParallelStage.setup(self)
-        
-        self.coadd = None
-
-    def process(self, clipboard):
-        """Add exposure to chiSquared coadd"""
-#         print "***** process ******"
-#         print "clipboard keys:"
-#         for key in clipboard.getKeys():
-#             print "*", key
-#         print "self.coadd=", self.coadd, "at start of process"
-
-        exposure = self.getFromClipboard(clipboard, "exposure")
-        
-        if not self.coadd:
-            self.log.log(Log.INFO, "First exposure: create coadd")
-            self.coadd = coaddChiSq.Coadd(
-                bbox = coaddUtils.bboxFromImage(exposure),
-                wcs = exposure.getWcs(),
-                allowedMaskPlanes = self.policy.getPolicy("coaddPolicy").get("allowedMaskPlanes"))
-
-        self.log.log(Log.INFO, "Add exposure to coadd")
-        self.coadd.addExposure(exposure)
-
-        event = self.getFromClipboard(clipboard, "event")
-#         print "event names"
-#         for name in event.names():
-#             print "*", name
-
-        if event.get("isLastExposure"):
-            self.log.log(Log.INFO, "Last exposure: write coadd to clipboard and reset to initial state")
-            coaddExposure = self.coadd.getCoadd()
-            weightMap = self.coadd.getWeightMap()
-            self.addToClipboard(clipboard, "coadd", coaddExposure)
-            self.addToClipboard(clipboard, "weightMap", weightMap)
-            self.coadd = None
+    metricsInputKeys = ("exposure",)
+    coaddType = coaddState.ChiSquaredCoaddType
+    exposureKey = "exposure"
         
 # this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
 class ChiSquaredStage(baseStage.Stage):
@@ -20,50 +20,24 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-from lsst.pex.logging import Log
-import lsst.coadd.utils as coaddUtils
+import baseCoaddStage
 import baseStage
+import coaddState
 
-class CoaddGenerationStageParallel(baseStage.ParallelStage):
+class CoaddGenerationStageParallel(baseCoaddStage.CoaddStageParallel):
     """
     Pipeline stage to add warped and psf-matched exposures to a coadd.
     
+    See baseCoaddStage.CoaddStageParallel for details.
+    
     @todo: modify to use HEALPix.
     """
     packageName = "coadd_pipeline"
     policyDictionaryName = "CoaddGenerationStageDictionary.paf"
-    def setup(self):
-        baseStage.ParallelStage.setup(self)
-        
-        self.coadd = None
-    
-    def process(self, clipboard):
-        """Add exposure to coadd"""
-#         print "***** process ******"
-#         print "clipboard keys:"
-#         for key in clipboard.getKeys():
-#             print "*", key
-
-        psfMatchedExposure = self.getFromClipboard(clipboard, "psfMatchedExposure")
-        if not self.coadd:
-            self.log.log(Log.INFO, "First exposure: create coadd")
-            coaddDimensions = psfMatchedExposure.getMaskedImage().getDimensions()
-            coaddWcs = psfMatchedExposure.getWcs()
-            allowedMaskPlanes = self.policy.getPolicy("coaddPolicy").get("allowedMaskPlanes")
-            self.coadd = coaddUtils.Coadd(coaddDimensions, coaddWcs, allowedMaskPlanes)
-
-        weight = self.coadd.addExposure(psfMatchedExposure)
-        self.addToClipboard(clipboard, "coaddedWeight", weight)
-        self.log.log(Log.INFO, "Added exposure to coadd; weight=%0.2f" % (weight,))
-
-        event = self.getFromClipboard(clipboard, "event")
-        if event.get("isLastExposure"):
-            self.log.log(Log.INFO, "Last exposure: write coadd to clipboard and reset to initial state")
-            coaddExposure = self.coadd.getCoadd()
-            weightMap = self.coadd.getWeightMap()
-            self.addToClipboard(clipboard, "coadd", coaddExposure)
-            self.addToClipboard(clipboard, "weightMap", weightMap)
-            self.coadd = None
+    metricsInputKeys = ("psfMatchedExposure",)
+    coaddType = coaddState.WeightedMeanCoaddType
+    exposureKey = "psfMatchedExposure"
+    weightKey = "coaddedWeight"
 
 # this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
 class CoaddGenerationStage(baseStage.Stage):
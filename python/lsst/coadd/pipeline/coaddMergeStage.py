@@ -0,0 +1,82 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from lsst.pex.logging import Log
+import baseStage
+import coaddState
+import parallelUtils
+
+class CoaddMergeStageParallel(baseStage.ParallelStage):
+    """
+    Pipeline stage to merge partial coadds (as output by CoaddGenerationStage or ChiSquaredStage
+    with outputPartialCoadd true) into one coadd.
+    
+    The partial coadds are merged pairwise in a tree reduction; the pairs at each level of the tree
+    are merged concurrently by a pool of numThreads threads. The partial coadds must all be of the same type
+    and have the same bounding box and WCS. Partial coadds supplied as objects are modified in place.
+    
+    If outputPartialCoadd is true then the merged partial coadd is output (so it can be merged
+    again by another CoaddMergeStage), else the final coadd and weight map are output.
+    """
+    packageName = "coadd_pipeline"
+    policyDictionaryName = "CoaddMergeStageDictionary.paf"
+    metricsInputKeys = ("partialCoaddList",)
+
+    def process(self, clipboard):
+        """Merge partial coadds"""
+        partialCoaddList = self.getFromClipboard(clipboard, "partialCoaddList")
+        if len(partialCoaddList) == 0:
+            raise RuntimeError("partialCoaddList is empty")
+        numThreads = self.policy.get("numThreads")
+        
+        partialCoaddList = parallelUtils.runInThreads(_getPartialCoadd, partialCoaddList, numThreads)
+        self.log.log(Log.INFO, "Merge %d partial coadds" % (len(partialCoaddList),))
+        while len(partialCoaddList) > 1:
+            pairList = [partialCoaddList[i:i+2] for i in range(0, len(partialCoaddList), 2)]
+            partialCoaddList = parallelUtils.runInThreads(_mergePair, pairList, numThreads)
+        partialCoadd = partialCoaddList[0]
+        
+        if self.policy.get("outputPartialCoadd"):
+            self.addToClipboard(clipboard, "partialCoadd", partialCoadd)
+        else:
+            allowedMaskPlanes = self.policy.getPolicy("coaddPolicy").get("allowedMaskPlanes")
+            coadd = partialCoadd.makeCoadd(allowedMaskPlanes)
+            self.addToClipboard(clipboard, "coadd", coadd.getCoadd())
+            self.addToClipboard(clipboard, "weightMap", coadd.getWeightMap())
+
+def _getPartialCoadd(partialCoadd):
+    """Return partialCoadd, reading it from disk first if it is a path"""
+    if isinstance(partialCoadd, basestring):
+        return coaddState.PartialCoadd.readFits(partialCoadd)
+    return partialCoadd
+
+def _mergePair(pair):
+    """Merge a list of one or two partial coadds into the first and return it"""
+    partialCoadd = pair[0]
+    for other in pair[1:]:
+        partialCoadd.merge(other)
+    return partialCoadd
+
+# this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
+class CoaddMergeStage(baseStage.Stage):
+    parallelClass = CoaddMergeStageParallel
@@ -0,0 +1,581 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Access to, and persistence of, the running state of coadd accumulators
+
+The accumulators (coaddUtils.Coadd and coaddChiSq.Coadd) keep an unnormalized sum
+and a weight map; getCoadd() normalizes a copy of the sum. All access to the accumulator's internals
+goes through getSumMaskedImage and getWcs so that the dependence on them is kept in one place.
+"""
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import time
+
+from lsst.pex.logging import Log
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+
+# supported values of coaddType
+WeightedMeanCoaddType = "weightedMean" # coaddUtils.Coadd, as made by CoaddGenerationStage
+ChiSquaredCoaddType = "chiSquared" # coaddChiSq.Coadd, as made by ChiSquaredStage
+
+def makeLayout(accumulatorPolicy):
+    """Return the storage layout of coadd accumulators specified by accumulatorPolicy
+    
+    Inputs:
+    - accumulatorPolicy: a policy as described by policy/AccumulatorDictionary.paf
+    
+    @return a compactCoadd.CompactLayout, or None for the standard accumulators
+    @raise RuntimeError if accumulatorPolicy.layout is not recognized
+    """
+    layoutName = accumulatorPolicy.get("layout")
+    if layoutName == "standard":
+        return None
+    elif layoutName == "compact":
+        # imported here so that the standard layout does not pay to import numpy
+        import compactCoadd
+        return compactCoadd.CompactLayout(
+            compensated = accumulatorPolicy.get("compensated"),
+            countWeights = accumulatorPolicy.get("countWeights"),
+            packMask = accumulatorPolicy.get("packMask"),
+        )
+    raise RuntimeError("Unknown accumulatorPolicy.layout=%r; must be standard or compact" % (layoutName,))
+
+def makeCoadd(coaddType, exposure, allowedMaskPlanes, layout=None):
+    """Return a new, empty coadd accumulator with the same dimensions, xy0 and WCS as exposure
+    
+    Inputs:
+    - coaddType: type of coadd: one of WeightedMeanCoaddType or ChiSquaredCoaddType
+    - exposure: exposure whose geometry the coadd will have
+    - allowedMaskPlanes: mask planes to allow (ignore) when coadding; a space-separated list of names
+    - layout: storage layout: a compactCoadd.CompactLayout for a compactCoadd.CompactCoadd,
+        or None for the standard accumulator (coaddUtils.Coadd or coaddChiSq.Coadd); see makeLayout
+    """
+    if coaddType not in (WeightedMeanCoaddType, ChiSquaredCoaddType):
+        raise RuntimeError("Unknown coaddType=%r" % (coaddType,))
+    if layout != None:
+        import compactCoadd
+        return compactCoadd.CompactCoadd(coaddUtils.bboxFromImage(exposure), exposure.getWcs(),
+            allowedMaskPlanes, layout, isChiSquared = (coaddType == ChiSquaredCoaddType))
+    if coaddType == WeightedMeanCoaddType:
+        return coaddUtils.Coadd(exposure.getMaskedImage().getDimensions(), exposure.getWcs(),
+            allowedMaskPlanes)
+    elif coaddType == ChiSquaredCoaddType:
+        # imported here so that weighted mean coadds do not pay to import lsst.coadd.chisquared
+        import lsst.coadd.chisquared as coaddChiSq
+        return coaddChiSq.Coadd(
+            bbox = coaddUtils.bboxFromImage(exposure),
+            wcs = exposure.getWcs(),
+            allowedMaskPlanes = allowedMaskPlanes)
+
+def getSumMaskedImage(coadd):
+    """Return the unnormalized sum of a coadd accumulator
+    
+    This is a view, not a copy, except for a compactCoadd.CompactCoadd.
+    """
+    if hasattr(coadd, "getSumMaskedImage"):
+        return coadd.getSumMaskedImage()
+    sumImage = coadd._coadd
+    if hasattr(sumImage, "getMaskedImage"):
+        sumImage = sumImage.getMaskedImage()
+    return sumImage
+
+def getWcs(coadd):
+    """Return the WCS of a coadd accumulator
+    """
+    if hasattr(coadd, "getWcs"):
+        return coadd.getWcs()
+    return coadd._wcs
+
+def setState(coadd, sumMaskedImage, weightMap):
+    """Set the running state of a coadd accumulator
+    
+    Inputs:
+    - coadd: the coadd accumulator; it must have the same dimensions as sumMaskedImage and weightMap
+    - sumMaskedImage: unnormalized sum (afwImage.MaskedImageF)
+    - weightMap: weight map (afwImage.ImageF)
+    """
+    if hasattr(coadd, "setState"):
+        coadd.setState(sumMaskedImage, weightMap)
+        return
+    coaddSum = getSumMaskedImage(coadd)
+    coaddSum <<= sumMaskedImage
+    coaddWeightMap = coadd.getWeightMap()
+    coaddWeightMap <<= weightMap
+
+def addTile(coadd, maskedImage, bbox, weight, badPixelMask):
+    """Add a masked image to a region of a coadd accumulator with a specified weight
+    
+    Only supported for weighted mean coadds (and chi-squared compactCoadd.CompactCoadd accumulators).
+    
+    Inputs:
+    - coadd: the coadd accumulator
+    - maskedImage: masked image to add (afwImage.MaskedImageF)
+    - bbox: region of the coadd, relative to its origin (not xy0), with the dimensions of maskedImage
+    - weight: weight of maskedImage
+    - badPixelMask: pixels of maskedImage with any of these mask bits set are ignored
+        (a compactCoadd.CompactCoadd uses its own allowed mask planes instead)
+    """
+    if hasattr(coadd, "addTile"):
+        coadd.addTile(maskedImage, bbox, weight)
+        return
+    subSumMaskedImage = afwImage.MaskedImageF(getSumMaskedImage(coadd), bbox)
+    subWeightMap = afwImage.ImageF(coadd.getWeightMap(), bbox)
+    coaddUtils.addToCoadd(subSumMaskedImage, subWeightMap, maskedImage, badPixelMask, weight)
+
+class PartialCoadd(object):
+    """The unnormalized state of a coadd accumulator, which can be merged with other partial coadds
+    of the same type and geometry and then turned into a coadd.
+    
+    Attributes:
+    - coaddType: type of coadd (see makeCoadd)
+    - sumExposure: unnormalized sum (afwImage.ExposureF), with the WCS of the coadd
+    - weightMap: weight map (afwImage.ImageF)
+    - exposureIdList: IDs of the exposures that have been added (a list of strings)
+    
+    On disk a partial coadd is a directory containing:
+    - sum: the unnormalized sum (an Exposure)
+    - weightMap.fits: the weight map
+    - coaddType.txt: the coadd type
+    - exposureIds.txt: the IDs of the exposures that have been added, one per line
+    """
+    def __init__(self, coaddType, sumExposure, weightMap, exposureIdList=()):
+        self.coaddType = coaddType
+        self.sumExposure = sumExposure
+        self.weightMap = weightMap
+        self.exposureIdList = [str(exposureId) for exposureId in exposureIdList]
+    
+    @staticmethod
+    def fromCoadd(coaddType, coadd, exposureIdList=(), deep=True):
+        """Construct a PartialCoadd from a coadd accumulator
+        
+        Inputs:
+        - coaddType: type of coadd (see makeCoadd)
+        - coadd: the coadd accumulator
+        - exposureIdList: IDs of the exposures that have been added to the coadd
+        - deep: if True then copy the pixels, else share them with coadd
+        """
+        sumMaskedImage = getSumMaskedImage(coadd)
+        weightMap = coadd.getWeightMap()
+        if deep:
+            sumMaskedImage = afwImage.MaskedImageF(sumMaskedImage, True)
+            weightMap = afwImage.ImageF(weightMap, True)
+        sumExposure = afwImage.makeExposure(sumMaskedImage, getWcs(coadd))
+        return PartialCoadd(coaddType, sumExposure, weightMap, exposureIdList)
+    
+    @staticmethod
+    def fromNormalizedCoadd(coaddType, coaddExposure, weightMap, exposureIdList=()):
+        """Construct a PartialCoadd from a coadd and weight map, as output by getCoadd() and getWeightMap()
+        
+        Normalization divides the sum by the weight map (and the variance by its square),
+        so the sum is recovered by multiplying by the weight map. The image and variance of pixels
+        with no data (weight 0) are set to 0, since the coadd may hold NaN there (and NaN * 0 is NaN),
+        and the EDGE (no data) bits set by normalization are cleared, so pixels that later receive data
+        are neither corrupted nor flagged.
+        
+        Inputs:
+        - coaddType: type of coadd; only WeightedMeanCoaddType is supported
+        - coaddExposure: the coadd (afwImage.ExposureF); it is not modified
+        - weightMap: weight map (afwImage.ImageF)
+        - exposureIdList: IDs of the exposures in the coadd
+        
+        @raise RuntimeError if coaddType is not WeightedMeanCoaddType
+        """
+        if coaddType != WeightedMeanCoaddType:
+            raise RuntimeError("Cannot recover the unnormalized sum of a coadd of type %s; "
+                "use a partial coadd" % (coaddType,))
+        sumMaskedImage = afwImage.MaskedImageF(coaddExposure.getMaskedImage(), True)
+        sumMaskedImage *= weightMap
+        hasNoData = weightMap.getArray() == 0
+        sumMaskedImage.getImage().getArray()[hasNoData] = 0
+        sumMaskedImage.getVariance().getArray()[hasNoData] = 0
+        sumMask = sumMaskedImage.getMask()
+        sumMask.clearMaskPlane(sumMask.getMaskPlane("EDGE"))
+        sumExposure = afwImage.makeExposure(sumMaskedImage, coaddExposure.getWcs())
+        return PartialCoadd(coaddType, sumExposure, weightMap, exposureIdList)
+    
+    def merge(self, other):
+        """Add another partial coadd to this one (in place)
+        
+        The sums and weight maps are added and the masks are ORed together.
+        
+        @raise RuntimeError if other has a different type, dimensions or WCS
+        """
+        if other.coaddType != self.coaddType:
+            raise RuntimeError("Cannot merge partial coadds of type %s and %s" % \
+                (self.coaddType, other.coaddType))
+        sumMaskedImage = self.sumExposure.getMaskedImage()
+        otherSumMaskedImage = other.sumExposure.getMaskedImage()
+        if (sumMaskedImage.getWidth(), sumMaskedImage.getHeight(), sumMaskedImage.getX0(), \
+            sumMaskedImage.getY0()) != (otherSumMaskedImage.getWidth(), otherSumMaskedImage.getHeight(),
+            otherSumMaskedImage.getX0(), otherSumMaskedImage.getY0()):
+            raise RuntimeError("Cannot merge partial coadds with different bounding boxes")
+        if self.sumExposure.getWcs().getFitsMetadata().toString() != \
+            other.sumExposure.getWcs().getFitsMetadata().toString():
+            raise RuntimeError("Cannot merge partial coadds with different WCS")
+        sumMaskedImage += otherSumMaskedImage
+        self.weightMap += other.weightMap
+        self.exposureIdList += other.exposureIdList
+    
+    def makeCoadd(self, allowedMaskPlanes, layout=None):
+        """Return a coadd accumulator whose state is this partial coadd
+        
+        Call getCoadd() and getWeightMap() on the result to get the final coadd.
+        
+        Inputs:
+        - allowedMaskPlanes: mask planes to allow (ignore) when coadding; a space-separated list of names
+        - layout: storage layout of the accumulator; see makeCoadd
+        """
+        coadd = makeCoadd(self.coaddType, self.sumExposure, allowedMaskPlanes, layout)
+        setState(coadd, self.sumExposure.getMaskedImage(), self.weightMap)
+        return coadd
+    
+    def writeFits(self, dirPath):
+        """Write this partial coadd to a new directory"""
+        os.makedirs(dirPath)
+        self.sumExposure.writeFits(os.path.join(dirPath, "sum"))
+        self.weightMap.writeFits(os.path.join(dirPath, "weightMap.fits"))
+        with file(os.path.join(dirPath, "coaddType.txt"), "w") as typeFile:
+            typeFile.write("%s\n" % (self.coaddType,))
+        # write the ID list last; readers treat a directory without it as incomplete
+        with file(os.path.join(dirPath, "exposureIds.txt"), "w") as idFile:
+            for exposureId in self.exposureIdList:
+                idFile.write("%s\n" % (exposureId,))
+    
+    @staticmethod
+    def isComplete(dirPath):
+        """Return True if dirPath contains a completely written partial coadd"""
+        return os.path.exists(os.path.join(dirPath, "exposureIds.txt"))
+    
+    @staticmethod
+    def readFits(dirPath):
+        """Read a partial coadd written by writeFits"""
+        sumExposure = afwImage.ExposureF(os.path.join(dirPath, "sum"))
+        weightMap = afwImage.ImageF(os.path.join(dirPath, "weightMap.fits"))
+        with file(os.path.join(dirPath, "coaddType.txt"), "r") as typeFile:
+            coaddType = typeFile.read().strip()
+        with file(os.path.join(dirPath, "exposureIds.txt"), "r") as idFile:
+            exposureIdList = [line.strip() for line in idFile if line.strip()]
+        return PartialCoadd(coaddType, sumExposure, weightMap, exposureIdList)
+
+def readSeed(coaddType, seedPolicy, log):
+    """Read the coadd from which to start a new coadd, as specified by seedPolicy
+    
+    Inputs:
+    - coaddType: type of coadd (see makeCoadd)
+    - seedPolicy: a policy as described by policy/SeedDictionary.paf
+    - log: log
+    
+    @return the seed as a PartialCoadd, or None if seedPolicy specifies no seed
+    @raise RuntimeError if the seed is incomplete or of the wrong type, or seedPolicy is inconsistent
+    """
+    partialCoaddPath = seedPolicy.get("partialCoaddPath")
+    coaddPath = seedPolicy.get("coaddPath")
+    if partialCoaddPath and coaddPath:
+        raise RuntimeError("Specify at most one of seedPolicy.partialCoaddPath and seedPolicy.coaddPath")
+    if partialCoaddPath:
+        if not PartialCoadd.isComplete(partialCoaddPath):
+            raise RuntimeError("No complete partial coadd found in %s" % (partialCoaddPath,))
+        seed = PartialCoadd.readFits(partialCoaddPath)
+        if seed.coaddType != coaddType:
+            raise RuntimeError("Partial coadd in %s has coaddType=%s; expected %s" % \
+                (partialCoaddPath, seed.coaddType, coaddType))
+        log.log(Log.INFO, "Read seed partial coadd of %d exposures from %s" % \
+            (len(seed.exposureIdList), partialCoaddPath))
+    elif coaddPath:
+        weightMapPath = seedPolicy.get("weightMapPath")
+        if not weightMapPath:
+            raise RuntimeError("seedPolicy.coaddPath requires seedPolicy.weightMapPath")
+        seed = PartialCoadd.fromNormalizedCoadd(coaddType, afwImage.ExposureF(coaddPath),
+            afwImage.ImageF(weightMapPath))
+        log.log(Log.INFO, "Read seed coadd from %s and weight map from %s" % (coaddPath, weightMapPath))
+    else:
+        return None
+    return seed
+
+class CoaddCheckpointer(object):
+    """Periodically save the running state of a coadd accumulator to disk so it can be resumed
+    
+    A checkpoint is a PartialCoadd. Each checkpoint is written to a new subdirectory
+    of the checkpoint directory and then renamed to "current",
+    so an interrupted write never corrupts the previous checkpoint.
+    """
+    def __init__(self, coaddType, checkpointPolicy, log):
+        """Construct a CoaddCheckpointer
+        
+        Inputs:
+        - coaddType: type of coadd (see makeCoadd)
+        - checkpointPolicy: a policy as described by policy/CheckpointDictionary.paf
+        - log: log
+        """
+        self.coaddType = coaddType
+        self.directory = checkpointPolicy.get("directory")
+        self.everyNExposures = checkpointPolicy.get("everyNExposures")
+        self.everyNSeconds = checkpointPolicy.get("everyNSeconds")
+        self.log = log
+        self.reset()
+    
+    def reset(self):
+        """Reset to the initial state: no exposures added"""
+        self.exposureIdList = []
+        self._exposureIdSet = set()
+        self._numEvents = 0
+        self._numSinceCheckpoint = 0
+        self._checkpointTime = time.time()
+
+    def isEnabled(self):
+        return bool(self.directory)
+    
+    def getExposureId(self, event):
+        """Return the ID of the exposure for an event
+        
+        The ID is event.exposureId if present, else the index of the event since the coadd was started
+        (which is only useful for resuming if the exposures are presented in the same order).
+        Call exactly once per event.
+        """
+        eventIndex = self._numEvents
+        self._numEvents += 1
+        if event.exists("exposureId"):
+            return str(event.get("exposureId"))
+        return "event%d" % (eventIndex,)
+
+    def addSeedExposureIds(self, exposureIdList):
+        """Note that the coadd was seeded with exposures with the specified IDs
+        
+        These exposures are then skipped if presented again and are recorded in checkpoints.
+        IDs made from the event index (see getExposureId) are ignored, since they only identify
+        an exposure within one run.
+        """
+        for exposureId in exposureIdList:
+            exposureId = str(exposureId)
+            if exposureId.startswith("event") and exposureId[5:].isdigit():
+                continue
+            self.exposureIdList.append(exposureId)
+            self._exposureIdSet.add(exposureId)
+
+    def hasExposure(self, exposureId):
+        """Return True if the exposure with the specified ID has already been added to the coadd"""
+        return str(exposureId) in self._exposureIdSet
+
+    def exposureAdded(self, coadd, exposureId):
+        """Note that an exposure has been added to coadd and write a checkpoint if one is due
+        """
+        self.exposureIdList.append(str(exposureId))
+        self._exposureIdSet.add(str(exposureId))
+        self._numSinceCheckpoint += 1
+        if not self.isEnabled():
+            return
+        isDue = (self.everyNExposures > 0 and self._numSinceCheckpoint >= self.everyNExposures) \
+            or (self.everyNSeconds > 0 and time.time() - self._checkpointTime >= self.everyNSeconds)
+        if isDue:
+            self.write(coadd)
+    
+    def write(self, coadd):
+        """Write a checkpoint of coadd"""
+        tempDir = os.path.join(self.directory, "new%d" % (os.getpid(),))
+        if os.path.exists(tempDir):
+            shutil.rmtree(tempDir)
+        partialCoadd = PartialCoadd.fromCoadd(self.coaddType, coadd, self.exposureIdList, deep=False)
+        partialCoadd.writeFits(tempDir)
+
+        currentDir = os.path.join(self.directory, "current")
+        oldDir = os.path.join(self.directory, "old")
+        if os.path.exists(oldDir):
+            shutil.rmtree(oldDir)
+        if os.path.exists(currentDir):
+            os.rename(currentDir, oldDir)
+        os.rename(tempDir, currentDir)
+        if os.path.exists(oldDir):
+            shutil.rmtree(oldDir)
+
+        self.log.log(Log.INFO, "Wrote checkpoint of %d exposures to %s" % \
+            (len(self.exposureIdList), currentDir))
+        self._numSinceCheckpoint = 0
+        self._checkpointTime = time.time()
+    
+    def read(self, allowedMaskPlanes, layout=None):
+        """Read the most recent checkpoint, if any
+        
+        Inputs:
+        - allowedMaskPlanes: mask planes to allow (ignore) when coadding; a space-separated list of names
+        - layout: storage layout of the restored accumulator; see makeCoadd
+        
+        @return the restored coadd accumulator, or None if there is no checkpoint.
+            The IDs of the exposures in the checkpoint are available as self.exposureIdList.
+        """
+        self.reset()
+        for subDir in ("current", "old"):
+            checkpointDir = os.path.join(self.directory, subDir)
+            if PartialCoadd.isComplete(checkpointDir):
+                break
+        else:
+            self.log.log(Log.INFO, "No checkpoint found in %s" % (self.directory,))
+            return None
+
+        partialCoadd = PartialCoadd.readFits(checkpointDir)
+        if partialCoadd.coaddType != self.coaddType:
+            raise RuntimeError("Checkpoint in %s has coaddType=%s; expected %s" % \
+                (checkpointDir, partialCoadd.coaddType, self.coaddType))
+        coadd = partialCoadd.makeCoadd(allowedMaskPlanes, layout)
+        self.exposureIdList = partialCoadd.exposureIdList
+        self._exposureIdSet = set(self.exposureIdList)
+        self.log.log(Log.INFO, "Resumed from checkpoint of %d exposures in %s" % \
+            (len(self.exposureIdList), checkpointDir))
+        return coadd
+    
+    def clear(self):
+        """Remove all checkpoints and reset to the initial state; call once the coadd is complete"""
+        self.reset()
+        if not self.isEnabled():
+            return
+        for subDir in ("current", "old"):
+            checkpointDir = os.path.join(self.directory, subDir)
+            if os.path.exists(checkpointDir):
+                shutil.rmtree(checkpointDir)
+
+class CoaddPatchCache(object):
+    """Coadd accumulators for any number of patches, keyed by patch ID,
+    at most maxNumInMemory of which are kept in memory
+    
+    When a patch is needed and maxNumInMemory patches are already in memory, the least recently used
+    patch is spilled to disk as a PartialCoadd and read back the next time it is needed.
+    """
+    def __init__(self, coaddType, allowedMaskPlanes, maxNumInMemory, spillDirectory, log, layout=None):
+        """Construct a CoaddPatchCache
+        
+        Inputs:
+        - coaddType: type of coadd (see makeCoadd)
+        - allowedMaskPlanes: mask planes to allow (ignore) when coadding; a space-separated list of names
+        - maxNumInMemory: maximum number of patches to keep in memory (at least 1 is kept)
+        - spillDirectory: directory in which to spill patches; if empty then a temporary directory
+            is created when first needed
+        - log: log
+        - layout: storage layout of accumulators read back from disk; see makeCoadd
+        """
+        self.coaddType = coaddType
+        self.allowedMaskPlanes = allowedMaskPlanes
+        self.layout = layout
+        self.maxNumInMemory = max(maxNumInMemory, 1)
+        self.spillDirectory = spillDirectory
+        self.log = log
+        self._tempDirectory = None
+        self.reset()
+    
+    def reset(self):
+        """Reset to the initial state: no patches"""
+        self._patchIdList = [] # IDs of all patches, in order of creation
+        self._coaddDict = {} # patch ID: coadd accumulator, for patches in memory
+        self._useList = [] # IDs of patches in memory, least recently used first
+        self._spillPathDict = {} # patch ID: partial coadd directory, for patches on disk
+        self._exposureIdListDict = {} # patch ID: IDs of the exposures added
+        self._numSpilled = 0
+    
+    def get(self, patchId, makeCoadd):
+        """Return the coadd accumulator for a patch, reading it back from disk if it was spilled
+        
+        Inputs:
+        - patchId: patch ID
+        - makeCoadd: function that returns a new, empty coadd accumulator; called if the patch is new
+        """
+        if patchId in self._coaddDict:
+            self._useList.remove(patchId)
+            self._useList.append(patchId)
+            return self._coaddDict[patchId]
+        
+        while len(self._useList) >= self.maxNumInMemory:
+            self._spill(self._useList[0])
+        if patchId in self._spillPathDict:
+            spillPath = self._spillPathDict.pop(patchId)
+            coadd = PartialCoadd.readFits(spillPath).makeCoadd(self.allowedMaskPlanes, self.layout)
+            shutil.rmtree(spillPath)
+            self.log.log(Log.INFO, "Read back patch %s from %s" % (patchId, spillPath))
+        else:
+            coadd = makeCoadd()
+            self._patchIdList.append(patchId)
+            self._exposureIdListDict[patchId] = []
+        self._coaddDict[patchId] = coadd
+        self._useList.append(patchId)
+        return coadd
+    
+    def exposureAdded(self, patchId, exposureId):
+        """Note that an exposure has been added to a patch"""
+        self._exposureIdListDict[patchId].append(str(exposureId))
+    
+    def getPatchIdList(self):
+        """Return the IDs of all patches, in order of creation"""
+        return self._patchIdList[:]
+    
+    def getPartialCoadd(self, patchId):
+        """Return the state of a patch as a PartialCoadd
+        
+        The pixels of a patch in memory are shared with its accumulator, not copied.
+        """
+        exposureIdList = self._exposureIdListDict[patchId]
+        if patchId in self._coaddDict:
+            coadd = self._coaddDict[patchId]
+            return PartialCoadd.fromCoadd(self.coaddType, coadd, exposureIdList, deep=False)
+        return PartialCoadd.readFits(self._spillPathDict[patchId])
+    
+    def remove(self, patchId):
+        """Remove a patch from memory, or from disk if it was spilled, to free its resources
+        
+        The patch ID stays in getPatchIdList, but the patch can no longer be accessed.
+        """
+        if patchId in self._coaddDict:
+            del self._coaddDict[patchId]
+            self._useList.remove(patchId)
+        elif patchId in self._spillPathDict:
+            spillPath = self._spillPathDict.pop(patchId)
+            if os.path.exists(spillPath):
+                shutil.rmtree(spillPath)
+    
+    def clear(self):
+        """Remove all spilled patches and reset to the initial state"""
+        for spillPath in self._spillPathDict.itervalues():
+            if os.path.exists(spillPath):
+                shutil.rmtree(spillPath)
+        if self._tempDirectory != None:
+            shutil.rmtree(self._tempDirectory)
+            self._tempDirectory = None
+        self.reset()
+    
+    def _spill(self, patchId):
+        """Write a patch to disk and remove it from memory"""
+        spillDirectory = self.spillDirectory
+        if not spillDirectory:
+            if self._tempDirectory == None:
+                self._tempDirectory = tempfile.mkdtemp(prefix="coaddPatches")
+            spillDirectory = self._tempDirectory
+        spillPath = os.path.join(spillDirectory, "patch%d_%d" % (os.getpid(), self._numSpilled))
+        self._numSpilled += 1
+        
+        coadd = self._coaddDict.pop(patchId)
+        self._useList.remove(patchId)
+        partialCoadd = PartialCoadd.fromCoadd(self.coaddType, coadd, self._exposureIdListDict[patchId],
+            deep=False)
+        partialCoadd.writeFits(spillPath)
+        self._spillPathDict[patchId] = spillPath
+        self.log.log(Log.INFO, "Spilled least recently used patch %s to %s" % (patchId, spillPath))
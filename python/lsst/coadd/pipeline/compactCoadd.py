@@ -0,0 +1,334 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Coadd accumulators with a compact storage layout
+
+CompactCoadd is a drop-in replacement for the coadd accumulators (coaddUtils.Coadd and coaddChiSq.Coadd)
+that uses less memory per pixel. It is selected by accumulatorPolicy.layout = "compact"
+(see policy/AccumulatorDictionary.paf).
+
+Bytes per pixel (k = number of allowed mask planes):
+- image sum: 4 (float32), plus 4 for the Kahan compensation plane if compensated
+- variance sum: 4 (float32; weighted mean coadds only)
+- weight: 4 (float32 sum of weights) or 2 (uint16 exposure count if countWeights, and for chi-squared coadds)
+- mask: k/8 (one bit-packed plane per allowed mask plane) if packMask, else 2 (uint16)
+For example a weighted mean coadd with countWeights, packMask, 2 allowed mask planes and no compensation
+needs 10.25 bytes/pixel, and a chi-squared coadd with compensation and packMask needs 10.25 bytes/pixel.
+
+Accuracy: with compensated summation the error of the image sum is about 2 float32 epsilons (~2.4e-7)
+relative to the sum of absolute values, independent of the number of exposures, which is comparable
+to float64 accumulation of float32 data. Without compensation the error grows as roughly
+sqrt(numExposures) float32 epsilons (numExposures in the worst case). The variance and weight sums
+have only positive terms and are not compensated, so their relative error is at most numExposures
+float32 epsilons and typically sqrt(numExposures). With compensation the coadd image therefore agrees
+with float64 accumulation to about 1e-6 relative (for pixels whose inputs have the same sign),
+and the coadd variance and weight map to about 1e-5 relative for up to 10000 exposures.
+"""
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+
+MaxCount = numpy.iinfo(numpy.uint16).max # maximum number of exposures with a uint16 count plane
+
+class CompactLayout(object):
+    """Storage layout options for CompactCoadd
+    
+    Attributes:
+    - compensated: if True then accumulate the image sum with Kahan compensated summation
+    - countWeights: if True then weight every exposure equally and keep a uint16 count of exposures
+        per pixel instead of a float32 sum of weights (chi-squared coadds always do this)
+    - packMask: if True then keep the OR of the masks as one bit-packed plane per allowed mask plane
+        instead of a uint16 plane
+    """
+    def __init__(self, compensated=True, countWeights=False, packMask=True):
+        self.compensated = bool(compensated)
+        self.countWeights = bool(countWeights)
+        self.packMask = bool(packMask)
+
+class CompactCoadd(object):
+    """A coadd accumulator with a compact storage layout
+    
+    A weighted mean coadd (as coaddUtils.Coadd) accumulates, for each pixel, sum(weight * image),
+    sum(weight^2 * variance) and sum(weight) over the good pixels of each exposure, where weight
+    is 1/mean variance of the good pixels (or 1 if layout.countWeights); getCoadd divides
+    the image sum by the weight sum and the variance sum by its square.
+    
+    A chi-squared coadd (as coaddChiSq.Coadd) accumulates sum(image^2 / variance) over the good pixels
+    of each exposure, with weight 1; getCoadd returns the unnormalized sum.
+    
+    Pixels with any mask bit not in allowedMaskPlanes are ignored. In the coadd, pixels with no data
+    have image and variance 0 and are masked EDGE.
+    """
+    def __init__(self, bbox, wcs, allowedMaskPlanes, layout, isChiSquared=False):
+        """Construct an empty CompactCoadd
+        
+        Inputs:
+        - bbox: bounding box of the coadd (afwImage.BBox)
+        - wcs: WCS of the coadd
+        - allowedMaskPlanes: mask planes to allow (ignore) when coadding; a space-separated list of names
+        - layout: storage layout (a CompactLayout)
+        - isChiSquared: if True then make a chi-squared coadd, else a weighted mean coadd
+        """
+        self.x0 = bbox.getX0()
+        self.y0 = bbox.getY0()
+        self.width = bbox.getWidth()
+        self.height = bbox.getHeight()
+        self._wcs = wcs
+        self.layout = layout
+        self.isChiSquared = bool(isChiSquared)
+        self.badPixelMask = coaddUtils.makeBitMask(allowedMaskPlanes.split(), doInvert=True)
+        self._maskBitList = [afwImage.MaskU.getPlaneBitMask(name) for name in allowedMaskPlanes.split()]
+
+        shape = (self.height, self.width)
+        self._imageSum = numpy.zeros(shape, dtype=numpy.float32)
+        self._imageCompensation = None
+        if layout.compensated:
+            self._imageCompensation = numpy.zeros(shape, dtype=numpy.float32)
+        self._varianceSum = None
+        if not self.isChiSquared:
+            self._varianceSum = numpy.zeros(shape, dtype=numpy.float32)
+        if self.isCounted():
+            self._weightSum = numpy.zeros(shape, dtype=numpy.uint16)
+        else:
+            self._weightSum = numpy.zeros(shape, dtype=numpy.float32)
+        if layout.packMask:
+            self._mask = numpy.zeros((len(self._maskBitList), self.height, (self.width + 7) // 8),
+                dtype=numpy.uint8)
+        else:
+            self._mask = numpy.zeros(shape, dtype=numpy.uint16)
+    
+    def isCounted(self):
+        """Return True if the weight of every exposure is 1 and the weight map is a uint16 count"""
+        return self.isChiSquared or self.layout.countWeights
+    
+    def getNumBytes(self):
+        """Return the number of bytes used by the accumulator planes"""
+        return sum([plane.nbytes for plane in (self._imageSum, self._imageCompensation, self._varianceSum,
+            self._weightSum, self._mask) if plane is not None])
+    
+    def getWcs(self):
+        return self._wcs
+    
+    def addExposure(self, exposure):
+        """Add an exposure to the coadd
+        
+        The exposure must have the same dimensions and xy0 as the coadd.
+        
+        @return weight of exposure (0 if it has no good pixels, in which case it is ignored)
+        @raise RuntimeError if the exposure has the wrong dimensions or xy0,
+            or the weight map is a count and it would overflow
+        """
+        image, mask, variance = self._getArrays(exposure.getMaskedImage())
+        isGood = self._getGoodPixels(mask, variance)
+        numGood = isGood.sum()
+        if numGood == 0:
+            return 0.0
+        if self.isCounted():
+            weight = 1.0
+        else:
+            weight = numGood / float(variance[isGood].sum(dtype=numpy.float64))
+        self._add((0, 0, self.width, self.height), image, mask, variance, isGood, weight)
+        return weight
+    
+    def addTile(self, maskedImage, bbox, weight):
+        """Add a masked image to a region of the coadd with a specified weight
+        
+        Inputs:
+        - maskedImage: masked image to add (afwImage.MaskedImageF)
+        - bbox: region of the coadd, relative to its origin (not xy0), with the dimensions of maskedImage
+        - weight: weight of maskedImage; ignored (1 is used) if the weight map is a count
+        
+        @raise RuntimeError if the weight map is a count and it would overflow
+        """
+        if (maskedImage.getWidth(), maskedImage.getHeight()) != (bbox.getWidth(), bbox.getHeight()):
+            raise RuntimeError("Image is %dx%d; region is %dx%d" % \
+                (maskedImage.getWidth(), maskedImage.getHeight(), bbox.getWidth(), bbox.getHeight()))
+        image = maskedImage.getImage().getArray()
+        mask = maskedImage.getMask().getArray()
+        variance = maskedImage.getVariance().getArray()
+        isGood = self._getGoodPixels(mask, variance)
+        if self.isCounted():
+            weight = 1.0
+        region = (bbox.getX0(), bbox.getY0(), bbox.getWidth(), bbox.getHeight())
+        self._add(region, image, mask, variance, isGood, weight)
+    
+    def getCoadd(self):
+        """Return the coadd (afwImage.ExposureF)"""
+        hasData = self._weightSum > 0
+        imageSum = self._getImageSum()
+        if self.isChiSquared:
+            image = numpy.where(hasData, imageSum, 0.0)
+            variance = numpy.zeros(imageSum.shape, dtype=numpy.float32)
+        else:
+            weightSum = numpy.where(hasData, self._weightSum, 1).astype(numpy.float64)
+            image = numpy.where(hasData, imageSum / weightSum, 0.0)
+            variance = numpy.where(hasData, self._varianceSum / (weightSum * weightSum), 0.0)
+        mask = numpy.where(hasData, self._getMask(), afwImage.MaskU.getPlaneBitMask("EDGE"))
+        return afwImage.makeExposure(self._makeMaskedImage(image, mask, variance), self._wcs)
+    
+    def getWeightMap(self):
+        """Return the weight map (afwImage.ImageF): the sum of weights of each pixel
+        (the number of exposures if the weight map is a count)
+        """
+        weightMap = afwImage.ImageF(self.width, self.height)
+        weightMap.setXY0(afwImage.PointI(self.x0, self.y0))
+        weightMap.getArray()[:, :] = self._weightSum
+        return weightMap
+    
+    def getSumMaskedImage(self):
+        """Return the unnormalized sum as a new afwImage.MaskedImageF (not a view)
+        """
+        variance = self._varianceSum
+        if variance is None:
+            variance = numpy.zeros((self.height, self.width), dtype=numpy.float32)
+        return self._makeMaskedImage(self._getImageSum(), self._getMask(), variance)
+    
+    def setState(self, sumMaskedImage, weightMap):
+        """Set the running state from an unnormalized sum (afwImage.MaskedImageF)
+        and weight map (afwImage.ImageF)
+        """
+        image, mask, variance = self._getArrays(sumMaskedImage)
+        self._imageSum[:, :] = image
+        if self._imageCompensation is not None:
+            self._imageCompensation[:, :] = 0
+        if self._varianceSum is not None:
+            self._varianceSum[:, :] = variance
+        weightArray = weightMap.getArray()
+        if self.isCounted():
+            self._weightSum[:, :] = numpy.clip(numpy.round(weightArray), 0, MaxCount)
+        else:
+            self._weightSum[:, :] = weightArray
+        if self.layout.packMask:
+            self._mask[:, :, :] = 0
+        else:
+            self._mask[:, :] = 0
+        self._orMask((0, 0, self.width, self.height), numpy.ones(mask.shape, dtype=bool), mask)
+    
+    def _getGoodPixels(self, mask, variance):
+        """Return a boolean array that is True for the pixels to add"""
+        isGood = (mask & self.badPixelMask) == 0
+        if self.isChiSquared:
+            isGood &= variance > 0
+        return isGood
+    
+    def _add(self, region, image, mask, variance, isGood, weight):
+        """Add the good pixels of image, mask and variance arrays to a region of the coadd
+        
+        Inputs:
+        - region: x0, y0, width, height of the region, relative to the origin of the coadd;
+            the arrays have the dimensions of the region
+        - image, mask, variance: arrays to add
+        - isGood: boolean array that is True for the pixels to add
+        - weight: weight of the pixels
+        """
+        if not isGood.any():
+            return
+        x0, y0, width, height = region
+        regionSlices = (slice(y0, y0 + height), slice(x0, x0 + width))
+        weightSum = self._weightSum[regionSlices]
+        if self.isCounted() and weightSum[isGood].max() >= MaxCount:
+            raise RuntimeError("Cannot add more than %d exposures to a coadd whose weight map "
+                "is a count" % (MaxCount,))
+
+        goodVariance = variance[isGood]
+        if self.isChiSquared:
+            goodImage = image[isGood]
+            self._addToImageSum(regionSlices, isGood, goodImage * goodImage / goodVariance)
+        else:
+            self._addToImageSum(regionSlices, isGood, image[isGood] * numpy.float32(weight))
+            self._varianceSum[regionSlices][isGood] += goodVariance * numpy.float32(weight * weight)
+        if self.isCounted():
+            weightSum[isGood] += 1
+        else:
+            weightSum[isGood] += numpy.float32(weight)
+        self._orMask(region, isGood, mask)
+    
+    def _addToImageSum(self, regionSlices, isGood, values):
+        """Add values to the image sum at the pixels of a region where isGood is True"""
+        imageSum = self._imageSum[regionSlices]
+        if self._imageCompensation is None:
+            imageSum[isGood] += values
+            return
+        # Kahan compensated summation: the compensation plane holds the low-order bits lost so far
+        imageCompensation = self._imageCompensation[regionSlices]
+        oldSum = imageSum[isGood]
+        correctedValues = values - imageCompensation[isGood]
+        newSum = oldSum + correctedValues
+        imageCompensation[isGood] = (newSum - oldSum) - correctedValues
+        imageSum[isGood] = newSum
+    
+    def _getImageSum(self):
+        """Return the image sum, including the compensation, as a float64 array"""
+        imageSum = self._imageSum.astype(numpy.float64)
+        if self._imageCompensation is not None:
+            imageSum -= self._imageCompensation
+        return imageSum
+    
+    def _orMask(self, region, isGood, mask):
+        """OR the mask bits of the pixels where isGood is True into a region of the accumulated mask
+        
+        See _add for the arguments.
+        """
+        x0, y0, width, height = region
+        if not self.layout.packMask:
+            regionMask = self._mask[y0:y0 + height, x0:x0 + width]
+            regionMask[isGood] |= mask[isGood]
+            return
+        # bits are packed along x, so pack full-width rows
+        for planeInd, maskBit in enumerate(self._maskBitList):
+            isSet = numpy.zeros((height, self.width), dtype=bool)
+            isSet[:, x0:x0 + width] = isGood & ((mask & maskBit) != 0)
+            self._mask[planeInd, y0:y0 + height] |= numpy.packbits(isSet, axis=1)
+    
+    def _getMask(self):
+        """Return the accumulated mask as a uint16 array"""
+        if not self.layout.packMask:
+            return self._mask.copy()
+        mask = numpy.zeros((self.height, self.width), dtype=numpy.uint16)
+        for planeInd, maskBit in enumerate(self._maskBitList):
+            isSet = numpy.unpackbits(self._mask[planeInd], axis=1)[:, :self.width].astype(bool)
+            mask[isSet] |= maskBit
+        return mask
+    
+    def _getArrays(self, maskedImage):
+        """Return the image, mask and variance arrays of a masked image
+        
+        @raise RuntimeError if maskedImage does not have the same dimensions and xy0 as the coadd
+        """
+        if (maskedImage.getWidth(), maskedImage.getHeight(), maskedImage.getX0(), maskedImage.getY0()) \
+            != (self.width, self.height, self.x0, self.y0):
+            raise RuntimeError("Image is %dx%d at (%d, %d); expected %dx%d at (%d, %d)" % \
+                (maskedImage.getWidth(), maskedImage.getHeight(), maskedImage.getX0(), maskedImage.getY0(),
+                self.width, self.height, self.x0, self.y0))
+        return maskedImage.getImage().getArray(), maskedImage.getMask().getArray(), \
+            maskedImage.getVariance().getArray()
+    
+    def _makeMaskedImage(self, image, mask, variance):
+        """Make an afwImage.MaskedImageF with the coadd's dimensions and xy0 from arrays"""
+        maskedImage = afwImage.MaskedImageF(self.width, self.height)
+        maskedImage.setXY0(afwImage.PointI(self.x0, self.y0))
+        maskedImage.getImage().getArray()[:, :] = image
+        maskedImage.getMask().getArray()[:, :] = mask
+        maskedImage.getVariance().getArray()[:, :] = variance
+        return maskedImage
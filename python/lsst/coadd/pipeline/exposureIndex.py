@@ -0,0 +1,324 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Persistent spatial index of exposure footprints, built from FITS headers alone
+
+The footprint of an exposure is a sky polygon sampled along the edges of the exposure.
+Footprints are stored in an sqlite database with the bounding box of each footprint
+in 3-d unit-vector space (which has no RA wraparound or pole problems),
+so that the exposures overlapping a coadd area can be found without reading any pixels:
+a fast bounding-box query selects candidates, which are then checked by intersecting
+their polygons with the coadd area's polygon in a gnomonic projection.
+"""
+import math
+import os
+import sqlite3
+
+from lsst.pex.logging import Log
+import lsst.afw.coord as afwCoord
+import lsst.afw.image as afwImage
+
+# number of points sampled along each edge of an exposure to make its sky polygon
+DefaultNumPerSide = 4
+
+def getExposureHeaderPath(path):
+    """Return the path of the FITS file containing the WCS of an Exposure
+    
+    Inputs:
+    - path: path to an Exposure (without the final _img.fits)
+    """
+    return path + "_img.fits"
+
+def readExposureGeometry(path):
+    """Read the WCS and bounding box of an Exposure on disk, reading only its image header
+    
+    Inputs:
+    - path: path to an Exposure (without the final _img.fits)
+    
+    @return wcs, bbox (afwImage.BBox in parent pixel coordinates)
+    """
+    metadata = afwImage.readMetadata(getExposureHeaderPath(path))
+    x0 = y0 = 0
+    if metadata.exists("LTV1"):
+        x0 = -int(round(metadata.get("LTV1")))
+    if metadata.exists("LTV2"):
+        y0 = -int(round(metadata.get("LTV2")))
+    bbox = afwImage.BBox(afwImage.PointI(x0, y0), metadata.getInt("NAXIS1"), metadata.getInt("NAXIS2"))
+    return afwImage.makeWcs(metadata), bbox
+
+def computeSkyPolygon(wcs, bbox, numPerSide=DefaultNumPerSide):
+    """Compute the sky polygon of an image area
+    
+    Inputs:
+    - wcs: WCS of the image
+    - bbox: bounding box of the image area (afwImage.BBox)
+    - numPerSide: number of points sampled along each edge (including one corner)
+    
+    @return a list of (RA, Dec) (degrees), walking around the edge of the area
+    """
+    xMin = bbox.getX0()
+    yMin = bbox.getY0()
+    xMax = bbox.getX1()
+    yMax = bbox.getY1()
+    pixelList = []
+    for i in range(numPerSide):
+        frac = i / float(numPerSide)
+        pixelList.append((xMin + frac * (xMax - xMin), yMin))
+    for i in range(numPerSide):
+        frac = i / float(numPerSide)
+        pixelList.append((xMax, yMin + frac * (yMax - yMin)))
+    for i in range(numPerSide):
+        frac = i / float(numPerSide)
+        pixelList.append((xMax - frac * (xMax - xMin), yMax))
+    for i in range(numPerSide):
+        frac = i / float(numPerSide)
+        pixelList.append((xMin, yMax - frac * (yMax - yMin)))
+    
+    skyPolygon = []
+    for x, y in pixelList:
+        sky = wcs.pixelToSky(x, y)
+        skyPolygon.append((sky.getLongitude(afwCoord.DEGREES), sky.getLatitude(afwCoord.DEGREES)))
+    return skyPolygon
+
+def skyToVector(ra, dec):
+    """Return the unit vector (x, y, z) of a sky position given as RA, Dec (degrees)"""
+    raRad = math.radians(ra)
+    decRad = math.radians(dec)
+    return (math.cos(decRad) * math.cos(raRad), math.cos(decRad) * math.sin(raRad), math.sin(decRad))
+
+def computeVectorBounds(skyPolygon):
+    """Return the bounding box, in unit-vector space, of the sky area enclosed by a sky polygon
+    
+    The box of the polygon's vertices is grown by the maximum bulge of the sphere
+    between the vertices, so the box is conservative.
+    
+    @return (xMin, xMax, yMin, yMax, zMin, zMax)
+    """
+    vectorList = [skyToVector(ra, dec) for ra, dec in skyPolygon]
+    center = _normalize([sum(vec[i] for vec in vectorList) for i in range(3)])
+    minCos = min(_dot(center, vec) for vec in vectorList)
+    pad = 1.0 - max(min(minCos, 1.0), -1.0) + 1.0e-9
+    bounds = []
+    for i in range(3):
+        bounds += [min(vec[i] for vec in vectorList) - pad, max(vec[i] for vec in vectorList) + pad]
+    return tuple(bounds)
+
+def skyPolygonsOverlap(skyPolygon1, skyPolygon2):
+    """Return True if two sky polygons overlap
+    
+    The polygons are compared in a gnomonic projection centered on the first polygon,
+    so they must each span well under 90 degrees. A polygon with any vertex more than 90 degrees
+    from the projection center is conservatively reported as overlapping.
+    """
+    vectorList1 = [skyToVector(ra, dec) for ra, dec in skyPolygon1]
+    center = _normalize([sum(vec[i] for vec in vectorList1) for i in range(3)])
+    # basis of the tangent plane at center
+    if abs(center[2]) < 0.9:
+        east = _normalize(_cross((0.0, 0.0, 1.0), center))
+    else:
+        east = _normalize(_cross((0.0, 1.0, 0.0), center))
+    north = _cross(center, east)
+
+    planePolygonList = []
+    for skyPolygon in (skyPolygon1, skyPolygon2):
+        planePolygon = []
+        for ra, dec in skyPolygon:
+            vec = skyToVector(ra, dec)
+            cosDist = _dot(center, vec)
+            if cosDist <= 0:
+                return True
+            planePolygon.append((_dot(east, vec) / cosDist, _dot(north, vec) / cosDist))
+        planePolygonList.append(planePolygon)
+    return polygonsOverlap(*planePolygonList)
+
+def polygonsOverlap(polygon1, polygon2):
+    """Return True if two simple plane polygons, each a list of (x, y) vertices, overlap
+    """
+    for point in polygon1:
+        if pointInPolygon(point, polygon2):
+            return True
+    for point in polygon2:
+        if pointInPolygon(point, polygon1):
+            return True
+    edgeList2 = zip(polygon2, polygon2[1:] + polygon2[:1])
+    for a1, b1 in zip(polygon1, polygon1[1:] + polygon1[:1]):
+        for a2, b2 in edgeList2:
+            if _segmentsIntersect(a1, b1, a2, b2):
+                return True
+    return False
+
+def pointInPolygon(point, polygon):
+    """Return True if a point (x, y) is inside a simple plane polygon (a list of (x, y) vertices)
+    """
+    x, y = point
+    isInside = False
+    for (xa, ya), (xb, yb) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (ya > y) != (yb > y):
+            xCross = xa + (y - ya) * (xb - xa) / (yb - ya)
+            if x < xCross:
+                isInside = not isInside
+    return isInside
+
+def _segmentsIntersect(a1, b1, a2, b2):
+    """Return True if plane segments a1-b1 and a2-b2 cross (touching does not count)"""
+    return _orientation(a2, b2, a1) * _orientation(a2, b2, b1) < 0 \
+        and _orientation(a1, b1, a2) * _orientation(a1, b1, b2) < 0
+
+def _orientation(a, b, c):
+    """Return > 0 if a, b, c are counterclockwise, < 0 if clockwise, 0 if collinear"""
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def _normalize(a):
+    norm = math.sqrt(_dot(a, a))
+    return (a[0] / norm, a[1] / norm, a[2] / norm)
+
+def _formatPolygon(skyPolygon):
+    return " ".join("%.10f %.10f" % (ra, dec) for ra, dec in skyPolygon)
+
+def _parsePolygon(polygonStr):
+    valList = [float(val) for val in polygonStr.split()]
+    return zip(valList[0::2], valList[1::2])
+
+class ExposureIndex(object):
+    """Persistent spatial index of exposure footprints
+    
+    Entries are keyed by exposure path and are refreshed if the exposure's header file
+    has been modified since it was indexed. Not safe to share between threads;
+    use one ExposureIndex per thread.
+    """
+    def __init__(self, dbPath, numPerSide=DefaultNumPerSide):
+        """Open (creating if necessary) an exposure index
+        
+        Inputs:
+        - dbPath: path of sqlite database file
+        - numPerSide: number of points sampled along each edge of an exposure for its footprint
+        """
+        self.dbPath = dbPath
+        self.numPerSide = numPerSide
+        self._conn = sqlite3.connect(dbPath)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS exposure (
+            path TEXT PRIMARY KEY,
+            mtime REAL,
+            xMin REAL, xMax REAL, yMin REAL, yMax REAL, zMin REAL, zMax REAL,
+            polygon TEXT)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS exposure_zMin ON exposure (zMin)")
+        self._conn.commit()
+
+    def close(self):
+        """Close the database"""
+        self._conn.close()
+    
+    def addExposures(self, pathList, log=None):
+        """Index exposures that are not yet indexed or whose header file has changed
+        
+        Only FITS headers are read.
+        
+        Inputs:
+        - pathList: list of paths to Exposures (without the final _img.fits)
+        - log: a pexLog.Log for progress, or None
+        
+        @return the number of exposures (re)indexed
+        """
+        mtimeDict = dict(self._conn.execute("SELECT path, mtime FROM exposure").fetchall())
+        numIndexed = 0
+        for path in pathList:
+            mtime = os.path.getmtime(getExposureHeaderPath(path))
+            if mtimeDict.get(path) == mtime:
+                continue
+            wcs, bbox = readExposureGeometry(path)
+            skyPolygon = computeSkyPolygon(wcs, bbox, self.numPerSide)
+            self._conn.execute("INSERT OR REPLACE INTO exposure VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, mtime) + computeVectorBounds(skyPolygon) + (_formatPolygon(skyPolygon),))
+            mtimeDict[path] = mtime
+            numIndexed += 1
+        self._conn.commit()
+        if log != None and numIndexed > 0:
+            log.log(Log.INFO, "Indexed %d of %d exposures" % (numIndexed, len(pathList)))
+        return numIndexed
+    
+    def findOverlapping(self, wcs, bbox, pathList=None):
+        """Find indexed exposures that overlap an image area
+        
+        Inputs:
+        - wcs: WCS of the image area
+        - bbox: bounding box of the image area (afwImage.BBox)
+        - pathList: if not None then only exposures in this list are returned
+            (exposures in the list that have not been indexed are not returned)
+        
+        @return a list of paths of overlapping exposures, in the order of pathList if specified,
+            else in sorted order
+        """
+        skyPolygon = computeSkyPolygon(wcs, bbox, self.numPerSide)
+        bounds = computeVectorBounds(skyPolygon)
+        cursor = self._conn.execute("""SELECT path, polygon FROM exposure
+            WHERE xMax >= ? AND xMin <= ? AND yMax >= ? AND yMin <= ? AND zMax >= ? AND zMin <= ?""",
+            bounds)
+        overlapSet = set()
+        for path, polygonStr in cursor:
+            if skyPolygonsOverlap(skyPolygon, _parsePolygon(polygonStr)):
+                overlapSet.add(path)
+        if pathList == None:
+            return sorted(overlapSet)
+        return [path for path in pathList if path in overlapSet]
+
+def filterExposurePathList(indexPath, pathList, wcs, bbox, log=None):
+    """Return the exposures in pathList that overlap an image area, updating an exposure index as needed
+    
+    Inputs:
+    - indexPath: path of sqlite exposure index database (created if it does not exist)
+    - pathList: list of paths to Exposures (without the final _img.fits)
+    - wcs: WCS of the image area
+    - bbox: bounding box of the image area (afwImage.BBox)
+    - log: a pexLog.Log for progress, or None
+    
+    @return the paths in pathList whose exposures overlap the image area, in order
+    """
+    exposureIndex = ExposureIndex(indexPath)
+    try:
+        exposureIndex.addExposures(pathList, log)
+        return exposureIndex.findOverlapping(wcs, bbox, pathList)
+    finally:
+        exposureIndex.close()
+
+def filterToFirstExposure(indexPath, pathList, log=None):
+    """Return the first path in pathList plus the other paths whose exposures overlap the first exposure,
+    updating an exposure index as needed
+    
+    This suits coadd drivers whose first exposure is the reference exposure.
+    Only FITS headers are read.
+    
+    Inputs:
+    - indexPath: path of sqlite exposure index database (created if it does not exist)
+    - pathList: list of paths to Exposures (without the final _img.fits)
+    - log: a pexLog.Log for progress, or None
+    """
+    if len(pathList) == 0:
+        return []
+    wcs, bbox = readExposureGeometry(pathList[0])
+    return pathList[:1] + filterExposurePathList(indexPath, pathList[1:], wcs, bbox, log)
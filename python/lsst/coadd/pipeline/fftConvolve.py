@@ -0,0 +1,186 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Convolve a masked image with a kernel using FFTs (overlap-add)
+
+The result matches afwMath.convolve(convolvedMaskedImage, maskedImage, kernel, False) to within
+floating-point round-off, but the cost grows as image area times log(block size), rather than
+image area times kernel area, so it is much faster for large kernels:
+- image: the image convolved with the kernel
+- variance: the variance convolved with the square of the kernel
+- mask: each mask bit is ORed over the pixels where the kernel is nonzero
+- non-finite image (or variance) pixels make every output pixel within the kernel's extent nan
+- edge pixels (where the kernel does not fit) are set as afwMath.convolve sets them
+
+The image is processed in blockSize x blockSize blocks, one row of blocks at a time; the planes to convolve
+are made for one row of blocks at a time, so the working memory is a few planes
+of (blockSize + kernel height) rows. A spatially varying kernel is evaluated
+at the center of each block, so the result is then only an approximation: a piecewise-constant kernel.
+"""
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+
+def fftConvolve(convolvedMaskedImage, maskedImage, kernel, blockSize):
+    """Convolve maskedImage with kernel using FFTs, as afwMath.convolve(..., doCopyEdge=False)
+    
+    Inputs:
+    - convolvedMaskedImage: output masked image; must have the same dimensions as maskedImage
+    - maskedImage: masked image to convolve (afwImage.MaskedImageF)
+    - kernel: convolution kernel (afwMath.Kernel); not normalized
+    - blockSize: width and height of the blocks into which maskedImage is divided
+    """
+    image = maskedImage.getImage().getArray()
+    mask = maskedImage.getMask().getArray()
+    variance = maskedImage.getVariance().getArray()
+    height, width = image.shape
+    kernelWidth = kernel.getWidth()
+    kernelHeight = kernel.getHeight()
+    ctrX = kernel.getCtrX()
+    ctrY = kernel.getCtrY()
+    
+    convolvedImage = convolvedMaskedImage.getImage().getArray()
+    convolvedMask = convolvedMaskedImage.getMask().getArray()
+    convolvedVariance = convolvedMaskedImage.getVariance().getArray()
+    edgeImage, edgeMask, edgeVariance = getEdgePixel(kernel)
+    convolvedImage[:, :] = edgeImage
+    convolvedMask[:, :] = edgeMask
+    convolvedVariance[:, :] = edgeVariance
+    if width < kernelWidth or height < kernelHeight:
+        return
+    
+    # mask bits that are set anywhere; OR each row first so the mask is not copied
+    bitList = []
+    maskOr = int(numpy.bitwise_or.reduce(numpy.bitwise_or.reduce(mask, axis=1))) if mask.size else 0
+    bit = 1
+    while bit <= maskOr:
+        if maskOr & bit:
+            bitList.append(bit)
+        bit <<= 1
+    numPlanes = 4 + len(bitList)
+    
+    blockSize = max(int(blockSize), 1)
+    fftShape = (nextFastSize(blockSize + kernelHeight - 1), nextFastSize(blockSize + kernelWidth - 1))
+    sumWidth = width + kernelWidth - 1
+    bandHeight = blockSize + kernelHeight - 1
+    sumList = [numpy.zeros((bandHeight, sumWidth)) for i in range(numPlanes)]
+    kernelFftList = None
+    for y0 in range(0, height, blockSize):
+        blockHeight = min(blockSize, height - y0)
+        bandRows = slice(y0, y0 + blockHeight)
+        planeList = makePlaneList(image[bandRows], mask[bandRows], variance[bandRows], bitList)
+        for x0 in range(0, width, blockSize):
+            blockWidth = min(blockSize, width - x0)
+            if kernelFftList == None or kernel.isSpatiallyVarying():
+                xCtr = maskedImage.getX0() + x0 + (blockWidth / 2.0)
+                yCtr = maskedImage.getY0() + y0 + (blockHeight / 2.0)
+                kernelFftList = makeKernelFftList(kernel, xCtr, yCtr, fftShape)
+            sumHeight = blockHeight + kernelHeight - 1
+            for (plane, kernelInd), planeSum in zip(planeList, sumList):
+                blockFft = numpy.fft.rfft2(plane[:, x0:x0 + blockWidth], fftShape)
+                blockSum = numpy.fft.irfft2(blockFft * kernelFftList[kernelInd], fftShape)
+                planeSum[0:sumHeight, x0:x0 + blockWidth + kernelWidth - 1] += \
+                    blockSum[0:sumHeight, 0:blockWidth + kernelWidth - 1]
+        
+        # rows y0 to y0 + blockHeight - 1 of the full convolution are complete;
+        # the full convolution's row r is output row r - (kernelHeight - 1 - ctrY), which is valid
+        # (not an edge pixel) if kernelHeight - 1 <= r < height
+        rowStart = max(y0, kernelHeight - 1)
+        rowEnd = min(y0 + blockHeight, height)
+        if rowStart < rowEnd:
+            sumRows = slice(rowStart - y0, rowEnd - y0)
+            outRows = slice(rowStart - (kernelHeight - 1 - ctrY), rowEnd - (kernelHeight - 1 - ctrY))
+            outCols = slice(ctrX, width - kernelWidth + ctrX + 1)
+            sumCols = slice(kernelWidth - 1, width)
+            outImage = sumList[0][sumRows, sumCols]
+            outVariance = sumList[1][sumRows, sumCols]
+            convolvedImage[outRows, outCols] = numpy.where(sumList[2][sumRows, sumCols] > 0.5,
+                numpy.nan, outImage)
+            convolvedVariance[outRows, outCols] = numpy.where(sumList[3][sumRows, sumCols] > 0.5,
+                numpy.nan, outVariance)
+            outMask = numpy.zeros(outImage.shape, dtype=convolvedMask.dtype)
+            for bit, planeSum in zip(bitList, sumList[4:]):
+                outMask[planeSum[sumRows, sumCols] > 0.5] |= bit
+            convolvedMask[outRows, outCols] = outMask
+        
+        for planeSum in sumList:
+            planeSum[0:kernelHeight - 1] = planeSum[blockHeight:blockHeight + kernelHeight - 1].copy()
+            planeSum[kernelHeight - 1:] = 0
+
+def makePlaneList(image, mask, variance, bitList):
+    """Return the planes to convolve for one row of blocks, as a list of (plane, index of kernel FFT)
+    
+    The planes are: the image (convolved with the kernel), the variance (with the kernel squared),
+    non-finite image and variance pixels (with the kernel's bounding box, since 0 * nan = nan)
+    and each mask bit in bitList (with the kernel's nonzero footprint).
+    """
+    isBadImage = ~numpy.isfinite(image)
+    isBadVariance = ~numpy.isfinite(variance)
+    return [
+        (numpy.where(isBadImage, 0, image), 0),
+        (numpy.where(isBadVariance, 0, variance), 1),
+        (isBadImage.astype(float), 3),
+        (isBadVariance.astype(float), 3),
+    ] + [(((mask & bit) != 0).astype(float), 2) for bit in bitList]
+
+def makeKernelFftList(kernel, x, y, fftShape):
+    """Return the FFTs of the kernel (evaluated at x, y), its square, its nonzero footprint
+    and its bounding box
+    
+    The kernel image is flipped, because afwMath.convolve computes
+    convolved(x, y) = sum over i, j of kernel(i, j) image(x + i - ctrX, y + j - ctrY)
+    """
+    kernelImage = afwImage.ImageD(kernel.getWidth(), kernel.getHeight())
+    kernel.computeImage(kernelImage, False, x, y)
+    kernelArray = kernelImage.getArray()[::-1, ::-1]
+    return [numpy.fft.rfft2(kernelArray, fftShape), numpy.fft.rfft2(kernelArray**2, fftShape),
+        numpy.fft.rfft2((kernelArray != 0).astype(float), fftShape),
+        numpy.fft.rfft2(numpy.ones(kernelArray.shape), fftShape)]
+
+def getEdgePixel(kernel):
+    """Return the image, mask and variance value afwMath.convolve sets for edge pixels
+    
+    These are measured by convolving a tiny image, to be certain of matching afwMath.convolve.
+    """
+    width = kernel.getWidth()
+    height = kernel.getHeight()
+    maskedImage = afwImage.MaskedImageF(width, height)
+    convolvedMaskedImage = afwImage.MaskedImageF(width, height)
+    afwMath.convolve(convolvedMaskedImage, maskedImage, kernel, False)
+    x, y = 0, 0
+    if (x, y) == (kernel.getCtrX(), kernel.getCtrY()):
+        x, y = width - 1, height - 1
+    return convolvedMaskedImage.getImage().get(x, y), convolvedMaskedImage.getMask().get(x, y), \
+        convolvedMaskedImage.getVariance().get(x, y)
+
+def nextFastSize(size):
+    """Return the smallest integer >= size whose only prime factors are 2, 3 and 5"""
+    while True:
+        remainder = size
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 1
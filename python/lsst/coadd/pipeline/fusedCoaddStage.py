@@ -0,0 +1,182 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from lsst.pex.logging import Log
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.coadd.utils as coaddUtils
+import baseCoaddStage
+import baseStage
+import coaddState
+import parallelUtils
+import psfMatchToImageStage
+import tileUtils
+import warpExposureStage
+import warpGeometry
+
+class FusedCoaddStageParallel(baseCoaddStage.CoaddStageParallel):
+    """
+    Pipeline stage to warp, psf-match and add exposures to a coadd, optionally one tile at a time.
+    
+    This does the work of WarpExposureStage, PsfMatchStage and CoaddGenerationStage in one stage.
+    For each exposure the psf-matching kernel is solved for (or found in the kernel cache) on a solve region
+    that is warped and psf-matched, and the weight of the exposure is computed as 1/mean variance
+    of the psf-matched solve region. The solve region depends on kernelSolveSize:
+    - If kernelSolveSize <= 0 (the default) the solve region is the overlap of the exposure
+      with the reference exposure, and the psf-matched overlap is added to the coadd as it is.
+      This matches the unfused stages, but it saves no memory: the warped and psf-matched overlap
+      are full-frame intermediates, as for WarpExposureStage and PsfMatchStage.
+    - If kernelSolveSize > 0 the solve region is a kernelSolveSize square at the center of the overlap.
+      Then, for each tileWidth x tileHeight tile of the overlap, the tile grown by the half-size
+      of the kernel is warped, convolved with the kernel (using FFTs for large kernels;
+      see psfMatchPolicy.convolutionPolicy), trimmed back to the tile and added to the coadd.
+      Up to numPrefetch tiles are warped and convolved ahead in a background thread.
+      No full-frame warped or psf-matched exposure is made: peak memory is the coadd plus the solve
+      region and a few tiles.
+    
+    The coadd has the dimensions, xy0 and WCS of the reference exposure. Warping and psf-matching are
+    controlled by warpExposurePolicy and psfMatchPolicy, as for WarpExposureStage and PsfMatchStage
+    (restrictToOverlap is always true). Solving on a kernelSolveSize square is faster and bounds memory,
+    but the kernel (and a spatially varying kernel in particular) is then only constrained by the square,
+    so the result differs from PsfMatchStage.
+    
+    Otherwise the stage behaves as CoaddGenerationStage (see baseCoaddStage.CoaddStageParallel),
+    except that patches are not supported.
+    """
+    packageName = "coadd_pipeline"
+    policyDictionaryName = "FusedCoaddStageDictionary.paf"
+    metricsInputKeys = ("exposure",)
+    coaddType = coaddState.WeightedMeanCoaddType
+    exposureKey = "exposure"
+    weightKey = "coaddedWeight"
+
+    def setup(self):
+        baseCoaddStage.CoaddStageParallel.setup(self)
+        if self.patchCache != None:
+            raise RuntimeError("FusedCoaddStage does not support patches; patchPolicy.patchWidth "
+                "and patchHeight must be 0")
+        
+        self.warpStage = warpExposureStage.WarpExposureStageParallel(
+            self.policy.getPolicy("warpExposurePolicy"), self.log)
+        self.psfMatchStage = psfMatchToImageStage.PsfMatchStageParallel(
+            self.policy.getPolicy("psfMatchPolicy"), self.log)
+        self.tileWidth = self.policy.get("tileWidth")
+        self.tileHeight = self.policy.get("tileHeight")
+        self.kernelSolveSize = self.policy.get("kernelSolveSize")
+        self.numPrefetch = self.policy.get("numPrefetch")
+        self.badPixelMask = coaddUtils.makeBitMask(self.allowedMaskPlanes.split(), doInvert=True)
+    
+    def addExposure(self, clipboard, exposure):
+        """Warp, psf-match and add exposure to the coadd, in one piece or one tile at a time
+        
+        @return weight of exposure (0 if it does not overlap the reference exposure or has no good pixels)
+        """
+        referenceExposure = self.getFromClipboard(clipboard, "referenceExposure")
+        if not self.coadd:
+            self.log.log(Log.INFO, "First exposure: create coadd")
+            self.coadd = self.makeCoadd(referenceExposure)
+        referenceGeometry = self.warpStage.getReferenceGeometry(referenceExposure)
+        
+        overlapBBox = referenceGeometry.computeOverlapBBox(exposure.getWcs(),
+            coaddUtils.bboxFromImage(exposure), self.warpStage.overlapBorder)
+        if overlapBBox.getWidth() == 0 or overlapBBox.getHeight() == 0:
+            self.log.log(Log.INFO, "Exposure does not overlap the reference exposure; skipping it")
+            return 0.0
+        
+        solveBBox = overlapBBox
+        if self.kernelSolveSize > 0:
+            solveWidth = min(self.kernelSolveSize, overlapBBox.getWidth())
+            solveHeight = min(self.kernelSolveSize, overlapBBox.getHeight())
+            solveLLC = afwImage.PointI(overlapBBox.getX0() + (overlapBBox.getWidth() - solveWidth) // 2,
+                overlapBBox.getY0() + (overlapBBox.getHeight() - solveHeight) // 2)
+            solveBBox = afwImage.BBox(solveLLC, solveWidth, solveHeight)
+        psfMatchedExposure, kernel, weight = self.matchSolveRegion(exposure, referenceExposure,
+            referenceGeometry, solveBBox)
+        if weight <= 0:
+            self.log.log(Log.WARN, "Psf-matched exposure has no good pixels; skipping it")
+            return 0.0
+        if self.kernelSolveSize <= 0:
+            self.log.log(Log.INFO, "Add the psf-matched %dx%d overlap to the coadd" % \
+                (overlapBBox.getWidth(), overlapBBox.getHeight()))
+            coaddState.addTile(self.coadd, psfMatchedExposure.getMaskedImage(),
+                warpGeometry.getRelativeBBox(overlapBBox, referenceGeometry.bbox), weight, self.badPixelMask)
+            return weight
+        del psfMatchedExposure
+        border = max(kernel.getCtrX(), kernel.getCtrY(),
+            kernel.getWidth() - 1 - kernel.getCtrX(), kernel.getHeight() - 1 - kernel.getCtrY())
+        
+        tileBBoxList = []
+        for relTileBBox in tileUtils.makeTileBBoxList(overlapBBox.getWidth(), overlapBBox.getHeight(),
+            self.tileWidth, self.tileHeight):
+            tileLLC = afwImage.PointI(overlapBBox.getX0() + relTileBBox.getX0(),
+                overlapBBox.getY0() + relTileBBox.getY0())
+            tileBBoxList.append(afwImage.BBox(tileLLC, relTileBBox.getWidth(), relTileBBox.getHeight()))
+        self.log.log(Log.INFO, "Warp, psf-match and coadd the %dx%d overlap in %d tiles" % \
+            (overlapBBox.getWidth(), overlapBBox.getHeight(), len(tileBBoxList)))
+        
+        def matchTile(tileBBox):
+            """Warp and psf-match one tile; return the psf-matched tile (afwImage.MaskedImageF)"""
+            grownBBox = afwImage.BBox(afwImage.PointI(tileBBox.getX0() - border, tileBBox.getY0() - border),
+                tileBBox.getWidth() + 2 * border, tileBBox.getHeight() + 2 * border)
+            paddedBBox = tileUtils.getOverlapBBox(grownBBox, referenceGeometry.bbox)
+            warpedExposure, interpolationError = self.warpStage.warpExposureToBBox(
+                exposure, referenceGeometry, paddedBBox)
+            psfMatchedExposure = psfMatchToImageStage.convolveExposure(warpedExposure, kernel, 1,
+                self.psfMatchStage.convolutionPolicy)
+            return afwImage.MaskedImageF(psfMatchedExposure.getMaskedImage(),
+                warpGeometry.getRelativeBBox(tileBBox, paddedBBox))
+        
+        for tileBBox, psfMatchedTile in parallelUtils.prefetch(matchTile, tileBBoxList, self.numPrefetch):
+            coaddState.addTile(self.coadd, psfMatchedTile,
+                warpGeometry.getRelativeBBox(tileBBox, referenceGeometry.bbox), weight, self.badPixelMask)
+        return weight
+    
+    def matchSolveRegion(self, exposure, referenceExposure, referenceGeometry, solveBBox):
+        """Warp the kernel solve region of exposure and psf-match it to referenceExposure
+        
+        @return psfMatchedExposure, psfMatchingKernel, weight: the psf-matched solve region,
+            the kernel and the weight of the exposure: 1/mean variance of the good pixels
+            of the psf-matched region (0 if there are none)
+        """
+        self.log.log(Log.INFO, "Solve for psf-matching kernel on %dx%d region" % \
+            (solveBBox.getWidth(), solveBBox.getHeight()))
+        
+        warpedExposure, interpolationError = self.warpStage.warpExposureToBBox(
+            exposure, referenceGeometry, solveBBox)
+        subReferenceExposure = afwImage.ExposureF(referenceExposure,
+            warpGeometry.getRelativeBBox(solveBBox, referenceGeometry.bbox))
+        psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, psfMatchingPath = \
+            self.psfMatchStage.matchExposure(warpedExposure, subReferenceExposure)
+        
+        psfMatchedMaskedImage = psfMatchedExposure.getMaskedImage()
+        statsControl = afwMath.StatisticsControl()
+        statsControl.setAndMask(self.badPixelMask)
+        meanVariance = afwMath.makeStatistics(psfMatchedMaskedImage.getVariance(),
+            psfMatchedMaskedImage.getMask(), afwMath.MEAN, statsControl).getValue(afwMath.MEAN)
+        if not meanVariance > 0:
+            return psfMatchedExposure, psfMatchingKernel, 0.0
+        return psfMatchedExposure, psfMatchingKernel, 1.0 / meanVariance
+
+# this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
+class FusedCoaddStage(baseStage.Stage):
+    parallelClass = FusedCoaddStageParallel
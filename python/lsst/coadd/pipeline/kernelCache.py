@@ -0,0 +1,164 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Cache of psf-matching kernel solutions, in memory and (optionally) on disk
+"""
+from __future__ import with_statement
+
+import glob
+import hashlib
+import os
+
+import lsst.daf.base as dafBase
+import lsst.daf.persistence as dafPersist
+import lsst.pex.policy as pexPolicy
+import lsst.afw.math as afwMath
+
+def updateExposureHash(sha, exposure):
+    """Update a hashlib hash with everything that identifies an exposure
+    
+    The hash includes the dimensions, xy0, WCS and metadata of the exposure
+    and every pixel of its image, mask and variance (which is cheap compared to psf-matching).
+    """
+    maskedImage = exposure.getMaskedImage()
+    sha.update("dims=%d,%d\n" % (maskedImage.getWidth(), maskedImage.getHeight()))
+    sha.update("xy0=%d,%d\n" % (maskedImage.getX0(), maskedImage.getY0()))
+    if exposure.hasWcs():
+        sha.update(exposure.getWcs().getFitsMetadata().toString())
+    sha.update(exposure.getMetadata().toString())
+    for plane in (maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance()):
+        sha.update(plane.getArray().tostring())
+
+def makeCacheKey(exposure, referenceExposure, policy):
+    """Return a cache key for psf-matching exposure to referenceExposure using policy
+    """
+    sha = hashlib.sha1()
+    updateExposureHash(sha, exposure)
+    updateExposureHash(sha, referenceExposure)
+    sha.update(policy.toString())
+    return sha.hexdigest()
+
+class KernelCache(object):
+    """Least-recently-used cache of psf-matching kernels and kernel sums
+    
+    Entries are held in memory (up to maxSize entries) and, if cacheDir is specified,
+    also on disk (up to maxDiskSize entries; kernels are persisted using BoostStorage).
+    """
+    def __init__(self, maxSize, cacheDir="", maxDiskSize=0):
+        """Construct a KernelCache
+        
+        Inputs:
+        - maxSize: maximum number of entries to keep in memory
+        - cacheDir: directory in which to keep entries on disk; if "" then entries are not kept on disk
+        - maxDiskSize: maximum number of entries to keep on disk
+        """
+        self._maxSize = maxSize
+        self._cacheDir = cacheDir
+        self._maxDiskSize = maxDiskSize
+        self._entryDict = {} # key: (kernel, kernelSum)
+        self._keyList = [] # keys in entryDict, least recently used first
+        if self._cacheDir and not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+    
+    def get(self, key):
+        """Return (kernel, kernelSum) for key, or None if not cached
+        """
+        entry = self._entryDict.get(key)
+        if entry != None:
+            self._keyList.remove(key)
+            self._keyList.append(key)
+            return entry
+        if not self._cacheDir:
+            return None
+        kernelPath, sumPath = self._getPaths(key)
+        if not (os.path.exists(kernelPath) and os.path.exists(sumPath)):
+            return None
+        with file(sumPath, "r") as sumFile:
+            kernelSum = float(sumFile.read())
+        kernel = _readKernel(kernelPath)
+        os.utime(sumPath, None) # mark as recently used
+        entry = (kernel, kernelSum)
+        self._putInMemory(key, entry)
+        return entry
+    
+    def put(self, key, kernel, kernelSum):
+        """Add a kernel and kernel sum to the cache
+        """
+        entry = (kernel, kernelSum)
+        self._putInMemory(key, entry)
+        if not self._cacheDir:
+            return
+        kernelPath, sumPath = self._getPaths(key)
+        tempKernelPath = kernelPath + ".tmp%d" % (os.getpid(),)
+        tempSumPath = sumPath + ".tmp%d" % (os.getpid(),)
+        _writeKernel(kernel, tempKernelPath)
+        with file(tempSumPath, "w") as sumFile:
+            sumFile.write(repr(kernelSum))
+        # rename the sum last; an entry is only valid once its sum file exists
+        os.rename(tempKernelPath, kernelPath)
+        os.rename(tempSumPath, sumPath)
+        self._trimDisk()
+    
+    def _putInMemory(self, key, entry):
+        if self._maxSize <= 0:
+            return
+        if key in self._entryDict:
+            self._keyList.remove(key)
+        self._entryDict[key] = entry
+        self._keyList.append(key)
+        while len(self._keyList) > self._maxSize:
+            del self._entryDict[self._keyList.pop(0)]
+    
+    def _getPaths(self, key):
+        basePath = os.path.join(self._cacheDir, key)
+        return basePath + ".boost", basePath + ".sum"
+    
+    def _trimDisk(self):
+        """Remove least recently used entries from disk until there are at most maxDiskSize"""
+        sumPathList = glob.glob(os.path.join(self._cacheDir, "*.sum"))
+        numToRemove = len(sumPathList) - self._maxDiskSize
+        if numToRemove <= 0:
+            return
+        sumPathList.sort(key = os.path.getmtime)
+        for sumPath in sumPathList[0:numToRemove]:
+            kernelPath = os.path.splitext(sumPath)[0] + ".boost"
+            for path in (sumPath, kernelPath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass # another process may have removed it already
+
+def _writeKernel(kernel, path):
+    """Persist a kernel to a file using BoostStorage"""
+    persistence = dafPersist.Persistence.getPersistence(pexPolicy.Policy())
+    storageList = dafPersist.StorageList()
+    storageList.append(persistence.getPersistStorage("BoostStorage", dafPersist.LogicalLocation(path)))
+    persistence.persist(kernel, storageList, dafBase.PropertySet())
+
+def _readKernel(path):
+    """Retrieve a kernel persisted by _writeKernel"""
+    persistence = dafPersist.Persistence.getPersistence(pexPolicy.Policy())
+    storageList = dafPersist.StorageList()
+    storageList.append(persistence.getRetrieveStorage("BoostStorage", dafPersist.LogicalLocation(path)))
+    kernelPtr = persistence.unsafeRetrieve("Kernel", storageList, dafBase.PropertySet())
+    return afwMath.Kernel.swigConvert(kernelPtr)
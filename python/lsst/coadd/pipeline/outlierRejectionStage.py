@@ -20,11 +20,18 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import os
+import shutil
+import tempfile
+
 from lsst.pex.logging import Log
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.utils as coaddUtils
 import baseStage
+import parallelUtils
+import stackCube
+import tileUtils
 
 class OutlierRejectionStageParallel(baseStage.ParallelStage):
     """
@@ -39,9 +46,22 @@ class OutlierRejectionStageParallel(baseStage.ParallelStage):
       - use mean or median? (else always median)
     - weight vector (a std::vector of doubles); I'd like this to be optional
         so if length = 0 then create a vector of 1.0 else require length to be correct
+
+    If outlierRejectionPolicy.tileWidth or tileHeight is positive then the coadd is computed
+    one tile at a time and the tiles are stitched together. If the inputs are supplied
+    as maskedImagePathList (instead of maskedImageList) then each tile is read from disk as needed,
+    so peak memory is roughly one tile times the number of inputs. Inputs may also be supplied
+    as stackCubePath: the path of a stackCube.StackCube, from which tiles are read
+    through a memory map.
+    
+    If outlierRejectionPolicy.numWorkers > 1 then tiles are processed concurrently
+    by a pool of threads or processes (see outlierRejectionPolicy.workerType).
+    Each output pixel depends only on the input pixels at the same position,
+    so the result is identical to the serial result.
     """
     packageName = "coadd_pipeline"
     policyDictionaryName = "OutlierRejectionStageDictionary.paf"
+    metricsInputKeys = ("maskedImageList",)
     def process(self, clipboard):
         """Reject outliers"""
 #         print "***** process ******"
@@ -49,27 +69,149 @@ class OutlierRejectionStageParallel(baseStage.ParallelStage):
 #         for key in clipboard.getKeys():
 #             print "*", key
 
-        maskedImageList = self.getFromClipboard(clipboard, "maskedImageList")
-        print "maskedImageList =", maskedImageList
+        maskedImageList = self.getFromClipboard(clipboard, "maskedImageList", doRaise=False)
+        stackCubePath = self.getFromClipboard(clipboard, "stackCubePath", doRaise=False)
+        maskedImagePathList = self.getFromClipboard(clipboard, "maskedImagePathList", doRaise=False)
+        if maskedImageList == None and stackCubePath == None and maskedImagePathList == None:
+            raise KeyError("Could not find inputKeys.maskedImageList, inputKeys.stackCubePath "
+                "or inputKeys.maskedImagePathList on clipboard")
         weightList = self.getFromClipboard(clipboard, "weightList", doRaise=False)
         outlierRejectionPolicy = self.policy.get("outlierRejectionPolicy")
+        statsArgs = (
+            outlierRejectionPolicy.get("numSigma"),
+            outlierRejectionPolicy.get("numIterations"),
+            outlierRejectionPolicy.get("allowedMaskPlanes"),
+        )
+        tileWidth = outlierRejectionPolicy.get("tileWidth")
+        tileHeight = outlierRejectionPolicy.get("tileHeight")
+        numWorkers = outlierRejectionPolicy.get("numWorkers")
+        workerType = outlierRejectionPolicy.get("workerType")
+        if workerType not in ("thread", "process"):
+            raise RuntimeError("Unknown outlierRejectionPolicy.workerType=%r; must be thread or process" % \
+                (workerType,))
         
-        allowedMaskPlanes = outlierRejectionPolicy.get("allowedMaskPlanes")
-        badPixelMask = coaddUtils.makeBitMask(allowedMaskPlanes.split(), doInvert=True)
+        if maskedImageList != None:
+            print "maskedImageList =", maskedImageList
+            if workerType == "process" and numWorkers > 1:
+                raise RuntimeError("outlierRejectionPolicy.workerType=process requires "
+                    "stackCubePath or maskedImagePathList")
+            if numWorkers > 1 and tileWidth <= 0 and tileHeight <= 0:
+                # split into row bands, one per worker, so there is something to run in parallel
+                tileHeight = -(-maskedImageList[0].getHeight() // numWorkers)
+            if tileWidth <= 0 and tileHeight <= 0:
+                coadd = _stack(maskedImageList, _makeStatisticsControl(*statsArgs), weightList)
+                self.addToClipboard(clipboard, "coadd", coadd)
+                return
+            width = maskedImageList[0].getWidth()
+            height = maskedImageList[0].getHeight()
+            def getTileList(bbox):
+                return afwImage.vectorMaskedImageF(
+                    [afwImage.MaskedImageF(maskedImage, bbox) for maskedImage in maskedImageList])
+            source = None
+        elif stackCubePath != None:
+            cube = stackCube.StackCube(stackCubePath)
+            width, height = cube.width, cube.height
+            if numWorkers > 1 and tileWidth <= 0 and tileHeight <= 0:
+                tileHeight = -(-height // numWorkers)
+            getTileList = cube.getTileList
+            source = stackCubePath
+        else:
+            width, height = tileUtils.getMaskedImageDimensions(maskedImagePathList[0])
+            if numWorkers > 1 and tileWidth <= 0 and tileHeight <= 0:
+                tileHeight = -(-height // numWorkers)
+            def getTileList(bbox):
+                return afwImage.vectorMaskedImageF(
+                    [tileUtils.readMaskedImageTile(path, bbox) for path in maskedImagePathList])
+            source = list(maskedImagePathList)
 
-        statsControl = afwMath.StatisticsControl()
-        statsControl.setNumSigmaClip(outlierRejectionPolicy.get("numSigma"))
-        statsControl.setNumIter(outlierRejectionPolicy.get("numIterations"))
-        statsControl.setAndMask(badPixelMask)
-        statsControl.setNanSafe(False) # we're using masked images, so no need for NaN detection
-        statsControl.setWeighted(True)
+        tileBBoxList = tileUtils.makeTileBBoxList(width, height, tileWidth, tileHeight)
+        self.log.log(Log.INFO, "Reject outliers in %d tiles using %d %s worker(s)" % \
+            (len(tileBBoxList), max(numWorkers, 1), workerType))
+        coadd = afwImage.MaskedImageF(width, height)
+        if workerType == "process" and numWorkers > 1:
+            self._stackTilesInProcesses(coadd, tileBBoxList, source, statsArgs, weightList, numWorkers)
+        else:
+            statsControl = _makeStatisticsControl(*statsArgs)
+            def stackTile(tileBBox):
+                tileCoadd = _stack(getTileList(tileBBox), statsControl, weightList)
+                subCoadd = afwImage.MaskedImageF(coadd, tileBBox)
+                subCoadd <<= tileCoadd
+            parallelUtils.runInThreads(stackTile, tileBBoxList, numWorkers)
+
+        self.addToClipboard(clipboard, "coadd", coadd)
+    
+    def _stackTilesInProcesses(self, coadd, tileBBoxList, source, statsArgs, weightList, numWorkers):
+        """Compute the tiles of the coadd in a pool of processes and stitch them into coadd
         
+        Each process reads its tile of each input from disk (source is a list of masked image paths
+        or the path of a stack cube) and writes its tile of the coadd to a scratch directory,
+        since afw images cannot be pickled.
+        """
         if weightList != None:
-            coadd = afwMath.statisticsStack(maskedImageList, afwMath.MEANCLIP, statsControl, weightList)
+            weightArgs = (list(weightList), weightList.__class__)
         else:
-            coadd = afwMath.statisticsStack(maskedImageList, afwMath.MEANCLIP, statsControl)
+            weightArgs = None
+        scratchDir = tempfile.mkdtemp(prefix="outlierRejection")
+        try:
+            argList = []
+            for ind, tileBBox in enumerate(tileBBoxList):
+                bboxArgs = (tileBBox.getX0(), tileBBox.getY0(), tileBBox.getWidth(), tileBBox.getHeight())
+                tilePath = os.path.join(scratchDir, "tile%d" % (ind,))
+                argList.append((source, bboxArgs, statsArgs, weightArgs, tilePath))
+            tilePathList = parallelUtils.runInProcesses(_stackTileFromDisk, argList, numWorkers)
+            for tileBBox, tilePath in zip(tileBBoxList, tilePathList):
+                subCoadd = afwImage.MaskedImageF(coadd, tileBBox)
+                subCoadd <<= afwImage.MaskedImageF(tilePath)
+        finally:
+            shutil.rmtree(scratchDir)
 
-        self.addToClipboard(clipboard, "coadd", coadd)
+def _makeStatisticsControl(numSigma, numIterations, allowedMaskPlanes):
+    """Make an afwMath.StatisticsControl for outlier rejection"""
+    badPixelMask = coaddUtils.makeBitMask(allowedMaskPlanes.split(), doInvert=True)
+
+    statsControl = afwMath.StatisticsControl()
+    statsControl.setNumSigmaClip(numSigma)
+    statsControl.setNumIter(numIterations)
+    statsControl.setAndMask(badPixelMask)
+    statsControl.setNanSafe(False) # we're using masked images, so no need for NaN detection
+    statsControl.setWeighted(True)
+    return statsControl
+
+def _stack(maskedImageList, statsControl, weightList):
+    """Compute the outlier-rejected mean of a list of masked images"""
+    if weightList != None:
+        return afwMath.statisticsStack(maskedImageList, afwMath.MEANCLIP, statsControl, weightList)
+    else:
+        return afwMath.statisticsStack(maskedImageList, afwMath.MEANCLIP, statsControl)
+
+def _stackTileFromDisk(args):
+    """Compute one tile of the outlier-rejected mean in a worker process
+    
+    Inputs (packed into one tuple so this can be used with parallelUtils.runInProcesses):
+    - source: list of paths to the input masked images, or the path of a stack cube
+    - bboxArgs: x0, y0, width, height of the tile
+    - statsArgs: arguments for _makeStatisticsControl
+    - weightArgs: None or (list of weights, class of weight vector)
+    - tilePath: path to which to write the tile of the coadd
+    
+    @return tilePath
+    """
+    source, bboxArgs, statsArgs, weightArgs, tilePath = args
+    x0, y0, width, height = bboxArgs
+    tileBBox = afwImage.BBox(afwImage.PointI(x0, y0), width, height)
+    if isinstance(source, basestring):
+        tileList = stackCube.StackCube(source).getTileList(tileBBox)
+    else:
+        tileList = afwImage.vectorMaskedImageF(
+            [tileUtils.readMaskedImageTile(path, tileBBox) for path in source])
+    if weightArgs != None:
+        weights, weightListClass = weightArgs
+        weightList = weightListClass(weights)
+    else:
+        weightList = None
+    tileCoadd = _stack(tileList, _makeStatisticsControl(*statsArgs), weightList)
+    tileCoadd.writeFits(tilePath)
+    return tilePath
 
 # this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
 class OutlierRejectionStage(baseStage.Stage):
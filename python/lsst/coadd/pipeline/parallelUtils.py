@@ -0,0 +1,154 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Utilities for running independent tasks in a pool of threads or processes
+"""
+import multiprocessing
+import Queue
+import sys
+import threading
+
+def runInThreads(func, argList, numThreads):
+    """Call func(arg) for each arg in argList using a pool of threads
+    
+    Inputs:
+    - func: function to call; it must take exactly one argument
+    - argList: list of arguments, one per call
+    - numThreads: maximum number of threads; if <= 1 then func is simply called serially
+    
+    @return a list of results, in the same order as argList
+    @raise the first exception raised by func (in the calling thread, with the original traceback);
+        once an exception is raised no new calls are started.
+    """
+    argList = list(argList)
+    if numThreads <= 1 or len(argList) <= 1:
+        return [func(arg) for arg in argList]
+
+    resultList = [None] * len(argList)
+    excInfoList = []
+    taskQueue = Queue.Queue()
+    for ind, arg in enumerate(argList):
+        taskQueue.put((ind, arg))
+
+    def worker():
+        while not excInfoList:
+            try:
+                ind, arg = taskQueue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                resultList[ind] = func(arg)
+            except Exception:
+                excInfoList.append(sys.exc_info())
+
+    threadList = [threading.Thread(target=worker) for i in range(min(numThreads, len(argList)))]
+    for thread in threadList:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threadList:
+        thread.join()
+
+    if excInfoList:
+        excType, excValue, excTraceback = excInfoList[0]
+        raise excType, excValue, excTraceback
+    return resultList
+
+def runInProcesses(func, argList, numProcesses):
+    """Call func(arg) for each arg in argList using a pool of processes
+    
+    Inputs:
+    - func: function to call; it must take exactly one argument and be defined at module level
+        (so that it can be pickled)
+    - argList: list of arguments, one per call; each must be picklable, as must each result
+    - numProcesses: maximum number of processes; if <= 1 then func is simply called serially
+    
+    @return a list of results, in the same order as argList
+    """
+    argList = list(argList)
+    if numProcesses <= 1 or len(argList) <= 1:
+        return [func(arg) for arg in argList]
+
+    pool = multiprocessing.Pool(min(numProcesses, len(argList)))
+    try:
+        resultList = pool.map(func, argList, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return resultList
+
+def prefetch(func, argList, numAhead):
+    """Iterate over func(arg) for each arg in argList, computing up to numAhead results ahead
+    in a background thread
+    
+    Intended for reading (and preprocessing) input files while the caller processes the previous one.
+    At most numAhead + 1 results are held at one time (numAhead queued plus one being computed).
+    
+    Inputs:
+    - func: function to call; it must take exactly one argument
+    - argList: list of arguments, one per call
+    - numAhead: maximum number of results to compute ahead; if <= 0 then func is simply called
+        as each result is wanted
+    
+    @return a generator of (arg, func(arg)), in the same order as argList
+    @raise the exception raised by func (in the calling thread, with the original traceback)
+        when the corresponding result is reached; no further calls are made.
+    """
+    argList = list(argList)
+    if numAhead <= 0:
+        for arg in argList:
+            yield arg, func(arg)
+        return
+
+    resultQueue = Queue.Queue(numAhead)
+    stopEvent = threading.Event()
+    
+    def worker():
+        for arg in argList:
+            if stopEvent.isSet():
+                return
+            try:
+                item = (arg, func(arg), None)
+            except Exception:
+                item = (arg, None, sys.exc_info())
+            # wait for room, but give up if the consumer has stopped
+            while not stopEvent.isSet():
+                try:
+                    resultQueue.put(item, True, 0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if item[2] != None:
+                return
+    
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        for i in range(len(argList)):
+            arg, result, excInfo = resultQueue.get()
+            if excInfo != None:
+                excType, excValue, excTraceback = excInfo
+                raise excType, excValue, excTraceback
+            yield arg, result
+    finally:
+        stopEvent.set()
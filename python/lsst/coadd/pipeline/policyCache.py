@@ -0,0 +1,88 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Process-wide cache of parsed policy dictionaries
+
+Parsing a stage policy dictionary (and the dictionaries it references, e.g. @@coadd_utils:...)
+is a measurable share of the startup time of a short-lived stage, so each dictionary is parsed once
+per process and shared. A cached dictionary is reparsed if the modification time
+of its (top-level) file changes; changes to referenced dictionaries alone are not noticed.
+
+Cached dictionaries are shared and must not be modified.
+"""
+import os
+import threading
+
+import lsst.pex.policy as pexPolicy
+
+_dictionaryCache = {} # (packageName, dictionaryName): (mtime, dictionary)
+_cacheLock = threading.Lock()
+
+def getPolicyDictionary(packageName, dictionaryName):
+    """Return a policy dictionary, parsing it only if it is not cached or its file has changed
+    
+    Inputs:
+    - packageName: name of package containing the dictionary, e.g. "coadd_pipeline"
+    - dictionaryName: name of dictionary file in the package's policy directory,
+        e.g. "WarpExposureStageDictionary.paf"
+    
+    @return the dictionary (a pexPolicy.Dictionary); do not modify it
+    """
+    policyFile = pexPolicy.DefaultPolicyFile(packageName, dictionaryName, "policy")
+    try:
+        mtime = os.path.getmtime(policyFile.getPath())
+    except OSError:
+        mtime = None
+    cacheKey = (packageName, dictionaryName)
+    _cacheLock.acquire()
+    try:
+        cachedMTime, dictionary = _dictionaryCache.get(cacheKey, (None, None))
+        if dictionary is None or mtime is None or cachedMTime != mtime:
+            defPolicy = pexPolicy.Policy.createPolicy(policyFile, policyFile.getRepositoryPath(), True)
+            dictionary = defPolicy.getDictionary()
+            _dictionaryCache[cacheKey] = (mtime, dictionary)
+        return dictionary
+    finally:
+        _cacheLock.release()
+
+def mergeDefaults(policy, packageName, dictionaryName):
+    """Merge defaults from a (cached) policy dictionary into a policy
+    
+    Inputs:
+    - policy: policy into which to merge defaults; if None then a new empty policy is used
+    - packageName, dictionaryName: see getPolicyDictionary
+    
+    @return policy with defaults merged
+    """
+    if policy is None:
+        policy = pexPolicy.Policy()
+    policy.mergeDefaults(getPolicyDictionary(packageName, dictionaryName))
+    return policy
+
+def clearCache():
+    """Discard all cached dictionaries"""
+    _cacheLock.acquire()
+    try:
+        _dictionaryCache.clear()
+    finally:
+        _cacheLock.release()
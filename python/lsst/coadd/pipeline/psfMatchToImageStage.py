@@ -20,10 +20,23 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-import lsst.coadd.psfmatched as coaddPsfMatch
+from lsst.pex.logging import Log
+import lsst.ip.diffim as ipDiffim
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
+import lsst.coadd.utils as coaddUtils
 import baseStage
+import fftConvolve
+import kernelCache
+import parallelUtils
+import psfMoments
+import warpGeometry
+
+# values of psfMatchingPath
+FastPath = "fastPath"       # PSFs nearly identical; scaled by the flux ratio
+CachePath = "cache"         # kernel found in the kernel cache
+SolvePath = "solve"         # kernel solved for
+NoOverlapPath = "noOverlap" # exposure does not overlap the reference exposure; nothing psf-matched
 
 class PsfMatchStageParallel(baseStage.ParallelStage):
     """
@@ -31,16 +44,55 @@ class PsfMatchStageParallel(baseStage.ParallelStage):
     
     The input exposures must have the same WCS to get reasonable results. This is NOT checked.
     
+    If kernelCacheSize > 0 or kernelCacheDir is specified then psf-matching kernels are cached,
+    keyed on a hash of warpedExposure and referenceExposure (every pixel, WCS and metadata)
+    and psfMatchToImagePolicy.
+    On a cache hit the kernel is not solved for; warpedExposure is simply convolved with the cached kernel.
+    
+    If restrictToOverlap is true (it is false by default) and overlapBBox (as output by WarpExposureStage)
+    is on the clipboard then only that region of warpedExposure is psf-matched; the rest
+    of psfMatchedExposure is masked as no-data (EDGE). If the region is empty then no psf-matching is done
+    and psfMatchingKernel is None.
+    
+    A new kernel is solved for by ip_diffim (createPsfMatchingKernel with psfMatchToImagePolicy)
+    without convolving; the solve never depends on numThreads or convolutionPolicy. The stage then
+    convolves warpedExposure with the kernel itself, whether it was solved for, found in the kernel cache
+    or made by the fast path:
+    - Large spatially invariant kernels are convolved using FFTs (see convolutionPolicy and fftConvolve);
+      this matches direct convolution to within round-off.
+    - Otherwise, if numThreads > 1, the convolution is split into horizontal strips that are convolved
+      by a pool of numThreads threads. The result is bit-identical to a single convolution.
+    The background model that ip_diffim fits along with the kernel is not applied;
+    the input exposures are background-subtracted.
+    
+    If fastPathPolicy.enabled is true then the PSFs of the two exposures are first compared using
+    the second moments of a small sample of stars. If they agree to within fastPathPolicy.maxPsfDifference
+    then no kernel is solved for: the exposure is simply scaled by the median flux ratio of the stars
+    (psfMatchingKernel is a 1x1 kernel with that value). psfMatchingPath reports which path was taken.
+    
     @todo: modify to psf-match one exposure to a psf model instead of another exposure.
     """
     packageName = "coadd_pipeline"
     policyDictionaryName = "PsfMatchToImageStageDictionary.paf"
+    metricsInputKeys = ("warpedExposure",)
     
     def setup(self):
         baseStage.ParallelStage.setup(self)
         
-        psfMatchToImagePolicy = self.policy.getPolicy("psfMatchToImagePolicy")
-        self.matcher = coaddPsfMatch.PsfMatchToImage(psfMatchToImagePolicy)
+        self.psfMatchToImagePolicy = self.policy.getPolicy("psfMatchToImagePolicy")
+        
+        self.kernelCache = None
+        kernelCacheSize = self.policy.get("kernelCacheSize")
+        kernelCacheDir = self.policy.get("kernelCacheDir")
+        if kernelCacheSize > 0 or kernelCacheDir:
+            self.kernelCache = kernelCache.KernelCache(kernelCacheSize, kernelCacheDir,
+                self.policy.get("kernelCacheDiskSize"))
+        self.restrictToOverlap = self.policy.get("restrictToOverlap")
+        self.fastPathPolicy = self.policy.getPolicy("fastPathPolicy")
+        self.fastPathBadPixelMask = coaddUtils.makeBitMask(
+            self.fastPathPolicy.get("allowedMaskPlanes").split(), doInvert=True)
+        self.numThreads = self.policy.get("numThreads")
+        self.convolutionPolicy = self.policy.getPolicy("convolutionPolicy")
 
     def process(self, clipboard):
         """Psf-match exposure to referenceExposure"""
@@ -51,14 +103,199 @@ class PsfMatchStageParallel(baseStage.ParallelStage):
 
         warpedExposure = self.getFromClipboard(clipboard, "warpedExposure")
         referenceExposure = self.getFromClipboard(clipboard, "referenceExposure")
+        overlapBBox = None
+        if self.restrictToOverlap:
+            overlapBBox = self.getFromClipboard(clipboard, "overlapBBox", doRaise=False)
         
-        psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum = self.matcher.matchExposure(
-            warpedExposure, referenceExposure.getMaskedImage())
+        fullBBox = coaddUtils.bboxFromImage(warpedExposure)
+        if overlapBBox == None or warpGeometry.isSameBBox(overlapBBox, fullBBox):
+            psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, psfMatchingPath = \
+                self.matchExposure(warpedExposure, referenceExposure)
+        elif overlapBBox.getWidth() == 0 or overlapBBox.getHeight() == 0:
+            self.log.log(Log.INFO, "Exposure does not overlap the reference exposure; nothing to psf-match")
+            psfMatchedExposure = warpGeometry.embedExposure(None, fullBBox, warpedExposure.getWcs())
+            psfMatchingKernel = None
+            psfMatchingKernelSum = 0.0
+            psfMatchingPath = NoOverlapPath
+        else:
+            self.log.log(Log.INFO, "Psf-match the %dx%d overlap of the %dx%d exposure" % \
+                (overlapBBox.getWidth(), overlapBBox.getHeight(), fullBBox.getWidth(), fullBBox.getHeight()))
+            subBBox = warpGeometry.getRelativeBBox(overlapBBox, fullBBox)
+            subPsfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, psfMatchingPath = \
+                self.matchExposure(afwImage.ExposureF(warpedExposure, subBBox),
+                    afwImage.ExposureF(referenceExposure, subBBox))
+            psfMatchedExposure = warpGeometry.embedExposure(subPsfMatchedExposure, fullBBox,
+                warpedExposure.getWcs())
 
         self.addToClipboard(clipboard, "psfMatchedExposure", psfMatchedExposure)
         self.addToClipboard(clipboard, "psfMatchingKernel", psfMatchingKernel)
         self.addToClipboard(clipboard, "psfMatchingKernelSum", psfMatchingKernelSum)
+        self.addToClipboard(clipboard, "psfMatchingPath", psfMatchingPath)
+    
+    def matchExposure(self, warpedExposure, referenceExposure):
+        """Psf-match warpedExposure to referenceExposure, using the fast path and kernel cache if enabled
+        
+        The two exposures must have the same bounding box.
+        
+        @return psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, psfMatchingPath
+            (one of FastPath, CachePath or SolvePath)
+        """
+        if self.fastPathPolicy.get("enabled"):
+            fluxRatio = self.checkFastPath(warpedExposure, referenceExposure)
+            if fluxRatio != None:
+                psfMatchingKernel = afwMath.FixedKernel(afwImage.ImageD(1, 1, fluxRatio))
+                psfMatchedExposure = convolveExposure(warpedExposure, psfMatchingKernel, self.numThreads)
+                return psfMatchedExposure, psfMatchingKernel, fluxRatio, FastPath
+
+        cacheKey = None
+        if self.kernelCache != None:
+            cacheKey = kernelCache.makeCacheKey(warpedExposure, referenceExposure,
+                self.psfMatchToImagePolicy)
+            cacheEntry = self.kernelCache.get(cacheKey)
+            if cacheEntry != None:
+                psfMatchingKernel, psfMatchingKernelSum = cacheEntry
+                psfMatchedExposure = self.applyKernel(warpedExposure, psfMatchingKernel,
+                    "Found psf-matching kernel in cache")
+                return psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, CachePath
+
+        psfMatchingKernel, psfMatchingKernelSum = self.solveKernel(warpedExposure, referenceExposure)
+        psfMatchedExposure = self.applyKernel(warpedExposure, psfMatchingKernel,
+            "Solved for psf-matching kernel")
+        if cacheKey != None:
+            self.kernelCache.put(cacheKey, psfMatchingKernel, psfMatchingKernelSum)
+        return psfMatchedExposure, psfMatchingKernel, psfMatchingKernelSum, SolvePath
+    
+    def applyKernel(self, warpedExposure, psfMatchingKernel, descr):
+        """Convolve warpedExposure with psfMatchingKernel using FFTs or numThreads threads,
+        as selected by convolutionPolicy, and log how
+        
+        @return the psf-matched exposure
+        """
+        if useFftConvolution(psfMatchingKernel, self.convolutionPolicy):
+            self.log.log(Log.INFO, "%s; convolve %dx%d kernel using FFTs" % \
+                (descr, psfMatchingKernel.getWidth(), psfMatchingKernel.getHeight()))
+        else:
+            self.log.log(Log.INFO, "%s; convolve using %d threads" % (descr, max(self.numThreads, 1)))
+        return convolveExposure(warpedExposure, psfMatchingKernel, self.numThreads, self.convolutionPolicy)
+    
+    def checkFastPath(self, warpedExposure, referenceExposure):
+        """Compare the PSFs of warpedExposure and referenceExposure using a small sample of stars
+        
+        @return the flux ratio (reference / warped) if the PSFs agree to within
+            fastPathPolicy.maxPsfDifference, else None
+        """
+        psfDifference, fluxRatio, numStars = psfMoments.comparePsfs(
+            warpedExposure.getMaskedImage(), referenceExposure.getMaskedImage(),
+            self.fastPathPolicy.get("numStars"), self.fastPathPolicy.get("minNumStars"),
+            self.fastPathPolicy.get("detectionThreshold"), self.fastPathPolicy.get("stampHalfSize"),
+            self.fastPathBadPixelMask)
+        if psfDifference == None:
+            self.log.log(Log.INFO, "Only %d stars measured; solve for psf-matching kernel" % (numStars,))
+            return None
+        if psfDifference > self.fastPathPolicy.get("maxPsfDifference") or not fluxRatio > 0:
+            self.log.log(Log.INFO, "PSFs differ by %0.3f (%d stars); solve for psf-matching kernel" % \
+                (psfDifference, numStars))
+            return None
+        self.log.log(Log.INFO, "PSFs differ by %0.3f (%d stars); scale by flux ratio %0.4f" % \
+            (psfDifference, numStars, fluxRatio))
+        return fluxRatio
+    
+    def solveKernel(self, warpedExposure, referenceExposure):
+        """Solve for the kernel that psf-matches warpedExposure to referenceExposure, without convolving
+        
+        The two exposures must have the same bounding box.
         
+        @return psfMatchingKernel, psfMatchingKernelSum
+            (the sum of the kernel at the center of warpedExposure)
+        """
+        maskedImage = warpedExposure.getMaskedImage()
+        psfMatchingKernel, backgroundModel, kernelCellSet = ipDiffim.createPsfMatchingKernel(
+            maskedImage, referenceExposure.getMaskedImage(), self.psfMatchToImagePolicy)
+        kernelImage = afwImage.ImageD(psfMatchingKernel.getWidth(), psfMatchingKernel.getHeight())
+        psfMatchingKernelSum = psfMatchingKernel.computeImage(kernelImage, False,
+            maskedImage.getX0() + (maskedImage.getWidth() / 2.0),
+            maskedImage.getY0() + (maskedImage.getHeight() / 2.0))
+        return psfMatchingKernel, psfMatchingKernelSum
+
+def convolveExposure(exposure, kernel, numThreads=1, convolutionPolicy=None):
+    """Convolve an exposure with a psf-matching kernel
+    
+    The kernel is not normalized, so the result is scaled by the kernel sum.
+    
+    If convolutionPolicy is specified (see ConvolutionDictionary.paf) and selects FFT convolution
+    for this kernel (see useFftConvolution) then fftConvolve.fftConvolve is used and numThreads is ignored.
+    
+    If numThreads > 1 then the exposure is split into horizontal strips (one per thread),
+    each of which is grown by the kernel's extent, convolved and trimmed back to the strip.
+    Every output pixel sees the same input pixels as in a single convolution of the whole exposure,
+    so the result is bit-identical (spatially varying kernels are evaluated in parent coordinates,
+    which are preserved by the sub-images).
+    
+    @return the convolved exposure, which has the same xy0 and WCS as exposure
+    """
+    maskedImage = exposure.getMaskedImage()
+    convolvedMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+    convolvedMaskedImage.setXY0(maskedImage.getXY0())
+    if useFftConvolution(kernel, convolutionPolicy):
+        fftConvolve.fftConvolve(convolvedMaskedImage, maskedImage, kernel,
+            convolutionPolicy.get("fftBlockSize"))
+        return afwImage.makeExposure(convolvedMaskedImage, exposure.getWcs())
+
+    stripList = makeStripList(maskedImage.getHeight(), kernel, numThreads)
+    if len(stripList) <= 1:
+        afwMath.convolve(convolvedMaskedImage, maskedImage, kernel, False)
+        return afwImage.makeExposure(convolvedMaskedImage, exposure.getWcs())
+
+    width = maskedImage.getWidth()
+    def convolveStrip(strip):
+        y0, y1, paddedY0, paddedY1 = strip
+        paddedMaskedImage = afwImage.MaskedImageF(maskedImage,
+            afwImage.BBox(afwImage.PointI(0, paddedY0), width, paddedY1 - paddedY0))
+        convolvedPaddedMaskedImage = afwImage.MaskedImageF(width, paddedY1 - paddedY0)
+        convolvedPaddedMaskedImage.setXY0(paddedMaskedImage.getXY0())
+        afwMath.convolve(convolvedPaddedMaskedImage, paddedMaskedImage, kernel, False)
+        convolvedStrip = afwImage.MaskedImageF(convolvedMaskedImage,
+            afwImage.BBox(afwImage.PointI(0, y0), width, y1 - y0))
+        convolvedStrip <<= afwImage.MaskedImageF(convolvedPaddedMaskedImage,
+            afwImage.BBox(afwImage.PointI(0, y0 - paddedY0), width, y1 - y0))
+    parallelUtils.runInThreads(convolveStrip, stripList, numThreads)
+    return afwImage.makeExposure(convolvedMaskedImage, exposure.getWcs())
+
+def useFftConvolution(kernel, convolutionPolicy):
+    """Return True if kernel should be convolved using FFTs according to convolutionPolicy
+    
+    @raise RuntimeError if convolutionPolicy.mode is not one of "auto", "direct" or "fft"
+    """
+    if convolutionPolicy == None:
+        return False
+    mode = convolutionPolicy.get("mode")
+    if mode == "direct":
+        return False
+    elif mode == "fft":
+        return True
+    elif mode == "auto":
+        return not kernel.isSpatiallyVarying() \
+            and max(kernel.getWidth(), kernel.getHeight()) >= convolutionPolicy.get("fftMinKernelSize")
+    raise RuntimeError("Unknown convolutionPolicy.mode=%r; must be auto, direct or fft" % (mode,))
+
+def makeStripList(height, kernel, numStrips):
+    """Divide the rows of an image into strips for convolution by kernel
+    
+    Strips are at least as tall as the kernel; fewer than numStrips are returned if the image is too short.
+    
+    @return a list of (y0, y1, paddedY0, paddedY1): the strip is rows [y0, y1);
+        the rows [paddedY0, paddedY1) of the input image are needed to convolve it
+    """
+    numStrips = max(1, min(numStrips, height // max(kernel.getHeight(), 1)))
+    stripList = []
+    for i in range(numStrips):
+        y0 = (height * i) // numStrips
+        y1 = (height * (i + 1)) // numStrips
+        paddedY0 = max(0, y0 - kernel.getCtrY())
+        paddedY1 = min(height, y1 + kernel.getHeight() - 1 - kernel.getCtrY())
+        stripList.append((y0, y1, paddedY0, paddedY1))
+    return stripList
+
 # this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
 class PsfMatchStage(baseStage.Stage):
     parallelClass = PsfMatchStageParallel
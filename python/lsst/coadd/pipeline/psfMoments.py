@@ -0,0 +1,172 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Compare the PSFs of two aligned exposures using the second moments of a small sample of stars
+
+This is a cheap test for whether psf-matching one exposure to another is nearly the identity
+(apart from a flux scaling), so that the full kernel solution can be skipped.
+"""
+from __future__ import with_statement
+
+import numpy
+
+def findStars(maskedImage, numStars, threshold, halfSize, badPixelMask):
+    """Find the brightest isolated, unmasked point-like peaks in a masked image
+    
+    Inputs:
+    - maskedImage: masked image (afwImage.MaskedImageF)
+    - numStars: maximum number of stars to return
+    - threshold: minimum peak signal-to-noise ratio (image / sqrt(variance))
+    - halfSize: stars are measured in (2*halfSize+1)^2 stamps; a peak is rejected if its stamp
+        extends past the image, contains a pixel with any bit of badPixelMask set,
+        or contains a brighter peak
+    - badPixelMask: mask bits that disqualify a stamp
+    
+    @return a list of (x, y) array indices, brightest first
+    """
+    image = maskedImage.getImage().getArray()
+    variance = maskedImage.getVariance().getArray()
+    mask = maskedImage.getMask().getArray()
+    height, width = image.shape
+    if width <= 2 * halfSize or height <= 2 * halfSize:
+        return []
+    
+    center = image[1:-1, 1:-1]
+    isPeak = numpy.ones(center.shape, dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx or dy:
+                isPeak &= center > image[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        isPeak &= center > threshold * numpy.sqrt(variance[1:-1, 1:-1])
+    peakY, peakX = numpy.nonzero(isPeak)
+    peakY += 1
+    peakX += 1
+    order = numpy.argsort(image[peakY, peakX])[::-1]
+    
+    # isolation: no brighter peak within the stamp; only check the brightest few candidates
+    candidateList = list(zip(peakX[order][:numStars * 20], peakY[order][:numStars * 20]))
+    starList = []
+    for ind, (x, y) in enumerate(candidateList):
+        if x < halfSize or y < halfSize or x >= width - halfSize or y >= height - halfSize:
+            continue
+        if (mask[y - halfSize:y + halfSize + 1, x - halfSize:x + halfSize + 1] & badPixelMask).any():
+            continue
+        if [1 for (bx, by) in candidateList[:ind] if abs(bx - x) <= halfSize and abs(by - y) <= halfSize]:
+            continue
+        starList.append((x, y))
+        if len(starList) >= numStars:
+            break
+    return starList
+
+def measureMoments(image, x, y, halfSize, weightSigma2=None, numIter=5):
+    """Measure the Gaussian-weighted second moments of a star
+    
+    Inputs:
+    - image: 2-d numpy array
+    - x, y: array indices of the peak of the star
+    - halfSize: the star is measured in a (2*halfSize+1)^2 stamp; the median of its border is the background
+    - weightSigma2: if None then the weight is adaptive (its sigma^2 is iterated to match the star's);
+        otherwise the fixed sigma^2 of the circular Gaussian weight (pixels^2)
+    - numIter: number of iterations of the centroid (and adaptive weight)
+    
+    @return flux, ixx, iyy, ixy, weightSigma2: weighted flux, second moments about the weighted centroid
+        (corrected for the weight, so that a Gaussian star of sigma s has ixx = iyy = s^2)
+        and the sigma^2 of the weight with which flux and the moments were measured;
+        ixx, iyy, ixy are None if the weighted flux is not positive
+    """
+    stamp = numpy.array(image[y - halfSize:y + halfSize + 1, x - halfSize:x + halfSize + 1], dtype=float)
+    border = numpy.concatenate((stamp[0, :], stamp[-1, :], stamp[1:-1, 0], stamp[1:-1, -1]))
+    stamp -= numpy.median(border)
+    dy, dx = numpy.mgrid[-halfSize:halfSize + 1, -halfSize:halfSize + 1].astype(float)
+    
+    isAdaptive = weightSigma2 == None
+    if isAdaptive:
+        weightSigma2 = (halfSize / 3.0)**2
+    xCtr = yCtr = 0.0
+    for i in range(numIter):
+        if i > 0 and isAdaptive and wxx > 0 and wyy > 0:
+            weightSigma2 = min(wxx + wyy, float(halfSize**2))
+        weight = numpy.exp(-0.5 * ((dx - xCtr)**2 + (dy - yCtr)**2) / weightSigma2) * stamp
+        flux = weight.sum()
+        if not flux > 0:
+            return flux, None, None, None, weightSigma2
+        xCtr = (weight * dx).sum() / flux
+        yCtr = (weight * dy).sum() / flux
+        if abs(xCtr) > halfSize or abs(yCtr) > halfSize:
+            return flux, None, None, None, weightSigma2
+        wxx = (weight * (dx - xCtr)**2).sum() / flux
+        wyy = (weight * (dy - yCtr)**2).sum() / flux
+        wxy = (weight * (dx - xCtr) * (dy - yCtr)).sum() / flux
+    
+    # for a Gaussian star of sigma^2 s2 and weight sigma^2 w2: weighted moment = s2 w2 / (s2 + w2)
+    ixx, iyy, ixy = [correctMoment(m, weightSigma2) for m in (wxx, wyy, wxy)]
+    return flux, ixx, iyy, ixy, weightSigma2
+
+def correctMoment(weightedMoment, weightSigma2):
+    """Remove the effect of a circular Gaussian weight of sigma^2 weightSigma2 from a second moment"""
+    if weightedMoment >= weightSigma2:
+        return float("inf")
+    return weightedMoment * weightSigma2 / (weightSigma2 - weightedMoment)
+
+def comparePsfs(maskedImage, referenceMaskedImage, numStars, minNumStars, threshold, halfSize, badPixelMask):
+    """Compare the PSFs of two aligned masked images of the same field
+    
+    Stars are found in referenceMaskedImage and measured at the same positions in both images.
+    
+    @return psfDifference, fluxRatio, numStars:
+    - psfDifference: the largest difference of the median ixx, iyy and ixy of the two images,
+        divided by the reference's median (ixx + iyy)/2; None if fewer than minNumStars stars were measured
+    - fluxRatio: median of reference flux / flux, measured with the reference star's weight in both images
+    - numStars: the number of stars measured in both images
+    """
+    starList = findStars(referenceMaskedImage, numStars, threshold, halfSize, badPixelMask)
+    image = maskedImage.getImage().getArray()
+    mask = maskedImage.getMask().getArray()
+    referenceImage = referenceMaskedImage.getImage().getArray()
+    momentList = []
+    referenceMomentList = []
+    fluxRatioList = []
+    for x, y in starList:
+        if (mask[y - halfSize:y + halfSize + 1, x - halfSize:x + halfSize + 1] & badPixelMask).any():
+            continue
+        refFlux, refIxx, refIyy, refIxy, weightSigma2 = measureMoments(referenceImage, x, y, halfSize)
+        flux, ixx, iyy, ixy, dumWeightSigma2 = measureMoments(image, x, y, halfSize)
+        if refIxx == None or ixx == None:
+            continue
+        fixedFlux = measureMoments(image, x, y, halfSize, weightSigma2=weightSigma2)[0]
+        if not fixedFlux > 0:
+            continue
+        momentList.append((ixx, iyy, ixy))
+        referenceMomentList.append((refIxx, refIyy, refIxy))
+        fluxRatioList.append(refFlux / fixedFlux)
+    
+    if len(momentList) < max(minNumStars, 1):
+        return None, None, len(momentList)
+    moments = numpy.median(numpy.array(momentList), axis=0)
+    referenceMoments = numpy.median(numpy.array(referenceMomentList), axis=0)
+    referenceSize = 0.5 * (referenceMoments[0] + referenceMoments[1])
+    if not 0 < referenceSize < float("inf"):
+        return None, None, len(momentList)
+    psfDifference = numpy.abs(moments - referenceMoments).max() / referenceSize
+    return psfDifference, float(numpy.median(fluxRatioList)), len(momentList)
@@ -0,0 +1,274 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import numpy
+
+from lsst.pex.logging import Log
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+import baseStage
+import parallelUtils
+
+class RobustCoaddStageParallel(baseStage.ParallelStage):
+    """
+    Pipeline stage to compute an outlier-rejected coadd one exposure (event) at a time.
+    
+    Unlike OutlierRejectionStage the stack of exposures is never held in memory; instead the stage
+    makes two passes through the exposures, keeping a few accumulator planes the size of one exposure
+    (see RobustMeanAccumulator):
+    - Pass one accumulates the running weighted mean and variance of each pixel.
+    - Pass two adds each exposure to the coadd, rejecting pixels that differ from the pass-one mean
+      by more than numSigma times the pass-one standard deviation.
+    This amounts to one iteration of sigma clipping about the mean.
+    
+    Each pass ends with an event whose isLastExposure is True. Pass two may be supplied in either of two ways:
+    - Re-streamed: the same exposures are processed again as new events (in any order).
+    - Re-read: if every pass-one event had an exposurePath on the clipboard then, after the last
+      pass-one exposure, the stage reads the exposures back from disk and completes pass two itself.
+    The coadd and weight map are output when pass two is complete; the stage then resets itself.
+    
+    All exposures must have the same dimensions and xy0; the coadd has the WCS of the first exposure.
+    """
+    packageName = "coadd_pipeline"
+    policyDictionaryName = "RobustCoaddStageDictionary.paf"
+    metricsInputKeys = ("exposure",)
+
+    def setup(self):
+        baseStage.ParallelStage.setup(self)
+        
+        self.numSigma = self.policy.get("numSigma")
+        self.minNumForClip = self.policy.get("minNumForClip")
+        self.numPrefetch = self.policy.get("numPrefetch")
+        allowedMaskPlanes = self.policy.getPolicy("coaddPolicy").get("allowedMaskPlanes")
+        self.badPixelMask = coaddUtils.makeBitMask(allowedMaskPlanes.split(), doInvert=True)
+        self.reset()
+    
+    def reset(self):
+        """Reset to the initial state: pass one of a new coadd"""
+        self.accumulator = None
+        self.passNum = 1
+        self.exposurePathList = []
+    
+    def process(self, clipboard):
+        """Add exposure to the pass-one statistics or, in pass two, to the coadd"""
+        exposure = self.getFromClipboard(clipboard, "exposure")
+        event = self.getFromClipboard(clipboard, "event")
+        
+        if self.accumulator == None:
+            self.log.log(Log.INFO, "First exposure: create accumulator")
+            self.accumulator = RobustMeanAccumulator(exposure, self.badPixelMask)
+        
+        if self.passNum == 1:
+            weight = self.accumulator.addToStatistics(exposure)
+            self.log.log(Log.INFO, "Pass one: added exposure to statistics; weight=%s" % (weight,))
+            self.exposurePathList.append(self.getFromClipboard(clipboard, "exposurePath", doRaise=False))
+            if not event.get("isLastExposure"):
+                return
+            
+            self.accumulator.computeClipLimits(self.numSigma, self.minNumForClip)
+            self.passNum = 2
+            if None in self.exposurePathList:
+                self.log.log(Log.INFO, "Last pass-one exposure: wait for the exposures to be re-streamed")
+                return
+            
+            self.log.log(Log.INFO, "Last pass-one exposure: re-read %d exposures for pass two" % \
+                (len(self.exposurePathList),))
+            for exposurePath, rereadExposure in parallelUtils.prefetch(
+                afwImage.ExposureF, self.exposurePathList, self.numPrefetch):
+                self.addToCoadd(rereadExposure)
+            self.outputCoadd(clipboard)
+        else:
+            self.addToCoadd(exposure)
+            if event.get("isLastExposure"):
+                self.outputCoadd(clipboard)
+    
+    def addToCoadd(self, exposure):
+        """Add an exposure to the coadd (pass two)"""
+        weight, numRejected = self.accumulator.addToCoadd(exposure)
+        self.log.log(Log.INFO, "Pass two: added exposure to coadd; weight=%s; rejected %d pixels" % \
+            (weight, numRejected))
+    
+    def outputCoadd(self, clipboard):
+        """Write the coadd and weight map to the clipboard and reset"""
+        if self.accumulator.numCoadded != self.accumulator.numStatistics:
+            self.log.log(Log.WARN, "Pass one had %d exposures but pass two had %d" % \
+                (self.accumulator.numStatistics, self.accumulator.numCoadded))
+        self.log.log(Log.INFO, "Last exposure: write coadd to clipboard and reset to initial state")
+        coaddExposure, weightMap = self.accumulator.getCoadd()
+        self.addToClipboard(clipboard, "coadd", coaddExposure)
+        self.addToClipboard(clipboard, "weightMap", weightMap)
+        self.addToClipboard(clipboard, "numRejected", self.accumulator.numRejected)
+        self.reset()
+
+class RobustMeanAccumulator(object):
+    """Per-pixel accumulators for a two-pass outlier-rejected weighted mean
+    
+    Pass one (addToStatistics) accumulates, for each pixel, the number of exposures, the sum of weights,
+    the weighted mean and the weighted sum of squared deviations from the mean, using West's weighted
+    form of Welford's update (which, unlike summing x and x^2, does not lose precision
+    as exposures are added). computeClipLimits then replaces these with the mean and the allowed
+    deviation from it. Pass two (addToCoadd) accumulates the weighted sum of image and variance,
+    the sum of weights and the OR of the masks of the pixels that are not rejected.
+    
+    Each exposure is weighted by 1/mean variance of its good pixels, as in CoaddGenerationStage.
+    Pixels with any mask bit in badPixelMask are ignored.
+    """
+    def __init__(self, exposure, badPixelMask):
+        """Create accumulators with the dimensions, xy0 and WCS of exposure
+        """
+        maskedImage = exposure.getMaskedImage()
+        self.width = maskedImage.getWidth()
+        self.height = maskedImage.getHeight()
+        self.x0 = maskedImage.getX0()
+        self.y0 = maskedImage.getY0()
+        self.wcs = exposure.getWcs()
+        self.badPixelMask = badPixelMask
+        self.numStatistics = 0 # number of exposures added in pass one
+        self.numCoadded = 0 # number of exposures added in pass two
+        self.numRejected = 0 # number of pixels rejected in pass two
+
+        shape = (self.height, self.width)
+        self._count = numpy.zeros(shape, dtype=numpy.int32)
+        self._weightSum = numpy.zeros(shape, dtype=numpy.float64)
+        self._mean = numpy.zeros(shape, dtype=numpy.float64)
+        self._sumSqDev = numpy.zeros(shape, dtype=numpy.float64)
+        self._clipLimit = None
+    
+    def addToStatistics(self, exposure):
+        """Add an exposure to the pass-one statistics
+        
+        @return weight of exposure (0 if it has no good pixels, in which case it is ignored)
+        """
+        if self._clipLimit is not None:
+            raise RuntimeError("Cannot add to statistics after computeClipLimits")
+        image, mask, variance, isGood, weight = self._getPlanes(exposure)
+        self.numStatistics += 1
+        if weight == 0:
+            return weight
+
+        goodImage = image[isGood]
+        oldMean = self._mean[isGood]
+        weightSum = self._weightSum[isGood] + weight
+        delta = goodImage - oldMean
+        mean = oldMean + delta * (weight / weightSum)
+        self._sumSqDev[isGood] += weight * delta * (goodImage - mean)
+        self._mean[isGood] = mean
+        self._weightSum[isGood] = weightSum
+        self._count[isGood] += 1
+        return weight
+    
+    def computeClipLimits(self, numSigma, minNumForClip):
+        """Finish pass one: compute the mean and allowed deviation of each pixel
+        and free the pass-one accumulators
+        
+        Inputs:
+        - numSigma: reject pixels that differ from the mean by more than numSigma standard deviations
+        - minNumForClip: do not reject any pixels where fewer than this many exposures have good data
+        """
+        variance = numpy.maximum(self._sumSqDev, 0.0) / numpy.maximum(self._weightSum, 1.0e-300)
+        clipLimit = numSigma * numpy.sqrt(variance)
+        clipLimit[self._count < minNumForClip] = numpy.inf
+        self._clipLimit = clipLimit.astype(numpy.float32)
+        self._mean = self._mean.astype(numpy.float32)
+        del self._count, self._weightSum, self._sumSqDev, variance, clipLimit
+
+        shape = (self.height, self.width)
+        self._imageSum = numpy.zeros(shape, dtype=numpy.float64)
+        self._varianceSum = numpy.zeros(shape, dtype=numpy.float64)
+        self._coaddWeightSum = numpy.zeros(shape, dtype=numpy.float64)
+        self._coaddMask = numpy.zeros(shape, dtype=numpy.uint16)
+    
+    def addToCoadd(self, exposure):
+        """Add an exposure to the coadd, rejecting outlier pixels (pass two)
+        
+        @return weight, numRejected:
+        - weight: weight of exposure (0 if it has no good pixels, in which case it is ignored)
+        - numRejected: number of good pixels rejected as outliers
+        """
+        if self._clipLimit is None:
+            raise RuntimeError("Must call computeClipLimits before addToCoadd")
+        image, mask, variance, isGood, weight = self._getPlanes(exposure)
+        self.numCoadded += 1
+        if weight == 0:
+            return weight, 0
+
+        isUsed = isGood & (numpy.abs(image - self._mean) <= self._clipLimit)
+        numRejected = int(isGood.sum() - isUsed.sum())
+        self._imageSum[isUsed] += weight * image[isUsed]
+        self._varianceSum[isUsed] += weight * weight * variance[isUsed]
+        self._coaddWeightSum[isUsed] += weight
+        self._coaddMask[isUsed] |= mask[isUsed]
+        self.numRejected += numRejected
+        return weight, numRejected
+    
+    def getCoadd(self):
+        """Return the coadd and weight map
+        
+        Pixels with no unrejected good data have image and variance 0 and are masked EDGE.
+        
+        @return coadd (afwImage.ExposureF), weightMap (afwImage.ImageF)
+        """
+        if self._clipLimit is None:
+            raise RuntimeError("Must call computeClipLimits and addToCoadd before getCoadd")
+        hasData = self._coaddWeightSum > 0
+        weightSum = numpy.where(hasData, self._coaddWeightSum, 1.0)
+        edgeMask = afwImage.MaskU.getPlaneBitMask("EDGE")
+
+        maskedImage = afwImage.MaskedImageF(self.width, self.height)
+        maskedImage.setXY0(afwImage.PointI(self.x0, self.y0))
+        maskedImage.getImage().getArray()[:, :] = numpy.where(hasData, self._imageSum / weightSum, 0.0)
+        maskedImage.getVariance().getArray()[:, :] = \
+            numpy.where(hasData, self._varianceSum / (weightSum * weightSum), 0.0)
+        maskedImage.getMask().getArray()[:, :] = numpy.where(hasData, self._coaddMask, edgeMask)
+        coadd = afwImage.ExposureF(maskedImage, self.wcs)
+
+        weightMap = afwImage.ImageF(self.width, self.height)
+        weightMap.setXY0(afwImage.PointI(self.x0, self.y0))
+        weightMap.getArray()[:, :] = self._coaddWeightSum
+        return coadd, weightMap
+    
+    def _getPlanes(self, exposure):
+        """Return image, mask and variance arrays of exposure, a boolean array of good pixels,
+        and the weight of exposure (1/mean variance of good pixels; 0 if there are none)
+        
+        @raise RuntimeError if exposure does not have the same dimensions and xy0 as the accumulators
+        """
+        maskedImage = exposure.getMaskedImage()
+        if (maskedImage.getWidth(), maskedImage.getHeight(), maskedImage.getX0(), maskedImage.getY0()) \
+            != (self.width, self.height, self.x0, self.y0):
+            raise RuntimeError("Exposure is %dx%d at (%d, %d); expected %dx%d at (%d, %d)" % \
+                (maskedImage.getWidth(), maskedImage.getHeight(), maskedImage.getX0(), maskedImage.getY0(),
+                self.width, self.height, self.x0, self.y0))
+        image = maskedImage.getImage().getArray()
+        mask = maskedImage.getMask().getArray()
+        variance = maskedImage.getVariance().getArray()
+        isGood = (mask & self.badPixelMask) == 0
+        varianceSum = float(variance[isGood].sum(dtype=numpy.float64))
+        if varianceSum <= 0:
+            return image, mask, variance, isGood, 0.0
+        weight = isGood.sum() / varianceSum
+        return image, mask, variance, isGood, weight
+
+# this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
+class RobustCoaddStage(baseStage.Stage):
+    parallelClass = RobustCoaddStageParallel
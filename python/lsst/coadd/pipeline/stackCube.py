@@ -0,0 +1,124 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""On-disk stack of masked images of identical dimensions, memory-mapped so that
+a tile of every image can be read without holding the whole stack in memory
+"""
+from __future__ import with_statement
+
+import os
+
+import numpy
+
+import lsst.afw.image as afwImage
+
+InfoFileName = "cube.txt"
+# plane name: (file name, numpy dtype)
+PlaneInfoDict = {
+    "image": ("image.dat", numpy.float32),
+    "mask": ("mask.dat", numpy.uint16),
+    "variance": ("variance.dat", numpy.float32),
+}
+
+class StackCube(object):
+    """A stack of masked images stored in a directory as three memory-mapped arrays
+    (image, mask and variance), each of shape (numImages, height, width)
+    
+    Images are written one at a time as they are produced (see setMaskedImage),
+    so the stack never has to be held in memory. Pixels are stored in image coordinates
+    (xy0 is not stored).
+    """
+    def __init__(self, path, mode="r"):
+        """Open an existing stack cube
+        
+        Inputs:
+        - path: path of stack cube directory
+        - mode: "r" to read, "r+" to read and write
+        """
+        self.path = path
+        with file(os.path.join(path, InfoFileName), "r") as infoFile:
+            self.width, self.height, self.numImages = [int(val) for val in infoFile.read().split()]
+        self._planeDict = {}
+        for planeName, (fileName, dtype) in PlaneInfoDict.iteritems():
+            self._planeDict[planeName] = numpy.memmap(os.path.join(path, fileName), dtype=dtype,
+                mode=mode, shape=(self.numImages, self.height, self.width))
+    
+    @classmethod
+    def create(cls, path, width, height, numImages):
+        """Create a new stack cube (all pixels 0) and open it for reading and writing
+        
+        Inputs:
+        - path: path of stack cube directory; it is created if it does not exist
+        - width, height: dimensions of each image
+        - numImages: number of images in the stack
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for planeName, (fileName, dtype) in PlaneInfoDict.iteritems():
+            plane = numpy.memmap(os.path.join(path, fileName), dtype=dtype, mode="w+",
+                shape=(numImages, height, width))
+            del plane
+        with file(os.path.join(path, InfoFileName), "w") as infoFile:
+            infoFile.write("%d %d %d\n" % (width, height, numImages))
+        return cls(path, mode="r+")
+    
+    def setMaskedImage(self, index, maskedImage):
+        """Write a masked image into the stack
+        
+        Inputs:
+        - index: index of image in stack
+        - maskedImage: masked image; must have the dimensions of the stack
+        """
+        if (maskedImage.getWidth(), maskedImage.getHeight()) != (self.width, self.height):
+            raise RuntimeError("maskedImage is %dx%d; stack cube images are %dx%d" % \
+                (maskedImage.getWidth(), maskedImage.getHeight(), self.width, self.height))
+        self._planeDict["image"][index] = maskedImage.getImage().getArray()
+        self._planeDict["mask"][index] = maskedImage.getMask().getArray()
+        self._planeDict["variance"][index] = maskedImage.getVariance().getArray()
+    
+    def flush(self):
+        """Write pending changes to disk"""
+        for plane in self._planeDict.itervalues():
+            plane.flush()
+    
+    def getTileList(self, bbox):
+        """Read the same tile of every image in the stack
+        
+        Inputs:
+        - bbox: region to read (afwImage.BBox), relative to the origin of the images
+        
+        @return the tiles (an afwImage.vectorMaskedImageF); each tile's xy0 is the corner of bbox
+        """
+        x0 = bbox.getX0()
+        y0 = bbox.getY0()
+        x1 = x0 + bbox.getWidth()
+        y1 = y0 + bbox.getHeight()
+        tileList = afwImage.vectorMaskedImageF()
+        for index in range(self.numImages):
+            tile = afwImage.MaskedImageF(bbox.getWidth(), bbox.getHeight())
+            tile.getImage().getArray()[:, :] = self._planeDict["image"][index, y0:y1, x0:x1]
+            tile.getMask().getArray()[:, :] = self._planeDict["mask"][index, y0:y1, x0:x1]
+            tile.getVariance().getArray()[:, :] = self._planeDict["variance"][index, y0:y1, x0:x1]
+            tile.setXY0(x0, y0)
+            tileList.push_back(tile)
+        return tileList
@@ -0,0 +1,181 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Timing, memory and throughput measurements of pipeline stages
+"""
+from __future__ import with_statement
+
+import os
+import resource
+import socket
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.daf.base as dafBase
+
+_jsonLinesLock = threading.Lock()
+
+def countPixels(item):
+    """Return the number of pixels in an image-like clipboard item, or in a list of them
+    
+    Items that are not images, masked images, exposures or lists of them have 0 pixels.
+    """
+    if hasattr(item, "getMaskedImage"):
+        item = item.getMaskedImage()
+    if hasattr(item, "getWidth") and hasattr(item, "getHeight"):
+        return item.getWidth() * item.getHeight()
+    if isinstance(item, basestring):
+        return 0
+    try:
+        itemList = list(item)
+    except Exception:
+        return 0
+    return sum(countPixels(subItem) for subItem in itemList)
+
+def _getCpuTime():
+    """Return user + system CPU time (sec) used by this process, including all threads"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _getMaxRss():
+    """Return the peak resident set size of this process (kB on Linux, bytes on Mac OS X)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageMetrics(object):
+    """Measure each call to a stage's process method and send the results to a sink
+    
+    Each measurement is a dict with these fields:
+    - stage: name of the stage class
+    - host, pid: where the stage ran
+    - startTime: time at which process was called (sec since the epoch)
+    - wallTime: elapsed time (sec)
+    - cpuTime: user + system CPU time used by the whole process (sec)
+    - maxRssDelta: increase in the peak resident set size of the process (kB on Linux)
+    - numPixels: number of input pixels (the size of the stage's primary data input)
+    - megapixelsPerSec: numPixels / 1e6 / wallTime
+    - succeeded: False if process raised an exception
+    
+    Measurements are always appended to measurementList and are also written to the sinks
+    specified by instrumentationPolicy: appended as one JSON object per line to a file
+    and/or put on the clipboard as a dafBase.PropertySet.
+    """
+    def __init__(self, stageName, instrumentationPolicy):
+        """Construct a StageMetrics
+        
+        Inputs:
+        - stageName: name of the stage
+        - instrumentationPolicy: a policy as described by policy/InstrumentationDictionary.paf
+        """
+        self.stageName = stageName
+        self.jsonLinesPath = instrumentationPolicy.get("jsonLinesPath")
+        self.clipboardKey = instrumentationPolicy.get("clipboardKey")
+        self.measurementList = []
+    
+    def measure(self, func, clipboard, inputKeyList):
+        """Call func(clipboard), record measurements and return its result
+        
+        Inputs:
+        - func: function to call (the stage's process method)
+        - clipboard: the clipboard
+        - inputKeyList: clipboard names of the stage's primary data inputs, in order of precedence;
+            the pixels of the first one on the clipboard are counted
+        """
+        numPixels = 0
+        for key in inputKeyList:
+            item = clipboard.get(key)
+            if item != None:
+                numPixels = countPixels(item)
+                break
+
+        startTime = time.time()
+        startCpuTime = _getCpuTime()
+        startMaxRss = _getMaxRss()
+        succeeded = False
+        try:
+            result = func(clipboard)
+            succeeded = True
+        finally:
+            wallTime = time.time() - startTime
+            measurement = dict(
+                stage = self.stageName,
+                host = socket.gethostname(),
+                pid = os.getpid(),
+                startTime = startTime,
+                wallTime = wallTime,
+                cpuTime = _getCpuTime() - startCpuTime,
+                maxRssDelta = _getMaxRss() - startMaxRss,
+                numPixels = numPixels,
+                megapixelsPerSec = numPixels / 1.0e6 / max(wallTime, 1.0e-9),
+                succeeded = succeeded,
+            )
+            self.record(measurement, clipboard)
+        return result
+    
+    def record(self, measurement, clipboard):
+        """Record one measurement"""
+        self.measurementList.append(measurement)
+        if self.jsonLinesPath:
+            line = json.dumps(measurement, sort_keys=True) + "\n"
+            with _jsonLinesLock:
+                with file(self.jsonLinesPath, "a") as outFile:
+                    outFile.write(line)
+        if self.clipboardKey:
+            propertySet = dafBase.PropertySet()
+            for name, value in measurement.iteritems():
+                propertySet.set(name, value)
+            clipboard.put(self.clipboardKey, propertySet)
+
+def readMeasurements(jsonLinesPath):
+    """Read measurements written by StageMetrics
+    
+    @return a list of measurements (dicts)
+    """
+    with file(jsonLinesPath, "r") as inFile:
+        return [json.loads(line) for line in inFile if line.strip()]
+
+def summarizeMeasurements(measurementList):
+    """Aggregate measurements by stage
+    
+    @return a dict of stage name: dict with fields:
+    - numCalls, numFailed
+    - wallTime, cpuTime, numPixels: totals
+    - maxRssDelta: largest value
+    - megapixelsPerSec: total numPixels / 1e6 / total wallTime
+    """
+    summaryDict = {}
+    for measurement in measurementList:
+        summary = summaryDict.setdefault(measurement["stage"], dict(
+            numCalls = 0, numFailed = 0, wallTime = 0.0, cpuTime = 0.0, numPixels = 0, maxRssDelta = 0))
+        summary["numCalls"] += 1
+        if not measurement["succeeded"]:
+            summary["numFailed"] += 1
+        for name in ("wallTime", "cpuTime", "numPixels"):
+            summary[name] += measurement[name]
+        summary["maxRssDelta"] = max(summary["maxRssDelta"], measurement["maxRssDelta"])
+    for summary in summaryDict.itervalues():
+        summary["megapixelsPerSec"] = summary["numPixels"] / 1.0e6 / max(summary["wallTime"], 1.0e-9)
+    return summaryDict
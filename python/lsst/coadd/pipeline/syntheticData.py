@@ -0,0 +1,172 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Synthetic exposures for exercising and benchmarking the coadd stages without survey data
+"""
+import math
+import random
+
+import lsst.daf.base as dafBase
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+
+def makeWcs(crval, crpix, pixelScale, rotation):
+    """Make a TAN WCS
+    
+    Inputs:
+    - crval: RA, Dec of the reference pixel (deg)
+    - crpix: x, y position of the reference pixel (FITS convention: 1-based)
+    - pixelScale: pixel scale (arcsec/pixel)
+    - rotation: rotation of the y axis east of north (deg)
+    """
+    scale = pixelScale / 3600.0
+    cosRot = math.cos(math.radians(rotation))
+    sinRot = math.sin(math.radians(rotation))
+    metadata = dafBase.PropertySet()
+    metadata.set("RADESYS", "ICRS")
+    metadata.set("EQUINOX", 2000.0)
+    metadata.set("CTYPE1", "RA---TAN")
+    metadata.set("CTYPE2", "DEC--TAN")
+    metadata.set("CUNIT1", "deg")
+    metadata.set("CUNIT2", "deg")
+    metadata.set("CRVAL1", float(crval[0]))
+    metadata.set("CRVAL2", float(crval[1]))
+    metadata.set("CRPIX1", float(crpix[0]))
+    metadata.set("CRPIX2", float(crpix[1]))
+    metadata.set("CD1_1", -scale * cosRot)
+    metadata.set("CD1_2", scale * sinRot)
+    metadata.set("CD2_1", scale * sinRot)
+    metadata.set("CD2_2", scale * cosRot)
+    return afwImage.makeWcs(metadata)
+
+def makeStarList(wcs, width, height, numStars, minFlux, maxFlux, rand):
+    """Make a list of stars uniformly distributed over an image area
+    
+    Inputs:
+    - wcs: WCS of the image area
+    - width, height: dimensions of the image area (pixels)
+    - numStars: number of stars
+    - minFlux, maxFlux: range of star flux (counts); fluxes are log-uniformly distributed
+    - rand: a random.Random
+    
+    @return a list of (sky position, flux)
+    """
+    starList = []
+    for i in range(numStars):
+        x = rand.uniform(0, width - 1)
+        y = rand.uniform(0, height - 1)
+        flux = math.exp(rand.uniform(math.log(minFlux), math.log(maxFlux)))
+        starList.append((wcs.pixelToSky(x, y), flux))
+    return starList
+
+def makeExposure(width, height, wcs, starList, psfSigma, skySigma, afwRand, rand,
+    numBadColumns=2, numCosmicRays=50):
+    """Make a synthetic, background-subtracted exposure
+    
+    The image contains stars with a Gaussian PSF plus Gaussian sky noise.
+    The mask has a few bad columns (BAD) and single-pixel cosmic rays (CR);
+    the variance is the sky variance plus the star counts.
+    
+    Inputs:
+    - width, height: dimensions of the exposure (pixels)
+    - wcs: WCS of the exposure
+    - starList: list of (sky position, flux), e.g. from makeStarList
+    - psfSigma: sigma of the Gaussian PSF (pixels)
+    - skySigma: sigma of the sky noise (counts)
+    - afwRand: an afwMath.Random, used for the pixel noise
+    - rand: a random.Random, used for everything else
+    - numBadColumns: number of bad columns
+    - numCosmicRays: number of cosmic rays
+    
+    @return the exposure (afwImage.ExposureF)
+    """
+    starImage = afwImage.ImageF(width, height)
+    starImage.set(0)
+    for sky, flux in starList:
+        pos = wcs.skyToPixel(sky)
+        x = int(round(pos.getX()))
+        y = int(round(pos.getY()))
+        if 0 <= x < width and 0 <= y < height:
+            starImage.set(x, y, starImage.get(x, y) + flux)
+    
+    kernelSize = 2 * int(math.ceil(4 * psfSigma)) + 1
+    psfKernel = afwMath.AnalyticKernel(kernelSize, kernelSize,
+        afwMath.GaussianFunction2D(psfSigma, psfSigma))
+    maskedImage = afwImage.MaskedImageF(width, height)
+    image = maskedImage.getImage()
+    afwMath.convolve(image, starImage, psfKernel, True)
+    
+    variance = maskedImage.getVariance()
+    variance <<= image # star counts, before noise is added
+    variance += skySigma**2
+
+    noiseImage = afwImage.ImageF(width, height)
+    afwMath.randomGaussianImage(noiseImage, afwRand)
+    noiseImage *= skySigma
+    image += noiseImage
+    
+    mask = maskedImage.getMask()
+    mask.set(0)
+    badBit = afwImage.MaskU.getPlaneBitMask("BAD")
+    for i in range(numBadColumns):
+        x = rand.randint(0, width - 1)
+        for y in range(height):
+            mask.set(x, y, mask.get(x, y) | badBit)
+    crBit = afwImage.MaskU.getPlaneBitMask("CR")
+    for i in range(numCosmicRays):
+        x = rand.randint(0, width - 1)
+        y = rand.randint(0, height - 1)
+        image.set(x, y, image.get(x, y) + rand.uniform(10, 100) * skySigma)
+        mask.set(x, y, mask.get(x, y) | crBit)
+    
+    return afwImage.makeExposure(maskedImage, wcs)
+
+def makeDataset(width, height, numExposures, seed=0, pixelScale=0.2, maxOffset=20.0, maxRotation=1.0,
+    minPsfSigma=1.5, maxPsfSigma=3.0, skySigma=10.0, numStars=None):
+    """Make a reference exposure and a set of exposures of the same field
+    
+    Each exposure has a random pointing offset (up to maxOffset pixels), rotation (up to maxRotation deg)
+    and PSF width (between minPsfSigma and maxPsfSigma pixels). The reference exposure has no offset
+    or rotation and the smallest PSF.
+    
+    @return referenceExposure, exposureList
+    """
+    rand = random.Random(seed)
+    afwRand = afwMath.Random(afwMath.Random.MT19937, seed)
+    if numStars == None:
+        numStars = max(10, width * height // 10000)
+    crval = (150.0, 2.0)
+    crpix = ((width + 1) / 2.0, (height + 1) / 2.0)
+    referenceWcs = makeWcs(crval, crpix, pixelScale, 0.0)
+    starList = makeStarList(referenceWcs, width, height, numStars, 100 * skySigma, 10000 * skySigma, rand)
+    
+    referenceExposure = makeExposure(width, height, referenceWcs, starList, minPsfSigma, skySigma,
+        afwRand, rand)
+    exposureList = []
+    for i in range(numExposures):
+        offset = (rand.uniform(-maxOffset, maxOffset), rand.uniform(-maxOffset, maxOffset))
+        wcs = makeWcs(crval, (crpix[0] + offset[0], crpix[1] + offset[1]), pixelScale,
+            rand.uniform(-maxRotation, maxRotation))
+        psfSigma = rand.uniform(minPsfSigma, maxPsfSigma)
+        exposureList.append(makeExposure(width, height, wcs, starList, psfSigma, skySigma, afwRand, rand))
+    return referenceExposure, exposureList
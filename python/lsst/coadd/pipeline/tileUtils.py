@@ -0,0 +1,111 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Utilities for processing images in tiles, to bound memory use
+"""
+import lsst.afw.image as afwImage
+
+def makeTileBBoxList(width, height, tileWidth, tileHeight):
+    """Split an image area into a list of tiles
+    
+    Inputs:
+    - width: width of the image area (pixels)
+    - height: height of the image area (pixels)
+    - tileWidth: width of each tile; if <= 0 then each tile spans the full width (row bands)
+    - tileHeight: height of each tile; if <= 0 then each tile spans the full height
+    
+    @return a list of afwImage.BBox, in row-major order, that exactly covers the image area.
+        The bounding boxes are relative to the origin of the image (not its xy0).
+        Tiles along the right and top edges may be smaller than requested.
+    """
+    if tileWidth <= 0:
+        tileWidth = width
+    if tileHeight <= 0:
+        tileHeight = height
+
+    bboxList = []
+    for y0 in range(0, height, tileHeight):
+        tileH = min(tileHeight, height - y0)
+        for x0 in range(0, width, tileWidth):
+            tileW = min(tileWidth, width - x0)
+            bboxList.append(afwImage.BBox(afwImage.PointI(x0, y0), tileW, tileH))
+    return bboxList
+
+def getMaskedImageDimensions(path):
+    """Get the dimensions of a masked image on disk by reading only its image header
+    
+    Inputs:
+    - path: path to a MaskedImage or Exposure (without the final _img.fits)
+    
+    @return width, height
+    """
+    metadata = afwImage.readMetadata(path + "_img.fits")
+    return metadata.getInt("NAXIS1"), metadata.getInt("NAXIS2")
+
+def readMaskedImageTile(path, bbox):
+    """Read a subregion of a masked image from disk
+    
+    Inputs:
+    - path: path to a MaskedImage or Exposure (without the final _img.fits)
+    - bbox: region to read (afwImage.BBox), relative to the origin of the image
+    
+    @return the subregion (afwImage.MaskedImageF)
+    """
+    return afwImage.MaskedImageF(path, 0, None, bbox)
+
+def getOverlapBBox(bbox1, bbox2):
+    """Return the intersection of two bounding boxes (afwImage.BBox), or None if they do not overlap
+    """
+    x0 = max(bbox1.getX0(), bbox2.getX0())
+    y0 = max(bbox1.getY0(), bbox2.getY0())
+    x1 = min(bbox1.getX0() + bbox1.getWidth(), bbox2.getX0() + bbox2.getWidth())
+    y1 = min(bbox1.getY0() + bbox1.getHeight(), bbox2.getY0() + bbox2.getHeight())
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return afwImage.BBox(afwImage.PointI(x0, y0), x1 - x0, y1 - y0)
+
+def getPatchBBox(patchId, patchWidth, patchHeight):
+    """Return the bounding box of a patch
+    
+    Patches tile the parent pixel grid of a WCS (the tract): patch "i,j" covers
+    x in [i*patchWidth, (i+1)*patchWidth) and y in [j*patchHeight, (j+1)*patchHeight).
+    
+    Inputs:
+    - patchId: patch ID: a string "i,j", as returned by getOverlappingPatchIdList
+    - patchWidth, patchHeight: dimensions of each patch (pixels)
+    """
+    xIndex, yIndex = [int(index) for index in patchId.split(",")]
+    return afwImage.BBox(afwImage.PointI(xIndex * patchWidth, yIndex * patchHeight), patchWidth, patchHeight)
+
+def getOverlappingPatchIdList(bbox, patchWidth, patchHeight):
+    """Return the IDs of the patches that overlap a bounding box, in row-major order
+    
+    Inputs:
+    - bbox: bounding box, in parent pixel coordinates (afwImage.BBox)
+    - patchWidth, patchHeight: dimensions of each patch (pixels); see getPatchBBox
+    """
+    if bbox.getWidth() <= 0 or bbox.getHeight() <= 0:
+        return []
+    xIndexRange = range(bbox.getX0() // patchWidth, (bbox.getX0() + bbox.getWidth() - 1) // patchWidth + 1)
+    yIndexRange = range(bbox.getY0() // patchHeight, (bbox.getY0() + bbox.getHeight() - 1) // patchHeight + 1)
+    return ["%d,%d" % (xIndex, yIndex) for yIndex in yIndexRange for xIndex in xIndexRange]
@@ -20,22 +20,61 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import threading
+
+from lsst.pex.logging import Log
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.utils as coaddUtils
 import baseStage
+import exposureIndex
+import parallelUtils
+import warpGeometry
 
 class WarpExposureStageParallel(baseStage.ParallelStage):
     """Pipeline stage to warp one exposure to match a reference exposure.
+    
+    The destination geometry (bounding box, WCS and sky grid) of the reference exposure is cached
+    and reused as long as each new reference exposure has the same bounding box and WCS.
+    
+    By default the WCS is evaluated for every destination pixel. If maxInterpolationError > 0
+    then the destination-to-source pixel mapping is only computed exactly on a grid and interpolated
+    in between; the grid is as coarse as possible (up to maxInterpolationLength) while keeping
+    the estimated error (computed using the cached sky grid) below maxInterpolationError.
+    The estimated error is output as interpolationError (0 if the exact mapping was used).
+    
+    If exposureList is on the clipboard then every exposure in it is warped (using a pool of numThreads
+    threads) and the results are output as warpedExposureList; in that case exposure is not required
+    and interpolationError is the largest error for any exposure in the list.
+    
+    If exposurePathList is on the clipboard then the exposures are read from disk and warped
+    as for exposureList. If exposureIndexPath is specified then the index (see exposureIndex)
+    is updated from the FITS headers and exposures that do not overlap the reference exposure
+    are neither read nor warped; the paths of the exposures that were warped are output
+    as overlappingExposurePathList.
+    
+    If restrictToOverlap is true (it is false by default) then only the part of the reference bounding box
+    that overlaps the exposure (grown by overlapBorder pixels) is warped; the rest of the warped exposure
+    is masked as no-data (EDGE). The overlap bounding box is output as overlapBBox
+    (or overlapBBoxList) so that PsfMatchStage can restrict psf-matching to the same region.
     """
     packageName = "coadd_pipeline"
     policyDictionaryName = "WarpExposureStageDictionary.paf"
+    metricsInputKeys = ("exposurePathList", "exposureList", "exposure")
     
     def setup(self):
         baseStage.ParallelStage.setup(self)
         
-        warpPolicy = self.policy.getPolicy("warpPolicy")
-        self.warper = coaddUtils.Warp.fromPolicy(warpPolicy)
+        self.warpPolicy = self.policy.getPolicy("warpPolicy")
+        self.referenceGeometry = None
+        self.maxInterpolationError = self.policy.get("maxInterpolationError")
+        self.maxInterpolationLength = self.policy.get("maxInterpolationLength")
+        self.numThreads = self.policy.get("numThreads")
+        self.exposureIndexPath = self.policy.get("exposureIndexPath")
+        self.restrictToOverlap = self.policy.get("restrictToOverlap")
+        self.overlapBorder = self.policy.get("overlapBorder")
+        # warpers are not thread-safe (warping kernels hold per-pixel state), so use one per thread
+        self._threadLocal = threading.local()
 
     def process(self, clipboard):
         """Warp exposure to referenceExposure"""
@@ -44,14 +83,128 @@ class WarpExposureStageParallel(baseStage.ParallelStage):
 #         for key in clipboard.getKeys():
 #             print "*", key
 
-        exposure = self.getFromClipboard(clipboard, "exposure")
         referenceExposure = self.getFromClipboard(clipboard, "referenceExposure")
-        warpedExposure = self.warper.warpExposure(
-            bbox = coaddUtils.bboxFromImage(referenceExposure),
-            wcs = referenceExposure.getWcs(),
-            exposure = exposure)
+        referenceGeometry = self.getReferenceGeometry(referenceExposure)
+
+        exposurePathList = self.getFromClipboard(clipboard, "exposurePathList", doRaise=False)
+        if exposurePathList != None:
+            if self.exposureIndexPath:
+                overlappingPathList = exposureIndex.filterExposurePathList(self.exposureIndexPath,
+                    exposurePathList, referenceGeometry.wcs, referenceGeometry.bbox, self.log)
+                self.log.log(Log.INFO, "%d of %d exposures overlap the reference exposure" % \
+                    (len(overlappingPathList), len(exposurePathList)))
+            else:
+                overlappingPathList = list(exposurePathList)
+            self.warpExposureList(clipboard, overlappingPathList, referenceGeometry,
+                lambda path: afwImage.ExposureF(path))
+            self.addToClipboard(clipboard, "overlappingExposurePathList", overlappingPathList)
+            return
+
+        exposureList = self.getFromClipboard(clipboard, "exposureList", doRaise=False)
+        if exposureList != None:
+            self.warpExposureList(clipboard, exposureList, referenceGeometry, lambda exposure: exposure)
+            return
+
+        exposure = self.getFromClipboard(clipboard, "exposure")
+        warpedExposure, interpolationError, overlapBBox = self.warpExposure(exposure, referenceGeometry)
 
         self.addToClipboard(clipboard, "warpedExposure", warpedExposure)
+        self.addToClipboard(clipboard, "interpolationError", interpolationError)
+        self.addToClipboard(clipboard, "overlapBBox", overlapBBox)
+    
+    def warpExposureList(self, clipboard, itemList, referenceGeometry, getExposure):
+        """Warp a list of exposures using a pool of threads and output the results
+        
+        Inputs:
+        - clipboard: the clipboard, to which warpedExposureList, interpolationError and overlapBBoxList
+            are output
+        - itemList: list of exposures or exposure paths
+        - referenceGeometry: reference geometry
+        - getExposure: function that returns the exposure for an item of itemList
+        """
+        self.log.log(Log.INFO, "Warp %d exposures using %d threads" % \
+            (len(itemList), max(self.numThreads, 1)))
+        resultList = parallelUtils.runInThreads(
+            lambda item: self.warpExposure(getExposure(item), referenceGeometry),
+            itemList, self.numThreads)
+        self.addToClipboard(clipboard, "warpedExposureList", [result[0] for result in resultList])
+        self.addToClipboard(clipboard, "interpolationError", max([0.0] + [r[1] for r in resultList]))
+        self.addToClipboard(clipboard, "overlapBBoxList", [result[2] for result in resultList])
+    
+    def warpExposure(self, exposure, referenceGeometry):
+        """Warp exposure to the reference geometry
+        
+        @return warpedExposure, interpolationError, overlapBBox:
+        - warpedExposure: the warped exposure
+        - interpolationError: the estimated maximum error (source pixels) of the approximate
+            pixel mapping (0 if the exact mapping was used)
+        - overlapBBox: the region of the reference bounding box that was warped (afwImage.BBox);
+            the whole reference bounding box unless restrictToOverlap is true
+        """
+        destBBox = referenceGeometry.bbox
+        if self.restrictToOverlap:
+            destBBox = referenceGeometry.computeOverlapBBox(
+                exposure.getWcs(), coaddUtils.bboxFromImage(exposure), self.overlapBorder)
+            if destBBox.getWidth() == 0:
+                self.log.log(Log.INFO, "Exposure does not overlap the reference exposure; nothing to warp")
+                return warpGeometry.embedExposure(None, referenceGeometry.bbox, referenceGeometry.wcs), \
+                    0.0, destBBox
+        warpedExposure, interpolationError = self.warpExposureToBBox(exposure, referenceGeometry, destBBox)
+        if not warpGeometry.isSameBBox(destBBox, referenceGeometry.bbox):
+            self.log.log(Log.INFO, "Warped the %dx%d overlap of the %dx%d reference exposure" % \
+                (destBBox.getWidth(), destBBox.getHeight(),
+                referenceGeometry.bbox.getWidth(), referenceGeometry.bbox.getHeight()))
+            warpedExposure = warpGeometry.embedExposure(warpedExposure, referenceGeometry.bbox,
+                referenceGeometry.wcs)
+        return warpedExposure, interpolationError, destBBox
+    
+    def warpExposureToBBox(self, exposure, referenceGeometry, destBBox):
+        """Warp exposure to the part destBBox of the reference geometry
+        
+        @return warpedExposure, interpolationError (see warpExposure)
+        """
+        warper, warpingKernel = self.getWarper()
+        if self.maxInterpolationError > 0:
+            interpLength, interpolationError = referenceGeometry.chooseInterpolationLength(
+                exposure.getWcs(), self.maxInterpolationError, self.maxInterpolationLength)
+            if interpLength > 0:
+                self.log.log(Log.INFO, "Warp using interpolation length %d; estimated error=%0.3g pixels" % \
+                    (interpLength, interpolationError))
+                warpedExposure = afwImage.ExposureF(destBBox.getWidth(), destBBox.getHeight(),
+                    referenceGeometry.wcs)
+                warpedExposure.getMaskedImage().setXY0(destBBox.getLLC())
+                afwMath.warpExposure(warpedExposure, exposure, warpingKernel, interpLength)
+                return warpedExposure, interpolationError
+            self.log.log(Log.INFO, "No interpolation length meets maxInterpolationError; warp exactly")
+
+        warpedExposure = warper.warpExposure(
+            bbox = destBBox,
+            wcs = referenceGeometry.wcs,
+            exposure = exposure)
+        return warpedExposure, 0.0
+    
+    def getWarper(self):
+        """Return the warper and warping kernel for the current thread, creating them if necessary
+        
+        @return warper, warpingKernel; warpingKernel is None unless maxInterpolationError > 0
+        """
+        warperData = getattr(self._threadLocal, "warperData", None)
+        if warperData == None:
+            warper = coaddUtils.Warp.fromPolicy(self.warpPolicy)
+            warpingKernel = None
+            if self.maxInterpolationError > 0:
+                warpingKernel = afwMath.makeWarpingKernel(self.warpPolicy.get("warpingKernelName"))
+            warperData = (warper, warpingKernel)
+            self._threadLocal.warperData = warperData
+        return warperData
+    
+    def getReferenceGeometry(self, referenceExposure):
+        """Return the cached geometry of referenceExposure, recomputing it if the reference has changed
+        """
+        if self.referenceGeometry == None or not self.referenceGeometry.matches(referenceExposure):
+            self.log.log(Log.INFO, "New reference exposure: compute destination geometry")
+            self.referenceGeometry = warpGeometry.ReferenceGeometry(referenceExposure)
+        return self.referenceGeometry
         
 # this is (unfortunately) required by SimpleStageTester; but not by the regular middleware
 class WarpExposureStage(baseStage.Stage):
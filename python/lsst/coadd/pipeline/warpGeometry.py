@@ -0,0 +1,241 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Cached destination geometry for warping exposures to a reference exposure
+"""
+import math
+
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+
+# number of points sampled along each edge of a source exposure to find its overlap with the reference
+OverlapNumPerSide = 16
+
+# smallest interpolation length tried by ReferenceGeometry.chooseInterpolationLength;
+# error estimation costs one WCS evaluation per grid cell, so smaller lengths get expensive
+MinInterpolationLength = 16
+
+def makeGridPositions(start, size, spacing):
+    """Return grid positions along one axis: start, start + spacing, ... and always the last pixel
+    
+    Inputs:
+    - start: position of first pixel
+    - size: number of pixels
+    - spacing: desired spacing between grid positions (pixels); must be > 0
+    """
+    end = start + size - 1
+    positionList = range(start, end, spacing)
+    positionList.append(end)
+    return positionList
+
+def getRelativeBBox(bbox, parentBBox):
+    """Return bbox relative to the corner of parentBBox (as needed to make a subimage)
+    """
+    corner = afwImage.PointI(bbox.getX0() - parentBBox.getX0(), bbox.getY0() - parentBBox.getY0())
+    return afwImage.BBox(corner, bbox.getWidth(), bbox.getHeight())
+
+def isSameBBox(bbox1, bbox2):
+    """Return True if two bounding boxes are identical"""
+    return (bbox1.getX0(), bbox1.getY0(), bbox1.getWidth(), bbox1.getHeight()) == \
+        (bbox2.getX0(), bbox2.getY0(), bbox2.getWidth(), bbox2.getHeight())
+
+def embedExposure(exposure, bbox, wcs):
+    """Return a new exposure covering bbox that contains exposure, with all other pixels
+    masked as no-data (EDGE, with image and variance 0)
+    
+    Inputs:
+    - exposure: exposure to embed, or None for an exposure that is entirely no-data;
+        its bounding box must be contained in bbox
+    - bbox: bounding box of the new exposure (afwImage.BBox)
+    - wcs: WCS of the new exposure
+    """
+    maskedImage = afwImage.MaskedImageF(bbox.getWidth(), bbox.getHeight())
+    maskedImage.setXY0(bbox.getLLC())
+    maskedImage.getImage().set(0.0)
+    maskedImage.getMask().set(afwImage.MaskU.getPlaneBitMask("EDGE"))
+    maskedImage.getVariance().set(0.0)
+    if exposure != None:
+        subBBox = getRelativeBBox(coaddUtils.bboxFromImage(exposure), bbox)
+        subMaskedImage = afwImage.MaskedImageF(maskedImage, subBBox)
+        subMaskedImage <<= exposure.getMaskedImage()
+    return afwImage.makeExposure(maskedImage, wcs)
+
+def makeWcsKey(wcs):
+    """Return a key that is equal for identical WCS"""
+    return wcs.getFitsMetadata().toString()
+
+class ReferenceGeometry(object):
+    """Destination geometry of a reference exposure, computed once and reused for every exposure
+    warped to that reference.
+    
+    The sky grids are used to estimate the error of warping with an interpolated pixel mapping
+    (see chooseInterpolationLength); afw's warper cannot be handed them, so they do not
+    save any WCS evaluation in the warp itself.
+    
+    Attributes:
+    - bbox: bounding box of the reference exposure (afwImage.BBox)
+    - wcs: WCS of the reference exposure (a copy, so later changes to the reference do not affect it)
+    """
+    def __init__(self, referenceExposure):
+        self.bbox = coaddUtils.bboxFromImage(referenceExposure)
+        self.wcs = referenceExposure.getWcs().clone()
+        self._wcsKey = None
+        self._lastMatchedExposure = referenceExposure
+        self._skyGridDict = {}
+
+    def matches(self, exposure):
+        """Return True if exposure has the same bounding box and WCS as the reference exposure
+        
+        The check is free if exposure is the same object as last time (the usual case:
+        the same reference exposure is on the clipboard for every event); so changing the WCS
+        of a reference exposure in place between events is not detected. Otherwise the bounding boxes
+        are compared and then, only if they match, the WCS FITS metadata.
+        """
+        if exposure is self._lastMatchedExposure:
+            return True
+        if not isSameBBox(coaddUtils.bboxFromImage(exposure), self.bbox):
+            return False
+        if self._wcsKey == None:
+            self._wcsKey = makeWcsKey(self.wcs)
+        if makeWcsKey(exposure.getWcs()) != self._wcsKey:
+            return False
+        self._lastMatchedExposure = exposure
+        return True
+
+    def getSkyGrid(self, spacing):
+        """Return the sky positions of a grid of destination pixels
+        
+        The grid is computed the first time it is requested for a given spacing and cached thereafter.
+        
+        Inputs:
+        - spacing: grid spacing (pixels)
+        
+        @return xList, yList, skyGrid where skyGrid[j][i] is the sky position of pixel (xList[i], yList[j])
+        """
+        skyGridData = self._skyGridDict.get(spacing)
+        if skyGridData == None:
+            xList = makeGridPositions(self.bbox.getX0(), self.bbox.getWidth(), spacing)
+            yList = makeGridPositions(self.bbox.getY0(), self.bbox.getHeight(), spacing)
+            skyGrid = [[self.wcs.pixelToSky(x, y) for x in xList] for y in yList]
+            skyGridData = (xList, yList, skyGrid)
+            self._skyGridDict[spacing] = skyGridData
+        return skyGridData
+
+    def getCellCenterSkyGrid(self, spacing):
+        """Return the sky positions of the centers of the cells of the grid returned by getSkyGrid
+        
+        @return xList, yList, skyGrid where skyGrid[j][i] is the sky position of pixel (xList[i], yList[j])
+        """
+        key = ("center", spacing)
+        skyGridData = self._skyGridDict.get(key)
+        if skyGridData == None:
+            gridXList, gridYList = self.getSkyGrid(spacing)[0:2]
+            xList = [(gridXList[i] + gridXList[i+1]) / 2.0 for i in range(len(gridXList) - 1)]
+            yList = [(gridYList[j] + gridYList[j+1]) / 2.0 for j in range(len(gridYList) - 1)]
+            skyGrid = [[self.wcs.pixelToSky(x, y) for x in xList] for y in yList]
+            skyGridData = (xList, yList, skyGrid)
+            self._skyGridDict[key] = skyGridData
+        return skyGridData
+
+    def computeInterpolationError(self, srcWcs, spacing):
+        """Estimate the error of approximating the destination-to-source pixel mapping
+        by bilinear interpolation over a grid
+        
+        The mapping is evaluated exactly at the grid points and at the center of each grid cell
+        (where the interpolation error of a smooth mapping is largest).
+        
+        Inputs:
+        - srcWcs: WCS of the source exposure
+        - spacing: grid spacing (pixels)
+        
+        @return the maximum error (source pixels)
+        """
+        gridSkyGrid = self.getSkyGrid(spacing)[2]
+        centerSkyGrid = self.getCellCenterSkyGrid(spacing)[2]
+        gridPosGrid = [[srcWcs.skyToPixel(sky) for sky in skyRow] for skyRow in gridSkyGrid]
+        maxError = 0.0
+        for j, centerSkyRow in enumerate(centerSkyGrid):
+            for i, centerSky in enumerate(centerSkyRow):
+                cornerList = (gridPosGrid[j][i], gridPosGrid[j][i+1],
+                    gridPosGrid[j+1][i], gridPosGrid[j+1][i+1])
+                interpX = sum(pos.getX() for pos in cornerList) / 4.0
+                interpY = sum(pos.getY() for pos in cornerList) / 4.0
+                truePos = srcWcs.skyToPixel(centerSky)
+                error = math.hypot(truePos.getX() - interpX, truePos.getY() - interpY)
+                maxError = max(maxError, error)
+        return maxError
+
+    def chooseInterpolationLength(self, srcWcs, maxError, maxLength):
+        """Choose the longest interpolation length whose estimated error is acceptable
+        
+        Lengths maxLength, maxLength/2, ... down to MinInterpolationLength are tried in turn.
+        
+        Inputs:
+        - srcWcs: WCS of the source exposure
+        - maxError: maximum acceptable error (source pixels)
+        - maxLength: longest interpolation length to try (pixels)
+        
+        @return interpLength, error: interpolation length (0 if no length is acceptable,
+            meaning the exact transform must be used) and its estimated error (0 if interpLength = 0)
+        """
+        interpLength = maxLength
+        while interpLength >= MinInterpolationLength:
+            error = self.computeInterpolationError(srcWcs, interpLength)
+            if error <= maxError:
+                return interpLength, error
+            interpLength //= 2
+        return 0, 0.0
+
+    def computeOverlapBBox(self, srcWcs, srcBBox, border):
+        """Compute the part of the reference bounding box that overlaps a source image
+        
+        Points along the edges of the source image are mapped to reference pixels and bounded;
+        the bounds are grown by border pixels (to allow for curvature between the points
+        and the support of the warping kernel) and clipped to the reference bounding box.
+        
+        Inputs:
+        - srcWcs: WCS of the source image
+        - srcBBox: bounding box of the source image (afwImage.BBox)
+        - border: number of pixels by which to grow the overlap
+        
+        @return the overlap bounding box (afwImage.BBox, in the same coordinates as self.bbox);
+            it has width and height 0 if there is no overlap
+        """
+        xMin = srcBBox.getX0()
+        yMin = srcBBox.getY0()
+        xMax = srcBBox.getX1()
+        yMax = srcBBox.getY1()
+        srcPosList = []
+        for i in range(OverlapNumPerSide + 1):
+            frac = i / float(OverlapNumPerSide)
+            x = xMin + frac * (xMax - xMin)
+            y = yMin + frac * (yMax - yMin)
+            srcPosList += [(x, yMin), (x, yMax), (xMin, y), (xMax, y)]
+        destPosList = [self.wcs.skyToPixel(srcWcs.pixelToSky(x, y)) for x, y in srcPosList]
+        x0 = max(self.bbox.getX0(), int(math.floor(min(pos.getX() for pos in destPosList))) - border)
+        y0 = max(self.bbox.getY0(), int(math.floor(min(pos.getY() for pos in destPosList))) - border)
+        x1 = min(self.bbox.getX1(), int(math.ceil(max(pos.getX() for pos in destPosList))) + border)
+        y1 = min(self.bbox.getY1(), int(math.ceil(max(pos.getY() for pos in destPosList))) + border)
+        if x0 > x1 or y0 > y1:
+            return afwImage.BBox(self.bbox.getLLC(), 0, 0)
+        return afwImage.BBox(afwImage.PointI(x0, y0), x1 - x0 + 1, y1 - y0 + 1)
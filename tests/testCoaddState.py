@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.coaddState
+"""
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline.coaddState as coaddState
+import lsst.coadd.pipeline.compactCoadd as compactCoadd
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+Width = 30
+Height = 20
+NumUncovered = 10 # the seed coadd has no data in columns [0, NumUncovered)
+AllowedMaskPlanes = "DETECTED"
+
+def makeExposure(imageArray, maskArray, varianceArray, wcs):
+    """Make an afwImage.ExposureF from image, mask and variance arrays"""
+    height, width = imageArray.shape
+    maskedImage = afwImage.MaskedImageF(width, height)
+    maskedImage.getImage().getArray()[:, :] = imageArray
+    maskedImage.getMask().getArray()[:, :] = maskArray
+    maskedImage.getVariance().getArray()[:, :] = varianceArray
+    return afwImage.makeExposure(maskedImage, wcs)
+
+class SeedTestCase(unittest.TestCase):
+    """Test seeding a coadd from a normalized coadd that has no data in some pixels"""
+    def setUp(self):
+        self.wcs = syntheticData.makeWcs((150.0, 2.0), (Width / 2.0, Height / 2.0), 0.2, 0.0)
+        shape = (Height, Width)
+        self.seedValue = 5.0
+        self.seedVariance = 2.0
+        self.seedWeight = 3.0
+        # a normalized coadd as it might be read from disk: NaN, masked EDGE, where there is no data
+        imageArray = numpy.ones(shape) * self.seedValue
+        varianceArray = numpy.ones(shape) * self.seedVariance
+        maskArray = numpy.zeros(shape, dtype=numpy.uint16)
+        imageArray[:, :NumUncovered] = numpy.nan
+        varianceArray[:, :NumUncovered] = numpy.nan
+        maskArray[:, :NumUncovered] = afwImage.MaskU.getPlaneBitMask("EDGE")
+        self.seedExposure = makeExposure(imageArray, maskArray, varianceArray, self.wcs)
+        self.seedWeightMap = afwImage.ImageF(Width, Height)
+        self.seedWeightMap.getArray()[:, :] = self.seedWeight
+        self.seedWeightMap.getArray()[:, :NumUncovered] = 0
+
+        # an exposure that covers every pixel
+        self.newValue = 8.0
+        self.newVariance = 4.0
+        self.newExposure = makeExposure(numpy.ones(shape) * self.newValue, numpy.zeros(shape, numpy.uint16),
+            numpy.ones(shape) * self.newVariance, self.wcs)
+
+    def tearDown(self):
+        del self.seedExposure
+        del self.seedWeightMap
+        del self.newExposure
+
+    def testFromNormalizedCoadd(self):
+        """The recovered sum must be 0, not NaN, where the seed has no data"""
+        partialCoadd = coaddState.PartialCoadd.fromNormalizedCoadd(coaddState.WeightedMeanCoaddType,
+            self.seedExposure, self.seedWeightMap)
+        sumMaskedImage = partialCoadd.sumExposure.getMaskedImage()
+        for plane in (sumMaskedImage.getImage(), sumMaskedImage.getVariance()):
+            self.assertTrue(numpy.all(plane.getArray()[:, :NumUncovered] == 0))
+        self.assertTrue(numpy.all(sumMaskedImage.getMask().getArray() == 0))
+        self.assertTrue(numpy.allclose(sumMaskedImage.getImage().getArray()[:, NumUncovered:],
+            self.seedValue * self.seedWeight))
+        # the seed is not modified
+        self.assertTrue(numpy.isnan(self.seedExposure.getMaskedImage().getImage().getArray()[0, 0]))
+
+    def testCoverUncovered(self):
+        """Adding an exposure to a seeded coadd must give valid data where the seed had none"""
+        newWeight = 1.0 / self.newVariance
+        combinedWeight = self.seedWeight + newWeight
+        for layout in (None, compactCoadd.CompactLayout()):
+            partialCoadd = coaddState.PartialCoadd.fromNormalizedCoadd(coaddState.WeightedMeanCoaddType,
+                self.seedExposure, self.seedWeightMap)
+            coadd = partialCoadd.makeCoadd(AllowedMaskPlanes, layout)
+            coadd.addExposure(self.newExposure)
+            coaddMaskedImage = coadd.getCoadd().getMaskedImage()
+            image = coaddMaskedImage.getImage().getArray()
+            variance = coaddMaskedImage.getVariance().getArray()
+            mask = coaddMaskedImage.getMask().getArray()
+
+            self.assertTrue(numpy.all(numpy.isfinite(image)))
+            self.assertTrue(numpy.all(numpy.isfinite(variance)))
+            self.assertTrue(numpy.all(mask == 0))
+            self.assertTrue(numpy.allclose(image[:, :NumUncovered], self.newValue))
+            self.assertTrue(numpy.allclose(variance[:, :NumUncovered], self.newVariance))
+            self.assertTrue(numpy.allclose(image[:, NumUncovered:],
+                (self.seedWeight * self.seedValue + newWeight * self.newValue) / combinedWeight))
+            self.assertTrue(numpy.allclose(variance[:, NumUncovered:],
+                (self.seedWeight**2 * self.seedVariance + newWeight**2 * self.newVariance) \
+                / combinedWeight**2))
+            weightMap = coadd.getWeightMap().getArray()
+            self.assertTrue(numpy.allclose(weightMap[:, :NumUncovered], newWeight))
+            self.assertTrue(numpy.allclose(weightMap[:, NumUncovered:], combinedWeight))
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(SeedTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
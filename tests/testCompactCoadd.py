@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.compactCoadd
+
+The coadd of many exposures is compared to the same sums accumulated in float64
+to check the accuracy documented in compactCoadd.
+"""
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline.compactCoadd as compactCoadd
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+Width = 40
+Height = 30
+AllowedMaskPlanes = "DETECTED"
+
+def makeExposure(imageArray, maskArray, varianceArray, wcs):
+    """Make an afwImage.ExposureF from image, mask and variance arrays"""
+    height, width = imageArray.shape
+    maskedImage = afwImage.MaskedImageF(width, height)
+    maskedImage.getImage().getArray()[:, :] = imageArray
+    maskedImage.getMask().getArray()[:, :] = maskArray
+    maskedImage.getVariance().getArray()[:, :] = varianceArray
+    return afwImage.makeExposure(maskedImage, wcs)
+
+def makeExposureList(numExposures, seed):
+    """Make a list of exposures with positive pixel values, some pixels masked DETECTED (allowed)
+    and some masked BAD (ignored); the top row is BAD in every exposure.
+    """
+    rand = numpy.random.RandomState(seed)
+    wcs = syntheticData.makeWcs((150.0, 2.0), (Width / 2.0, Height / 2.0), 0.2, 0.0)
+    detectedBit = afwImage.MaskU.getPlaneBitMask("DETECTED")
+    badBit = afwImage.MaskU.getPlaneBitMask("BAD")
+    exposureList = []
+    for i in range(numExposures):
+        imageArray = rand.normal(1000.0, 30.0, (Height, Width))
+        varianceArray = numpy.ones((Height, Width)) * rand.uniform(500.0, 1500.0)
+        maskArray = numpy.zeros((Height, Width), dtype=numpy.uint16)
+        maskArray[rand.uniform(size=(Height, Width)) < 0.02] |= detectedBit
+        maskArray[rand.uniform(size=(Height, Width)) < 0.01] |= badBit
+        maskArray[-1, :] = badBit
+        exposureList.append(makeExposure(imageArray, maskArray, varianceArray, wcs))
+    return exposureList
+
+def computeReference(exposureList, isChiSquared=False, countWeights=False):
+    """Compute the coadd sums in float64
+    
+    @return imageSum, varianceSum, weightSum, mask (arrays)
+    """
+    badPixelMask = ~afwImage.MaskU.getPlaneBitMask("DETECTED") & 0xFFFF
+    imageSum = numpy.zeros((Height, Width))
+    varianceSum = numpy.zeros((Height, Width))
+    weightSum = numpy.zeros((Height, Width))
+    mask = numpy.zeros((Height, Width), dtype=numpy.uint16)
+    for exposure in exposureList:
+        maskedImage = exposure.getMaskedImage()
+        image = maskedImage.getImage().getArray().astype(numpy.float64)
+        variance = maskedImage.getVariance().getArray().astype(numpy.float64)
+        exposureMask = maskedImage.getMask().getArray()
+        isGood = (exposureMask & badPixelMask) == 0
+        if isChiSquared:
+            imageSum[isGood] += image[isGood]**2 / variance[isGood]
+            weightSum[isGood] += 1
+        else:
+            weight = 1.0
+            if not countWeights:
+                weight = isGood.sum() / variance[isGood].sum()
+            imageSum[isGood] += weight * image[isGood]
+            varianceSum[isGood] += weight**2 * variance[isGood]
+            weightSum[isGood] += weight
+        mask[isGood] |= exposureMask[isGood]
+    return imageSum, varianceSum, weightSum, mask
+
+def makeCoadd(exposureList, layout, isChiSquared=False):
+    bbox = afwImage.BBox(afwImage.PointI(0, 0), Width, Height)
+    coadd = compactCoadd.CompactCoadd(bbox, exposureList[0].getWcs(), AllowedMaskPlanes, layout,
+        isChiSquared=isChiSquared)
+    for exposure in exposureList:
+        coadd.addExposure(exposure)
+    return coadd
+
+def divide(numerator, denominator):
+    """Return numerator / denominator where denominator > 0, else 0"""
+    hasData = denominator > 0
+    return numpy.where(hasData, numerator, 0.0) / numpy.where(hasData, denominator, 1.0)
+
+def getMaxRelErr(array, refArray, isGood):
+    return numpy.abs(array[isGood] / refArray[isGood] - 1.0).max()
+
+class CompactCoaddTestCase(unittest.TestCase):
+    """A test case for CompactCoadd"""
+    def setUp(self):
+        self.exposureList = makeExposureList(500, seed=1)
+
+    def tearDown(self):
+        del self.exposureList
+
+    def testWeightedMean(self):
+        """With compensation the image must match float64 accumulation to 1e-6 relative,
+        and the variance and weight map to 1e-5 relative, with either mask layout
+        """
+        imageSum, varianceSum, weightSum, refMask = computeReference(self.exposureList)
+        hasData = weightSum > 0
+        self.assertFalse(hasData[-1, :].any())
+        self.assertTrue(hasData[:-1, :].all())
+        for packMask in (False, True):
+            layout = compactCoadd.CompactLayout(compensated=True, packMask=packMask)
+            coadd = makeCoadd(self.exposureList, layout)
+            coaddMaskedImage = coadd.getCoadd().getMaskedImage()
+            image = coaddMaskedImage.getImage().getArray()
+            variance = coaddMaskedImage.getVariance().getArray()
+            mask = coaddMaskedImage.getMask().getArray()
+            self.assertTrue(getMaxRelErr(image, divide(imageSum, weightSum), hasData) < 1.0e-6)
+            self.assertTrue(getMaxRelErr(variance, divide(varianceSum, weightSum**2), hasData) < 1.0e-5)
+            self.assertTrue(getMaxRelErr(coadd.getWeightMap().getArray(), weightSum, hasData) < 1.0e-5)
+            self.assertTrue(numpy.all(mask[hasData] == refMask[hasData]))
+            # pixels with no data have image and variance 0 and are masked EDGE
+            self.assertTrue(numpy.all(image[~hasData] == 0))
+            self.assertTrue(numpy.all(variance[~hasData] == 0))
+            self.assertTrue(numpy.all(mask[~hasData] == afwImage.MaskU.getPlaneBitMask("EDGE")))
+
+    def testCompensationHelps(self):
+        """Compensated summation must be more accurate than plain float32 summation"""
+        imageSum, varianceSum, weightSum, refMask = computeReference(self.exposureList)
+        hasData = weightSum > 0
+        errList = []
+        for compensated in (True, False):
+            coadd = makeCoadd(self.exposureList, compactCoadd.CompactLayout(compensated=compensated))
+            image = coadd.getCoadd().getMaskedImage().getImage().getArray()
+            errList.append(getMaxRelErr(image, divide(imageSum, weightSum), hasData))
+        self.assertTrue(errList[0] < errList[1])
+
+    def testChiSquared(self):
+        """A chi-squared coadd must match float64 accumulation to 1e-6 relative, with an exact count"""
+        imageSum, varianceSum, weightSum, refMask = computeReference(self.exposureList, isChiSquared=True)
+        hasData = weightSum > 0
+        coadd = makeCoadd(self.exposureList, compactCoadd.CompactLayout(), isChiSquared=True)
+        image = coadd.getCoadd().getMaskedImage().getImage().getArray()
+        self.assertTrue(getMaxRelErr(image, imageSum, hasData) < 1.0e-6)
+        self.assertTrue(numpy.all(coadd.getWeightMap().getArray() == weightSum))
+
+    def testCountWeights(self):
+        """With countWeights every exposure has weight 1 and the weight map is an exact count"""
+        imageSum, varianceSum, weightSum, refMask = computeReference(self.exposureList, countWeights=True)
+        hasData = weightSum > 0
+        coadd = makeCoadd(self.exposureList, compactCoadd.CompactLayout(countWeights=True))
+        image = coadd.getCoadd().getMaskedImage().getImage().getArray()
+        self.assertTrue(getMaxRelErr(image, divide(imageSum, weightSum), hasData) < 1.0e-6)
+        self.assertTrue(numpy.all(coadd.getWeightMap().getArray() == weightSum))
+
+    def testSetState(self):
+        """A coadd restored from its sum and weight map must continue where the original left off"""
+        layout = compactCoadd.CompactLayout()
+        numFirst = len(self.exposureList) // 2
+        partialCoadd = makeCoadd(self.exposureList[:numFirst], layout)
+        bbox = afwImage.BBox(afwImage.PointI(0, 0), Width, Height)
+        coadd = compactCoadd.CompactCoadd(bbox, partialCoadd.getWcs(), AllowedMaskPlanes, layout)
+        coadd.setState(partialCoadd.getSumMaskedImage(), partialCoadd.getWeightMap())
+        for exposure in self.exposureList[numFirst:]:
+            coadd.addExposure(exposure)
+
+        imageSum, varianceSum, weightSum, refMask = computeReference(self.exposureList)
+        hasData = weightSum > 0
+        coaddMaskedImage = coadd.getCoadd().getMaskedImage()
+        self.assertTrue(getMaxRelErr(coaddMaskedImage.getImage().getArray(), divide(imageSum, weightSum),
+            hasData) < 1.0e-6)
+        self.assertTrue(numpy.all(coaddMaskedImage.getMask().getArray()[hasData] == refMask[hasData]))
+
+    def testWrongDimensions(self):
+        layout = compactCoadd.CompactLayout()
+        bbox = afwImage.BBox(afwImage.PointI(0, 0), Width + 1, Height)
+        coadd = compactCoadd.CompactCoadd(bbox, self.exposureList[0].getWcs(), AllowedMaskPlanes, layout)
+        self.assertRaises(RuntimeError, coadd.addExposure, self.exposureList[0])
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(CompactCoaddTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for the footprint geometry of lsst.coadd.pipeline.exposureIndex
+"""
+import unittest
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline.exposureIndex as exposureIndex
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+def makeSquare(x0, y0, size):
+    return [(x0, y0), (x0 + size, y0), (x0 + size, y0 + size), (x0, y0 + size)]
+
+class PolygonTestCase(unittest.TestCase):
+    """A test case for the plane polygon functions"""
+    def testPointInPolygon(self):
+        square = makeSquare(0.0, 0.0, 1.0)
+        self.assertTrue(exposureIndex.pointInPolygon((0.5, 0.5), square))
+        self.assertTrue(exposureIndex.pointInPolygon((0.01, 0.99), square))
+        self.assertFalse(exposureIndex.pointInPolygon((1.5, 0.5), square))
+        self.assertFalse(exposureIndex.pointInPolygon((0.5, -0.5), square))
+        self.assertFalse(exposureIndex.pointInPolygon((-0.5, 0.5), square))
+
+        # concave "L" shape: the notch is outside
+        lShape = [(0.0, 0.0), (2.0, 0.0), (2.0, 1.0), (1.0, 1.0), (1.0, 2.0), (0.0, 2.0)]
+        self.assertTrue(exposureIndex.pointInPolygon((0.5, 1.5), lShape))
+        self.assertTrue(exposureIndex.pointInPolygon((1.5, 0.5), lShape))
+        self.assertFalse(exposureIndex.pointInPolygon((1.5, 1.5), lShape))
+
+    def testPolygonsOverlap(self):
+        square = makeSquare(0.0, 0.0, 1.0)
+        # partial overlap, containment either way, and disjoint
+        self.assertTrue(exposureIndex.polygonsOverlap(square, makeSquare(0.5, 0.5, 1.0)))
+        self.assertTrue(exposureIndex.polygonsOverlap(square, makeSquare(0.25, 0.25, 0.5)))
+        self.assertTrue(exposureIndex.polygonsOverlap(makeSquare(0.25, 0.25, 0.5), square))
+        self.assertFalse(exposureIndex.polygonsOverlap(square, makeSquare(1.5, 0.0, 1.0)))
+        self.assertFalse(exposureIndex.polygonsOverlap(square, makeSquare(-2.0, -2.0, 1.0)))
+        # a cross: neither polygon has a vertex inside the other, but the edges cross
+        horizontal = [(-1.0, 0.4), (2.0, 0.4), (2.0, 0.6), (-1.0, 0.6)]
+        vertical = [(0.4, -1.0), (0.6, -1.0), (0.6, 2.0), (0.4, 2.0)]
+        self.assertTrue(exposureIndex.polygonsOverlap(horizontal, vertical))
+
+class SkyPolygonTestCase(unittest.TestCase):
+    """A test case for sky polygons"""
+    def testSkyPolygonsOverlap(self):
+        self.assertTrue(exposureIndex.skyPolygonsOverlap(makeSquare(150.0, 2.0, 0.1),
+            makeSquare(150.05, 2.05, 0.1)))
+        self.assertFalse(exposureIndex.skyPolygonsOverlap(makeSquare(150.0, 2.0, 0.1),
+            makeSquare(150.2, 2.0, 0.1)))
+        # RA wraparound
+        self.assertTrue(exposureIndex.skyPolygonsOverlap(makeSquare(359.95, 0.0, 0.1),
+            makeSquare(0.0, 0.0, 0.1)))
+        self.assertFalse(exposureIndex.skyPolygonsOverlap(makeSquare(359.8, 0.0, 0.1),
+            makeSquare(0.0, 0.0, 0.1)))
+        # near a pole
+        self.assertTrue(exposureIndex.skyPolygonsOverlap(
+            [(0.0, 89.9), (90.0, 89.9), (180.0, 89.9), (270.0, 89.9)],
+            [(45.0, 89.95), (50.0, 89.95), (50.0, 89.97), (45.0, 89.97)]))
+
+    def testVectorBounds(self):
+        """The unit-vector bounds of a polygon must contain its vertices and its interior"""
+        skyPolygon = makeSquare(359.5, -1.0, 1.0)
+        bounds = exposureIndex.computeVectorBounds(skyPolygon)
+        for ra, dec in skyPolygon + [(0.0, -0.5), (359.99, -0.01)]:
+            vec = exposureIndex.skyToVector(ra, dec)
+            for i in range(3):
+                self.assertTrue(bounds[2 * i] <= vec[i] <= bounds[2 * i + 1])
+
+    def testComputeSkyPolygon(self):
+        """Sky polygons of exposures overlap if and only if their pixels overlap"""
+        width, height = 200, 100
+        wcs = syntheticData.makeWcs((150.0, 2.0), (100.5, 50.5), 0.2, 10.0)
+        bbox = afwImage.BBox(afwImage.PointI(0, 0), width, height)
+        skyPolygon = exposureIndex.computeSkyPolygon(wcs, bbox)
+        self.assertEqual(len(skyPolygon), 4 * exposureIndex.DefaultNumPerSide)
+        for x0, y0, isOverlapping in (
+            (150, 50, True),
+            (-50, -80, True),
+            (0, 0, True),
+            (220, 0, False),
+            (0, -120, False),
+        ):
+            otherBBox = afwImage.BBox(afwImage.PointI(x0, y0), 100, 100)
+            otherSkyPolygon = exposureIndex.computeSkyPolygon(wcs, otherBBox)
+            self.assertEqual(exposureIndex.skyPolygonsOverlap(skyPolygon, otherSkyPolygon), isOverlapping)
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(PolygonTestCase)
+    suites += unittest.makeSuite(SkyPolygonTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
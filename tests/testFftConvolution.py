@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.fftConvolve
+
+A synthetic exposure (see lsst.coadd.pipeline.syntheticData), with a few non-finite pixels added,
+is convolved with various kernels both directly (afwMath.convolve) and using FFTs. The image and variance
+must agree to within a tolerance (relative to the largest value of each plane); the mask, the pattern
+of non-finite pixels and the edge pixels (where the kernel does not fit) must agree exactly.
+"""
+import random
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.pex.policy as pexPolicy
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.coadd.pipeline.fftConvolve as fftConvolve
+import lsst.coadd.pipeline.policyCache as policyCache
+import lsst.coadd.pipeline.psfMatchToImageStage as psfMatchToImageStage
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+Tolerance = 1.0e-5 # maximum error of image and variance, relative to the largest value of the plane
+
+def makeConvolutionPolicy(mode=None):
+    """Make a convolution policy with the defaults of ConvolutionDictionary.paf, optionally overriding mode"""
+    policy = policyCache.mergeDefaults(pexPolicy.Policy(), "coadd_pipeline", "ConvolutionDictionary.paf")
+    if mode != None:
+        policy.set("mode", mode)
+    return policy
+
+def makeRandomKernel(width, height, ctrX, ctrY, rand):
+    """Make a random asymmetric kernel whose bottom row is zero, so the mask is ORed over a footprint
+    that differs from the kernel's bounding box
+    """
+    kernelImage = afwImage.ImageD(width, height)
+    kernelArray = kernelImage.getArray()
+    for y in range(1, height):
+        for x in range(width):
+            kernelArray[y, x] = rand.gauss(0, 1)
+    kernel = afwMath.FixedKernel(kernelImage)
+    kernel.setCtrX(ctrX)
+    kernel.setCtrY(ctrY)
+    return kernel
+
+def convolveBoth(maskedImage, kernel, blockSize):
+    """Convolve maskedImage with kernel directly and using FFTs
+    
+    @return directMaskedImage, fftMaskedImage
+    """
+    directMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+    afwMath.convolve(directMaskedImage, maskedImage, kernel, False)
+    fftMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+    fftConvolve.fftConvolve(fftMaskedImage, maskedImage, kernel, blockSize)
+    return directMaskedImage, fftMaskedImage
+
+def getPlaneList(maskedImage):
+    return [maskedImage.getImage().getArray(), maskedImage.getVariance().getArray()]
+
+def getEdgeSlices(kernel, width, height):
+    """Return slices (y, x) of the edge regions where the kernel does not fit: bottom, top, left, right"""
+    x1 = width - (kernel.getWidth() - 1 - kernel.getCtrX())
+    y1 = height - (kernel.getHeight() - 1 - kernel.getCtrY())
+    return [
+        (slice(0, kernel.getCtrY()), slice(None)),
+        (slice(y1, None), slice(None)),
+        (slice(None), slice(0, kernel.getCtrX())),
+        (slice(None), slice(x1, None)),
+    ]
+
+class FftConvolutionTestCase(unittest.TestCase):
+    """A test case comparing fftConvolve to afwMath.convolve"""
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.width = 200
+        self.height = 150
+        referenceExposure, exposureList = syntheticData.makeDataset(self.width, self.height, 0, seed=1)
+        self.maskedImage = referenceExposure.getMaskedImage()
+        for i in range(5):
+            self.maskedImage.getImage().set(self.rand.randint(0, self.width - 1),
+                self.rand.randint(0, self.height - 1), numpy.nan)
+        self.maskedImage.getVariance().set(100, 75, numpy.inf)
+        self.blockSize = makeConvolutionPolicy().get("fftBlockSize")
+
+    def tearDown(self):
+        del self.maskedImage
+
+    def assertConvolutionsAgree(self, kernel, blockSize, descr):
+        directMaskedImage, fftMaskedImage = convolveBoth(self.maskedImage, kernel, blockSize)
+        for directArray, fftArray in zip(getPlaneList(directMaskedImage), getPlaneList(fftMaskedImage)):
+            isFinite = numpy.isfinite(directArray)
+            self.assertTrue(numpy.all(isFinite == numpy.isfinite(fftArray)),
+                "%s: non-finite pixels differ" % (descr,))
+            self.assertTrue(isFinite.any())
+            scale = numpy.abs(directArray[isFinite]).max()
+            err = numpy.abs(directArray[isFinite].astype(numpy.float64) - fftArray[isFinite]).max() / scale
+            self.assertTrue(err <= Tolerance, "%s: relative error %0.2g > %0.2g" % (descr, err, Tolerance))
+        isMaskSame = directMaskedImage.getMask().getArray() == fftMaskedImage.getMask().getArray()
+        self.assertTrue(isMaskSame.all(), "%s: masks differ" % (descr,))
+
+    def testLargeInvariantKernel(self):
+        """Spatially invariant kernels larger than fftMinKernelSize, which auto mode convolves using FFTs"""
+        convolutionPolicy = makeConvolutionPolicy("auto")
+        fftMinKernelSize = convolutionPolicy.get("fftMinKernelSize")
+        for kernelSize in (fftMinKernelSize + 4, 41):
+            sigma = kernelSize / 6.0
+            kernel = afwMath.AnalyticKernel(kernelSize, kernelSize, afwMath.GaussianFunction2D(sigma, sigma))
+            self.assertTrue(psfMatchToImageStage.useFftConvolution(kernel, convolutionPolicy))
+            self.assertConvolutionsAgree(kernel, self.blockSize, "gaussian %dx%d" % (kernelSize, kernelSize))
+
+            randomKernel = makeRandomKernel(kernelSize, kernelSize, kernelSize // 4, (3 * kernelSize) // 4,
+                self.rand)
+            self.assertTrue(psfMatchToImageStage.useFftConvolution(randomKernel, convolutionPolicy))
+            self.assertConvolutionsAgree(randomKernel, self.blockSize,
+                "random %dx%d" % (kernelSize, kernelSize))
+
+    def testBlockSizes(self):
+        """The result must not depend on the block size, including blocks smaller than the kernel"""
+        kernel = makeRandomKernel(25, 21, 3, 17, self.rand)
+        for blockSize in (16, 64, 100, 1000):
+            self.assertConvolutionsAgree(kernel, blockSize, "block size %d" % (blockSize,))
+
+    def testEdgePixels(self):
+        """Edge pixels (where the kernel does not fit) must be set exactly as afwMath.convolve sets them"""
+        kernel = makeRandomKernel(25, 31, 20, 4, self.rand)
+        directMaskedImage, fftMaskedImage = convolveBoth(self.maskedImage, kernel, self.blockSize)
+        directArrayList = getPlaneList(directMaskedImage) + [directMaskedImage.getMask().getArray()]
+        fftArrayList = getPlaneList(fftMaskedImage) + [fftMaskedImage.getMask().getArray()]
+        for edgeSlices in getEdgeSlices(kernel, self.width, self.height):
+            for directArray, fftArray in zip(directArrayList, fftArrayList):
+                directEdge = directArray[edgeSlices]
+                fftEdge = fftArray[edgeSlices]
+                self.assertTrue(directEdge.size > 0)
+                isSame = (directEdge == fftEdge) | (numpy.isnan(directEdge) & numpy.isnan(fftEdge))
+                self.assertTrue(isSame.all())
+
+    def testSmallImage(self):
+        """An image smaller than the kernel is all edge pixels"""
+        kernel = makeRandomKernel(41, 41, 20, 20, self.rand)
+        maskedImage = afwImage.MaskedImageF(self.maskedImage,
+            afwImage.BBox(afwImage.PointI(10, 10), 30, 50))
+        directMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+        afwMath.convolve(directMaskedImage, maskedImage, kernel, False)
+        fftMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+        fftConvolve.fftConvolve(fftMaskedImage, maskedImage, kernel, self.blockSize)
+        for directArray, fftArray in zip(getPlaneList(directMaskedImage), getPlaneList(fftMaskedImage)):
+            isSame = (directArray == fftArray) | (numpy.isnan(directArray) & numpy.isnan(fftArray))
+            self.assertTrue(isSame.all())
+        isMaskSame = directMaskedImage.getMask().getArray() == fftMaskedImage.getMask().getArray()
+        self.assertTrue(isMaskSame.all())
+
+    def testUseFftConvolution(self):
+        """Test the selection of FFT convolution by convolutionPolicy.mode"""
+        fftMinKernelSize = makeConvolutionPolicy().get("fftMinKernelSize")
+        smallKernel = afwMath.AnalyticKernel(fftMinKernelSize - 2, fftMinKernelSize - 2,
+            afwMath.GaussianFunction2D(2.0, 2.0))
+        largeKernel = afwMath.AnalyticKernel(fftMinKernelSize, fftMinKernelSize,
+            afwMath.GaussianFunction2D(4.0, 4.0))
+        basisKernelList = afwMath.KernelList()
+        basisKernelList.append(largeKernel)
+        varyingKernel = afwMath.LinearCombinationKernel(basisKernelList, afwMath.PolynomialFunction2D(1))
+        varyingKernel.setSpatialParameters([[1.0, 1.0e-3, 0.0]])
+        for mode, kernel, isFft in (
+            ("auto", smallKernel, False),
+            ("auto", largeKernel, True),
+            ("auto", varyingKernel, False),
+            ("direct", largeKernel, False),
+            ("fft", smallKernel, True),
+            ("fft", varyingKernel, True),
+        ):
+            convolutionPolicy = makeConvolutionPolicy(mode)
+            self.assertEqual(psfMatchToImageStage.useFftConvolution(kernel, convolutionPolicy), isFft)
+        self.assertEqual(psfMatchToImageStage.useFftConvolution(largeKernel, None), False)
+        self.assertRaises(RuntimeError, psfMatchToImageStage.useFftConvolution, largeKernel,
+            makeConvolutionPolicy("bogus"))
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(FftConvolutionTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.parallelUtils
+"""
+import threading
+import time
+import unittest
+
+import lsst.utils.tests as utilsTests
+import lsst.coadd.pipeline.parallelUtils as parallelUtils
+
+class TestError(Exception):
+    pass
+
+def square(arg):
+    # sleep longer for earlier arguments so that calls finish out of order
+    time.sleep(0.001 * (10 - arg % 10))
+    return arg * arg
+
+def squareOrRaise(arg):
+    if arg == 5:
+        raise TestError("arg=%s" % (arg,))
+    return arg * arg
+
+class ParallelUtilsTestCase(unittest.TestCase):
+    """A test case for parallelUtils"""
+    def testRunInThreads(self):
+        """Results must be in the order of the arguments, for any number of threads"""
+        argList = range(25)
+        for numThreads in (0, 1, 3, 8, 100):
+            self.assertEqual(parallelUtils.runInThreads(square, argList, numThreads),
+                [arg * arg for arg in argList])
+        self.assertEqual(parallelUtils.runInThreads(square, [], 4), [])
+
+    def testRunInThreadsUsesThreads(self):
+        """With numThreads > 1 the calls must run concurrently"""
+        lock = threading.Lock()
+        state = dict(numRunning=0, maxNumRunning=0)
+        def func(arg):
+            lock.acquire()
+            state["numRunning"] += 1
+            state["maxNumRunning"] = max(state["maxNumRunning"], state["numRunning"])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            state["numRunning"] -= 1
+            lock.release()
+            return arg
+        parallelUtils.runInThreads(func, range(4), 4)
+        self.assertTrue(state["maxNumRunning"] > 1)
+
+    def testRunInThreadsRaises(self):
+        """An exception raised by func must be raised in the calling thread"""
+        for numThreads in (1, 4):
+            self.assertRaises(TestError, parallelUtils.runInThreads, squareOrRaise, range(10), numThreads)
+
+    def testPrefetch(self):
+        """Results must be (arg, result) in the order of the arguments"""
+        argList = range(15)
+        for numAhead in (0, 1, 4, 100):
+            self.assertEqual(list(parallelUtils.prefetch(square, argList, numAhead)),
+                [(arg, arg * arg) for arg in argList])
+        self.assertEqual(list(parallelUtils.prefetch(square, [], 2)), [])
+
+    def testPrefetchRaises(self):
+        """Results before the failing call must be returned, then the exception raised"""
+        for numAhead in (0, 2):
+            resultList = []
+            def consume():
+                for arg, result in parallelUtils.prefetch(squareOrRaise, range(10), numAhead):
+                    resultList.append(result)
+            self.assertRaises(TestError, consume)
+            self.assertEqual(resultList, [arg * arg for arg in range(5)])
+
+    def testPrefetchStopsEarly(self):
+        """Abandoning the generator must stop the background thread"""
+        numCalls = [0]
+        def func(arg):
+            numCalls[0] += 1
+            return arg
+        for arg, result in parallelUtils.prefetch(func, range(1000), 2):
+            if arg == 3:
+                break
+        time.sleep(0.5)
+        self.assertTrue(numCalls[0] < 10)
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ParallelUtilsTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for the threaded convolution of lsst.coadd.pipeline.psfMatchToImageStage
+
+Convolving an exposure in strips with several threads must give exactly the same pixels
+as convolving it in one call.
+"""
+import random
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.coadd.pipeline.psfMatchToImageStage as psfMatchToImageStage
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+def makeKernelList():
+    """Make a list of (description, kernel): spatially invariant kernels, one of them off-center,
+    and a spatially varying kernel
+    """
+    rand = random.Random(0)
+    gaussianKernel = afwMath.AnalyticKernel(11, 11, afwMath.GaussianFunction2D(2.0, 2.0))
+
+    kernelImage = afwImage.ImageD(9, 7)
+    kernelArray = kernelImage.getArray()
+    for y in range(kernelImage.getHeight()):
+        for x in range(kernelImage.getWidth()):
+            kernelArray[y, x] = rand.uniform(0.0, 1.0)
+    offCenterKernel = afwMath.FixedKernel(kernelImage)
+    offCenterKernel.setCtrX(2)
+    offCenterKernel.setCtrY(5)
+
+    basisKernelList = afwMath.KernelList()
+    for sigma in (1.0, 2.5):
+        basisKernelList.append(afwMath.AnalyticKernel(9, 9, afwMath.GaussianFunction2D(sigma, sigma)))
+    varyingKernel = afwMath.LinearCombinationKernel(basisKernelList, afwMath.PolynomialFunction2D(1))
+    varyingKernel.setSpatialParameters([[1.0, 0.0, 0.0], [0.0, 1.0e-3, 2.0e-3]])
+    return [
+        ("gaussian", gaussianKernel),
+        ("off-center", offCenterKernel),
+        ("spatially varying", varyingKernel),
+    ]
+
+class ThreadedConvolutionTestCase(unittest.TestCase):
+    """A test case for convolveExposure with numThreads > 1"""
+    def setUp(self):
+        referenceExposure, exposureList = syntheticData.makeDataset(120, 97, 0, seed=1)
+        self.exposure = referenceExposure
+        maskedImage = self.exposure.getMaskedImage()
+        # a non-zero xy0, so that spatially varying kernels must be evaluated in parent coordinates
+        maskedImage.setXY0(afwImage.PointI(31, -17))
+        maskedImage.getImage().getArray()[50, 60] = numpy.nan
+
+    def tearDown(self):
+        del self.exposure
+
+    def assertExposuresIdentical(self, exposure1, exposure2, descr):
+        maskedImage1 = exposure1.getMaskedImage()
+        maskedImage2 = exposure2.getMaskedImage()
+        self.assertEqual((maskedImage1.getX0(), maskedImage1.getY0()),
+            (maskedImage2.getX0(), maskedImage2.getY0()))
+        for getPlane in (lambda mi: mi.getImage(), lambda mi: mi.getMask(), lambda mi: mi.getVariance()):
+            array1 = getPlane(maskedImage1).getArray()
+            array2 = getPlane(maskedImage2).getArray()
+            isSame = (array1 == array2) | (numpy.isnan(array1) & numpy.isnan(array2))
+            self.assertTrue(isSame.all(), "%s: %d pixels differ" % (descr, (~isSame).sum()))
+
+    def testNumThreads(self):
+        """numThreads = 4 must give the same pixels as numThreads = 1 and as afwMath.convolve"""
+        maskedImage = self.exposure.getMaskedImage()
+        for kernelDescr, kernel in makeKernelList():
+            serialExposure = psfMatchToImageStage.convolveExposure(self.exposure, kernel, 1)
+            directMaskedImage = afwImage.MaskedImageF(maskedImage.getWidth(), maskedImage.getHeight())
+            directMaskedImage.setXY0(maskedImage.getXY0())
+            afwMath.convolve(directMaskedImage, maskedImage, kernel, False)
+            self.assertExposuresIdentical(serialExposure,
+                afwImage.makeExposure(directMaskedImage, self.exposure.getWcs()), kernelDescr)
+            for numThreads in (2, 4, 7):
+                threadedExposure = psfMatchToImageStage.convolveExposure(self.exposure, kernel, numThreads)
+                self.assertExposuresIdentical(serialExposure, threadedExposure,
+                    "%s with %d threads" % (kernelDescr, numThreads))
+
+    def testStripList(self):
+        """Strips must cover every row once, and be padded by the kernel's extent"""
+        for kernelDescr, kernel in makeKernelList():
+            for height, numStrips in ((97, 4), (97, 1), (20, 4), (5, 4)):
+                stripList = psfMatchToImageStage.makeStripList(height, kernel, numStrips)
+                self.assertTrue(1 <= len(stripList) <= numStrips)
+                self.assertEqual(stripList[0][0], 0)
+                self.assertEqual(stripList[-1][1], height)
+                for ind, (y0, y1, paddedY0, paddedY1) in enumerate(stripList):
+                    if ind > 0:
+                        self.assertEqual(y0, stripList[ind - 1][1])
+                    self.assertTrue(y1 - y0 >= min(height, kernel.getHeight()))
+                    self.assertEqual(paddedY0, max(0, y0 - kernel.getCtrY()))
+                    self.assertEqual(paddedY1, min(height, y1 + kernel.getHeight() - 1 - kernel.getCtrY()))
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ThreadedConvolutionTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+
+"""Tests for the star moments of lsst.coadd.pipeline.psfMoments
+"""
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.coadd.pipeline.psfMoments as psfMoments
+
+def makeStarImage(sigmaX, sigmaY, flux=1000.0, size=41):
+    """Make a noiseless image of an elliptical Gaussian star at the center of a size x size array"""
+    ctr = size // 2
+    y, x = numpy.mgrid[0:size, 0:size].astype(float)
+    return flux / (2 * numpy.pi * sigmaX * sigmaY) \
+        * numpy.exp(-0.5 * ((x - ctr)**2 / sigmaX**2 + (y - ctr)**2 / sigmaY**2))
+
+class MeasureMomentsTestCase(unittest.TestCase):
+    """A test case for measureMoments"""
+    def testGaussianStar(self):
+        """The corrected moments of a Gaussian star are its sigma^2, with an adaptive or fixed weight"""
+        image = makeStarImage(3.0, 1.5)
+        for weightSigma2 in (None, 4.0, 20.0):
+            flux, ixx, iyy, ixy, dumWeightSigma2 = psfMoments.measureMoments(image, 20, 20, 15,
+                weightSigma2=weightSigma2)
+            self.assertAlmostEqual(ixx, 9.0, 4)
+            self.assertAlmostEqual(iyy, 2.25, 4)
+            self.assertAlmostEqual(ixy, 0.0, 6)
+
+    def testReturnedWeight(self):
+        """The returned weight is the one flux and the moments were measured with"""
+        image = makeStarImage(2.0, 2.5)
+        for numIter in (1, 2, 5):
+            adaptiveResult = psfMoments.measureMoments(image, 20, 20, 15, numIter=numIter)
+            weightSigma2 = adaptiveResult[4]
+            fixedResult = psfMoments.measureMoments(image, 20, 20, 15, weightSigma2=weightSigma2,
+                numIter=numIter)
+            for adaptiveValue, fixedValue in zip(adaptiveResult, fixedResult):
+                self.assertAlmostEqual(adaptiveValue, fixedValue, 10)
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(MeasureMomentsTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.robustCoaddStage.RobustMeanAccumulator
+"""
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline.robustCoaddStage as robustCoaddStage
+import lsst.coadd.pipeline.syntheticData as syntheticData
+
+Width = 30
+Height = 20
+NumExposures = 20
+
+def makeExposure(imageArray, maskArray, varianceArray, wcs):
+    """Make an afwImage.ExposureF from image, mask and variance arrays"""
+    height, width = imageArray.shape
+    maskedImage = afwImage.MaskedImageF(width, height)
+    maskedImage.getImage().getArray()[:, :] = imageArray
+    maskedImage.getMask().getArray()[:, :] = maskArray
+    maskedImage.getVariance().getArray()[:, :] = varianceArray
+    return afwImage.makeExposure(maskedImage, wcs)
+
+class RobustMeanAccumulatorTestCase(unittest.TestCase):
+    """A test case for RobustMeanAccumulator"""
+    def setUp(self):
+        rand = numpy.random.RandomState(1)
+        wcs = syntheticData.makeWcs((150.0, 2.0), (Width / 2.0, Height / 2.0), 0.2, 0.0)
+        self.badBit = afwImage.MaskU.getPlaneBitMask("BAD")
+        self.exposureList = []
+        for i in range(NumExposures):
+            imageArray = rand.normal(10.0, 1.0, (Height, Width))
+            varianceArray = numpy.ones((Height, Width)) * (1.0 + 0.1 * i)
+            maskArray = numpy.zeros((Height, Width), dtype=numpy.uint16)
+            maskArray[0, 0] = self.badBit # pixel (0, 0) has no good data
+            if i > 1:
+                maskArray[0, 1] = self.badBit # pixel (1, 0) has good data in only two exposures
+            self.exposureList.append(makeExposure(imageArray, maskArray, varianceArray, wcs))
+
+    def tearDown(self):
+        del self.exposureList
+
+    def getArrays(self, exposureList):
+        """Return the image stack, good pixel stack and weight of each exposure, as numpy arrays"""
+        imageList = []
+        isGoodList = []
+        weightList = []
+        for exposure in exposureList:
+            maskedImage = exposure.getMaskedImage()
+            isGood = (maskedImage.getMask().getArray() & self.badBit) == 0
+            variance = maskedImage.getVariance().getArray().astype(numpy.float64)
+            imageList.append(maskedImage.getImage().getArray().astype(numpy.float64))
+            isGoodList.append(isGood)
+            weightList.append(isGood.sum() / variance[isGood].sum())
+        return numpy.array(imageList), numpy.array(isGoodList), numpy.array(weightList)
+
+    def makeCoadd(self, numSigma, minNumForClip):
+        accumulator = robustCoaddStage.RobustMeanAccumulator(self.exposureList[0], self.badBit)
+        for exposure in self.exposureList:
+            accumulator.addToStatistics(exposure)
+        accumulator.computeClipLimits(numSigma, minNumForClip)
+        for exposure in self.exposureList:
+            accumulator.addToCoadd(exposure)
+        coadd, weightMap = accumulator.getCoadd()
+        return accumulator, coadd, weightMap
+
+    def testWeightedMean(self):
+        """With no rejection the coadd must be the weighted mean of the good pixels"""
+        imageStack, isGoodStack, weightArr = self.getArrays(self.exposureList)
+        weightStack = isGoodStack * weightArr[:, numpy.newaxis, numpy.newaxis]
+        refWeightSum = weightStack.sum(axis=0)
+        hasData = refWeightSum > 0
+        refImage = (weightStack * imageStack).sum(axis=0) / numpy.where(hasData, refWeightSum, 1.0)
+
+        accumulator, coadd, weightMap = self.makeCoadd(1000.0, 1)
+        self.assertEqual(accumulator.numRejected, 0)
+        image = coadd.getMaskedImage().getImage().getArray()
+        mask = coadd.getMaskedImage().getMask().getArray()
+        self.assertTrue(numpy.abs(image[hasData] - refImage[hasData]).max() < 1.0e-5)
+        self.assertTrue(numpy.abs(weightMap.getArray()[hasData] / refWeightSum[hasData] - 1.0).max() < 1.0e-6)
+        self.assertFalse(hasData[0, 0])
+        self.assertEqual(image[0, 0], 0)
+        self.assertEqual(mask[0, 0], afwImage.MaskU.getPlaneBitMask("EDGE"))
+
+    def testRejectOutlier(self):
+        """An outlier must be rejected, leaving the weighted mean of the other exposures"""
+        outlierInd = 3
+        self.exposureList[outlierInd].getMaskedImage().getImage().getArray()[5, 5] = 1000.0
+        accumulator, coadd, weightMap = self.makeCoadd(3.0, 3)
+        self.assertTrue(accumulator.numRejected >= 1)
+
+        otherList = self.exposureList[:outlierInd] + self.exposureList[outlierInd + 1:]
+        imageStack, isGoodStack, weightArr = self.getArrays(otherList)
+        refValue = (weightArr * imageStack[:, 5, 5]).sum() / weightArr.sum()
+        self.assertAlmostEqual(coadd.getMaskedImage().getImage().getArray()[5, 5], refValue, 4)
+        self.assertAlmostEqual(weightMap.getArray()[5, 5] / weightArr.sum(), 1.0, 6)
+
+    def testMinNumForClip(self):
+        """Pixels with fewer than minNumForClip good exposures must not be clipped"""
+        self.exposureList[0].getMaskedImage().getImage().getArray()[0, 1] = 1000.0
+        accumulator, coadd, weightMap = self.makeCoadd(0.01, 3)
+        imageStack, isGoodStack, weightArr = self.getArrays(self.exposureList[:2])
+        refValue = (weightArr * imageStack[:, 0, 1]).sum() / weightArr.sum()
+        self.assertAlmostEqual(coadd.getMaskedImage().getImage().getArray()[0, 1], refValue, 3)
+
+    def testCallOrder(self):
+        accumulator = robustCoaddStage.RobustMeanAccumulator(self.exposureList[0], self.badBit)
+        self.assertRaises(RuntimeError, accumulator.addToCoadd, self.exposureList[0])
+        self.assertRaises(RuntimeError, accumulator.getCoadd)
+        accumulator.addToStatistics(self.exposureList[0])
+        accumulator.computeClipLimits(3.0, 3)
+        self.assertRaises(RuntimeError, accumulator.addToStatistics, self.exposureList[0])
+
+    def testWrongDimensions(self):
+        accumulator = robustCoaddStage.RobustMeanAccumulator(self.exposureList[0], self.badBit)
+        maskedImage = afwImage.MaskedImageF(Width + 1, Height)
+        exposure = afwImage.makeExposure(maskedImage, self.exposureList[0].getWcs())
+        self.assertRaises(RuntimeError, accumulator.addToStatistics, exposure)
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(RobustMeanAccumulatorTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)
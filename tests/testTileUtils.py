@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Tests for lsst.coadd.pipeline.tileUtils
+"""
+import unittest
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.coadd.pipeline.tileUtils as tileUtils
+
+def makeBBox(x0, y0, width, height):
+    return afwImage.BBox(afwImage.PointI(x0, y0), width, height)
+
+def getBBoxTuple(bbox):
+    return (bbox.getX0(), bbox.getY0(), bbox.getWidth(), bbox.getHeight())
+
+class TileUtilsTestCase(unittest.TestCase):
+    """A test case for tileUtils"""
+    def testTilesCoverImage(self):
+        """Tiles must exactly cover the image area, in row-major order"""
+        for width, height, tileWidth, tileHeight in (
+            (100, 60, 32, 32),
+            (100, 60, 100, 60),
+            (100, 60, 200, 7),
+            (1, 1, 32, 32),
+        ):
+            bboxList = tileUtils.makeTileBBoxList(width, height, tileWidth, tileHeight)
+            numCovered = [[0] * width for y in range(height)]
+            lastStart = None
+            for bbox in bboxList:
+                self.assertTrue(0 < bbox.getWidth() <= tileWidth)
+                self.assertTrue(0 < bbox.getHeight() <= tileHeight)
+                start = (bbox.getY0(), bbox.getX0())
+                if lastStart != None:
+                    self.assertTrue(start > lastStart)
+                lastStart = start
+                for y in range(bbox.getY0(), bbox.getY0() + bbox.getHeight()):
+                    for x in range(bbox.getX0(), bbox.getX0() + bbox.getWidth()):
+                        numCovered[y][x] += 1
+            for row in numCovered:
+                self.assertEqual(row, [1] * width)
+
+    def testRowBands(self):
+        """A tile size <= 0 spans the full width or height"""
+        bboxList = tileUtils.makeTileBBoxList(100, 60, 0, 25)
+        self.assertEqual([getBBoxTuple(bbox) for bbox in bboxList],
+            [(0, 0, 100, 25), (0, 25, 100, 25), (0, 50, 100, 10)])
+        bboxList = tileUtils.makeTileBBoxList(100, 60, -1, -1)
+        self.assertEqual([getBBoxTuple(bbox) for bbox in bboxList], [(0, 0, 100, 60)])
+
+    def testOverlap(self):
+        """Test getOverlapBBox"""
+        bbox1 = makeBBox(10, 20, 30, 40)
+        self.assertEqual(getBBoxTuple(tileUtils.getOverlapBBox(bbox1, makeBBox(30, 0, 100, 25))),
+            (30, 20, 10, 5))
+        self.assertEqual(getBBoxTuple(tileUtils.getOverlapBBox(bbox1, bbox1)), getBBoxTuple(bbox1))
+        self.assertEqual(getBBoxTuple(tileUtils.getOverlapBBox(bbox1, makeBBox(-5, -5, 100, 100))),
+            getBBoxTuple(bbox1))
+        # boxes that only touch do not overlap
+        self.assertEqual(tileUtils.getOverlapBBox(bbox1, makeBBox(40, 20, 10, 10)), None)
+        self.assertEqual(tileUtils.getOverlapBBox(bbox1, makeBBox(10, 60, 10, 10)), None)
+        self.assertEqual(tileUtils.getOverlapBBox(bbox1, makeBBox(-50, -50, 10, 10)), None)
+
+    def testPatches(self):
+        """Test getPatchBBox and getOverlappingPatchIdList, including negative coordinates"""
+        self.assertEqual(getBBoxTuple(tileUtils.getPatchBBox("2,3", 100, 50)), (200, 150, 100, 50))
+        self.assertEqual(getBBoxTuple(tileUtils.getPatchBBox("-1,-2", 100, 50)), (-100, -100, 100, 50))
+
+        self.assertEqual(tileUtils.getOverlappingPatchIdList(makeBBox(0, 0, 100, 50), 100, 50), ["0,0"])
+        self.assertEqual(tileUtils.getOverlappingPatchIdList(makeBBox(99, 49, 2, 2), 100, 50),
+            ["0,0", "1,0", "0,1", "1,1"])
+        self.assertEqual(tileUtils.getOverlappingPatchIdList(makeBBox(-1, -51, 2, 1), 100, 50),
+            ["-1,-2", "0,-2"])
+        self.assertEqual(tileUtils.getOverlappingPatchIdList(makeBBox(0, 0, 0, 10), 100, 50), [])
+
+        # every patch returned overlaps the bbox, and every pixel of the bbox is in a returned patch
+        bbox = makeBBox(-130, 75, 345, 110)
+        patchIdList = tileUtils.getOverlappingPatchIdList(bbox, 100, 50)
+        numPixels = 0
+        for patchId in patchIdList:
+            overlapBBox = tileUtils.getOverlapBBox(bbox, tileUtils.getPatchBBox(patchId, 100, 50))
+            self.assertNotEqual(overlapBBox, None)
+            numPixels += overlapBBox.getWidth() * overlapBBox.getHeight()
+        self.assertEqual(numPixels, bbox.getWidth() * bbox.getHeight())
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(TileUtilsTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(exit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), exit)
+
+if __name__ == "__main__":
+    run(True)